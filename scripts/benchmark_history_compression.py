@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Mide bytes transferidos y latencia de los endpoints de historial según
+Accept-Encoding (identity, gzip, br).
+
+Dos modos:
+    --api-url   peticiones HTTP reales al API desplegado (latencia extremo a
+                extremo, bytes en el cable y tiempo de descompresión en el cliente)
+    (sin flag)  invoca read_history en proceso contra las tablas del stage
+                (bytes del body y tiempo de handler, incluida la compresión)
+
+Uso:
+    python scripts/benchmark_history_compression.py --stage dev --placa P-123ABC
+    python scripts/benchmark_history_compression.py --api-url https://xxx.execute-api.us-east-1.amazonaws.com/dev \\
+        --placa P-123ABC --requests 20
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+import urllib.request
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+import local_pipeline  # noqa: E402
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ENDPOINTS = ['payments', 'invoices']
+ENCODINGS = ['identity', 'gzip', 'br']
+
+
+def decompress(body, coding):
+    if coding == 'gzip':
+        return gzip.decompress(body)
+    if coding == 'br':
+        return brotli.decompress(body)
+    return body
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(samples):
+    return {
+        'bytes': samples[0]['bytes'],
+        'raw_bytes': samples[0]['raw_bytes'],
+        'p50_ms': round(statistics.median(s['ms'] for s in samples), 2),
+        'p95_ms': round(percentile([s['ms'] for s in samples], 0.95), 2),
+        'decode_ms': round(statistics.median(s['decode_ms'] for s in samples), 3)
+    }
+
+
+def measure_api(api_url, endpoint, placa, coding, limit):
+    url = f"{api_url.rstrip('/')}/history/{endpoint}/{placa}?limit={limit}"
+    request = urllib.request.Request(url, headers={'Accept-Encoding': coding, 'Accept': 'application/json'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+        received = response.headers.get('Content-Encoding') or 'identity'
+    elapsed = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    raw = decompress(body, received)
+    return {
+        'bytes': len(body),
+        'raw_bytes': len(raw),
+        'ms': elapsed,
+        'decode_ms': (time.perf_counter() - start) * 1000
+    }
+
+
+def measure_local(module, endpoint, placa, coding, limit):
+    event = {
+        'path': f'/history/{endpoint}/{placa}',
+        'httpMethod': 'GET',
+        'pathParameters': {'placa': placa},
+        'queryStringParameters': {'limit': str(limit)},
+        'headers': {'Accept-Encoding': coding}
+    }
+    invoke = local_pipeline.Invoker()
+    response = invoke('read_history', module, event)
+    body = response['body'].encode('utf-8')
+    if response.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    received = response['headers'].get('Content-Encoding', 'identity')
+    start = time.perf_counter()
+    raw = decompress(body, received)
+    return {
+        'bytes': len(body),
+        'raw_bytes': len(raw),
+        'ms': invoke.elapsed_ms,
+        'decode_ms': (time.perf_counter() - start) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compara tamaño y latencia del historial según Accept-Encoding')
+    parser.add_argument('--placa', type=str, required=True, help='Placa a consultar')
+    parser.add_argument('--api-url', type=str, default=None, help='URL base del stage del API')
+    parser.add_argument('--stage', type=str, default=local_pipeline.DEFAULT_STAGE,
+                        help=f'Stage para el modo local (default: {local_pipeline.DEFAULT_STAGE})')
+    parser.add_argument('--limit', type=int, default=50, help='Items por página')
+    parser.add_argument('--requests', type=int, default=10, help='Peticiones por combinación')
+    parser.add_argument('--json', action='store_true', help='Imprimir el reporte como JSON')
+    args = parser.parse_args()
+
+    encodings = [coding for coding in ENCODINGS if coding != 'br' or brotli is not None]
+    if args.api_url:
+        measure = lambda endpoint, coding: measure_api(args.api_url, endpoint, args.placa, coding, args.limit)  # noqa: E731
+    else:
+        local_pipeline.configure_environment(args.stage, trace=False)
+        module = local_pipeline.load_handler('read_history')
+        measure = lambda endpoint, coding: measure_local(module, endpoint, args.placa, coding, args.limit)  # noqa: E731
+
+    report = {}
+    for endpoint in ENDPOINTS:
+        for coding in encodings:
+            samples = [measure(endpoint, coding) for _ in range(args.requests)]
+            report[f'{endpoint}/{coding}'] = summarize(samples)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print()
+    print('=' * 78)
+    print(f"📦 HISTORIAL {args.placa} ({'API' if args.api_url else 'local'}, limit={args.limit})")
+    print('=' * 78)
+    print(f"{'endpoint/encoding':<22}{'bytes':>10}{'sin comp.':>11}{'ratio':>8}{'p50 ms':>9}{'p95 ms':>9}{'decode ms':>11}")
+    for name, stats in report.items():
+        ratio = stats['raw_bytes'] / stats['bytes'] if stats['bytes'] else 0
+        print(f"{name:<22}{stats['bytes']:>10}{stats['raw_bytes']:>11}{ratio:>8.1f}"
+              f"{stats['p50_ms']:>9}{stats['p95_ms']:>9}{stats['decode_ms']:>11}")
+
+
+if __name__ == '__main__':
+    main()
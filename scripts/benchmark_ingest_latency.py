@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Mide la latencia de ingest_webhook con las lecturas de validación en
+secuencia y en paralelo (INGEST_CONCURRENT_LOOKUPS), invocando el handler en
+proceso contra las tablas DynamoDB de un stage.
+
+En cada petición con tag_id, la lectura del tag corre en paralelo con la
+validación del peaje y el control de admisión. Para que el control de
+admisión lea DynamoDB como en producción, se usa la tabla AdmissionBuckets del
+stage (--admission) con un presupuesto alto, así ninguna petición recibe 429.
+--lease-size 1 fuerza una escritura de admisión por petición (peor caso).
+
+Contra tablas locales (DynamoDB Local) la latencia de red es casi nula:
+--added-latency-ms agrega un retardo fijo a cada llamada DynamoDB para
+aproximar el round trip desde Lambda.
+
+EventBridge se sustituye por el bus local: no se publican cruces.
+
+Uso:
+    python scripts/benchmark_ingest_latency.py --stage dev --requests 500
+    python scripts/benchmark_ingest_latency.py --stage dev --admission --lease-size 1 --added-latency-ms 8
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+import local_pipeline  # noqa: E402
+
+MODES = {'sequential': False, 'concurrent': True}
+WARMUP_REQUESTS = 20
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def summarize(samples):
+    return {
+        'requests': len(samples),
+        'mean_ms': round(statistics.fmean(samples), 2),
+        'p50_ms': round(percentile(samples, 0.50), 2),
+        'p95_ms': round(percentile(samples, 0.95), 2),
+        'p99_ms': round(percentile(samples, 0.99), 2),
+        'max_ms': round(max(samples), 2)
+    }
+
+
+def add_latency(client, milliseconds):
+    """Retardo fijo antes de enviar cada petición DynamoDB (round trip simulado)."""
+    def delay(**kwargs):
+        time.sleep(milliseconds / 1000)
+    client.meta.events.register('before-send.dynamodb', delay)
+
+
+def load_events(path, limit=None):
+    with open(path, 'r', encoding='utf-8') as f:
+        events = json.load(f)
+    events = [event for event in events if event.get('tag_id')]
+    return events[:limit] if limit else events
+
+
+def measure(module, events, requests):
+    """Latencia del handler por petición (ms), recorriendo los eventos en ciclo."""
+    invoke = local_pipeline.Invoker()
+    samples, statuses = [], {}
+    for index in range(requests):
+        body = dict(events[index % len(events)])
+        # Sin caché negativa: cada petición lee el tag aunque no exista
+        module.negative.clear('tag:')
+        invoke.reset()
+        response = invoke('ingest_webhook', module, {'body': json.dumps(body)})
+        samples.append(invoke.elapsed_ms)
+        statuses[response['statusCode']] = statuses.get(response['statusCode'], 0) + 1
+    return samples, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latencia de ingest_webhook con lecturas en secuencia vs en paralelo')
+    parser.add_argument('--stage', type=str, default=local_pipeline.DEFAULT_STAGE,
+                        help=f'Stage de las tablas (default: {local_pipeline.DEFAULT_STAGE})')
+    parser.add_argument('--events', type=str, default=local_pipeline.DEFAULT_EVENTS,
+                        help='JSON con los eventos de webhook (se usan los que traen tag_id)')
+    parser.add_argument('--requests', type=int, default=300, help='Peticiones medidas por modo')
+    parser.add_argument('--admission', action='store_true',
+                        help='Usar AdmissionBuckets-<stage> (escrituras de admisión reales)')
+    parser.add_argument('--lease-size', type=int, default=None,
+                        help='Tokens por lease de admisión (1 = una escritura por petición)')
+    parser.add_argument('--added-latency-ms', type=float, default=0.0,
+                        help='Retardo agregado a cada llamada DynamoDB')
+    parser.add_argument('--json', action='store_true', help='Imprimir el reporte como JSON')
+    args = parser.parse_args()
+
+    local_pipeline.configure_environment(args.stage, trace=False)
+    if args.admission:
+        os.environ['ADMISSION_TABLE'] = f'AdmissionBuckets-{args.stage}'
+        os.environ['ADMISSION_RATE_PER_SECOND'] = '1000000'
+        os.environ['ADMISSION_BURST'] = '1000000'
+    if args.lease_size:
+        os.environ['ADMISSION_LEASE_SIZE'] = str(args.lease_size)
+
+    module = local_pipeline.load_handler('ingest_webhook')
+    module.eventbridge = local_pipeline.LocalEventBus()
+    if args.added_latency_ms:
+        add_latency(module.dynamodb.meta.client, args.added_latency_ms)
+    events = load_events(args.events)
+    if not events:
+        print('❌ No hay eventos con tag_id en el archivo')
+        sys.exit(1)
+
+    report = {}
+    for mode, concurrent in MODES.items():
+        module.INGEST_CONCURRENT_LOOKUPS = concurrent
+        measure(module, events, WARMUP_REQUESTS)
+        samples, statuses = measure(module, events, args.requests)
+        report[mode] = {**summarize(samples), 'status_codes': statuses}
+
+    sequential, concurrent = report['sequential'], report['concurrent']
+    report['improvement'] = {
+        key: round(1 - concurrent[key] / sequential[key], 3) if sequential[key] else 0
+        for key in ('p50_ms', 'p95_ms', 'p99_ms')
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print()
+    print('=' * 78)
+    print(f"⏱️  INGEST_WEBHOOK ({args.stage}, {args.requests} peticiones con tag por modo"
+          f"{', admisión' if args.admission else ''}"
+          f"{f', +{args.added_latency_ms}ms por llamada' if args.added_latency_ms else ''})")
+    print('=' * 78)
+    print(f"{'modo':<14}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}  status")
+    for mode in MODES:
+        stats = report[mode]
+        print(f"{mode:<14}{stats['mean_ms']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['max_ms']:>10}  {stats['status_codes']}")
+    improvement = report['improvement']
+    print(f"\n📉 Mejora con lecturas en paralelo: p50 {improvement['p50_ms']:.0%}, "
+          f"p95 {improvement['p95_ms']:.0%}, p99 {improvement['p99_ms']:.0%}")
+
+
+if __name__ == '__main__':
+    main()
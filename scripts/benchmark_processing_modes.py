@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Compara los modos de procesamiento de cruces (ProcessingMode) ejecutando los
+handlers en proceso contra las tablas DynamoDB de un stage:
+
+    stepfunctions  ingest_webhook → EventBridge → máquina de estados por cruce
+    batch          ingest_webhook → EventBridge → SQS → process_toll_batch (lotes de 100)
+    fifo           ingest_webhook → SQS FIFO (grupo = tag_id o placa) → process_toll_batch (lotes de 10)
+
+Por modo reporta invocaciones, llamadas DynamoDB y tiempo de handler por
+cruce, y el throughput secuencial (cruces por segundo de cómputo). En fifo
+también reporta los grupos de mensajes: la concurrencia máxima del consumidor
+es el número de grupos activos y el grupo más largo se procesa en serie.
+
+Finalmente verifica el orden de los débitos por tag: en cada tag, el
+tag_balance_before de un cruce debe ser el tag_balance_after del anterior.
+
+Los cruces se escriben en el stage indicado (igual que local_pipeline.py).
+
+Uso:
+    python scripts/benchmark_processing_modes.py --stage dev
+    python scripts/benchmark_processing_modes.py --stage dev --modes fifo batch --repeat 5
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.conditions import Key
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
+
+import local_pipeline  # noqa: E402
+
+MODES = ['stepfunctions', 'batch', 'fifo']
+BATCH_SIZE = {'batch': 100, 'fifo': 10}
+# Transiciones de estado por cruce en ProcessToll (Validate, Calculate, [UpdateTag], Persist, Notify)
+STATE_TRANSITIONS = {'tag': 5, 'default': 4}
+
+
+class LocalQueue:
+    """Sustituto local de SQS (estándar o FIFO): conserva los mensajes enviados."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, MessageGroupId=None, MessageDeduplicationId=None):
+        record = {
+            'messageId': f'msg-{len(self.messages)}',
+            'body': MessageBody,
+            'attributes': {}
+        }
+        if MessageGroupId is not None:
+            record['attributes']['MessageGroupId'] = MessageGroupId
+        self.messages.append(record)
+        return {'MessageId': record['messageId']}
+
+    def batches(self, size):
+        """
+        Lotes como los arma el poller de Lambda: en colas FIFO cada grupo
+        conserva su orden y un lote puede mezclar grupos.
+        """
+        if not self.messages or 'MessageGroupId' not in self.messages[0]['attributes']:
+            for start in range(0, len(self.messages), size):
+                yield self.messages[start:start + size]
+            return
+        groups = {}
+        for record in self.messages:
+            groups.setdefault(record['attributes']['MessageGroupId'], []).append(record)
+        pending = list(groups.values())
+        while pending:
+            batch = []
+            for group in pending:
+                while group and len(batch) < size:
+                    batch.append(group.pop(0))
+                if len(batch) >= size:
+                    break
+            pending = [group for group in pending if group]
+            yield batch
+
+    def groups(self):
+        sizes = {}
+        for record in self.messages:
+            group = record['attributes'].get('MessageGroupId')
+            sizes[group] = sizes.get(group, 0) + 1
+        return sizes
+
+
+class LocalNotifications:
+    """Sustituto local de SNS para process_toll_batch."""
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        return {'Successful': [{'Id': e['Id']} for e in PublishBatchRequestEntries], 'Failed': []}
+
+
+def expand(payloads, repeat):
+    """Repite los payloads desplazando el timestamp para que los cruces de un tag tengan orden."""
+    expanded = []
+    for i in range(repeat):
+        for payload in payloads:
+            payload = dict(payload)
+            timestamp = datetime.fromisoformat(payload['timestamp'].replace('Z', '+00:00'))
+            payload['timestamp'] = (timestamp + timedelta(minutes=i)).isoformat().replace('+00:00', 'Z')
+            expanded.append(payload)
+    return expanded
+
+
+def ingest(handlers, bus, payloads, invoke):
+    """Pasa los payloads por ingest_webhook; retorna los aceptados."""
+    accepted = 0
+    for payload in payloads:
+        response = invoke('ingest_webhook', handlers['ingest_webhook'], {'body': json.dumps(payload)})
+        if response['statusCode'] == 200:
+            accepted += 1
+        else:
+            print(f"  ❌ ingest {payload.get('placa') or payload.get('tag_id')}: {response['body']}")
+    return accepted
+
+
+def run_stepfunctions(handlers, payloads, invoke, stats):
+    bus = local_pipeline.LocalEventBus()
+    handlers['ingest_webhook'].eventbridge = bus
+    handlers['ingest_webhook'].TOLL_FIFO_QUEUE_URL = None
+    ingest(handlers, bus, payloads, invoke)
+    invoke.reset()
+    for entry in bus.entries:
+        detail = json.loads(entry['Detail'])
+        stats['invocations'] += 3
+        try:
+            state = local_pipeline.run_state_machine(handlers, detail, invoke)
+        except Exception as e:
+            print(f"  ❌ {detail.get('placa')}: {e}")
+            continue
+        if state.get('user_type') == 'tag':
+            stats['invocations'] += 1
+        stats['transitions'] += STATE_TRANSITIONS.get(state.get('user_type'), STATE_TRANSITIONS['default'])
+        stats['crossings'] += 1
+
+
+def run_queue(mode, handlers, payloads, invoke, stats):
+    queue = LocalQueue()
+    module = handlers['ingest_webhook']
+    if mode == 'fifo':
+        module.sqs = queue
+        module.TOLL_FIFO_QUEUE_URL = 'local-fifo'
+        ingest(handlers, None, payloads, invoke)
+    else:
+        # La regla de EventBridge entrega el evento completo a la cola estándar
+        bus = local_pipeline.LocalEventBus()
+        module.eventbridge = bus
+        module.TOLL_FIFO_QUEUE_URL = None
+        ingest(handlers, bus, payloads, invoke)
+        for entry in bus.entries:
+            queue.send_message('local', json.dumps({'detail': json.loads(entry['Detail'])}))
+    invoke.reset()
+    for batch in queue.batches(BATCH_SIZE[mode]):
+        response = invoke('process_toll_batch', handlers['process_toll_batch'], {'Records': batch})
+        stats['invocations'] += 1
+        stats['crossings'] += len(batch) - len(response['batchItemFailures'])
+    if mode == 'fifo':
+        sizes = queue.groups()
+        stats['groups'] = len(sizes)
+        stats['largest_group'] = max(sizes.values()) if sizes else 0
+
+
+def check_order(payloads, since):
+    """Cuenta los cruces de tag cuyo balance anterior no coincide con el posterior del cruce previo."""
+    table = boto3.resource('dynamodb').Table(os.environ['TRANSACTIONS_TABLE'])
+    violations = 0
+    for placa in sorted({p['placa'] for p in payloads if p.get('tag_id') and p.get('placa')}):
+        items = table.query(KeyConditionExpression=Key('placa').eq(placa))['Items']
+        items = sorted((i for i in items if i.get('created_at', '') >= since and 'tag_balance_before' in i),
+                       key=lambda i: i['ts'])
+        for previous, current in zip(items, items[1:]):
+            if Decimal(current['tag_balance_before']) != Decimal(previous['tag_balance_after']):
+                violations += 1
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compara throughput y costo DynamoDB de los modos de procesamiento de cruces'
+    )
+    parser.add_argument('--stage', type=str, default=local_pipeline.DEFAULT_STAGE,
+                        help=f'Stage del deployment (default: {local_pipeline.DEFAULT_STAGE})')
+    parser.add_argument('--events', type=str, default=local_pipeline.DEFAULT_EVENTS,
+                        help='Archivo JSON con la lista de payloads del webhook')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Veces que se repite cada payload (cruces sucesivos del mismo tag)')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES,
+                        help='Modos a comparar')
+    parser.add_argument('--json', action='store_true',
+                        help='Imprimir el reporte como JSON')
+    args = parser.parse_args()
+
+    local_pipeline.configure_environment(args.stage)
+    handlers, _ = local_pipeline.load_pipeline(local_pipeline.PIPELINE_FUNCTIONS + ['process_toll_batch'])
+    handlers['process_toll_batch'].sns = LocalNotifications()
+    invoke = local_pipeline.Invoker()
+
+    with open(args.events, 'r', encoding='utf-8') as f:
+        payloads = expand(json.load(f), args.repeat)
+
+    report = {}
+    for mode in args.modes:
+        since = datetime.utcnow().isoformat() + 'Z'
+        stats = {'crossings': 0, 'invocations': 0, 'transitions': 0}
+        if mode == 'stepfunctions':
+            run_stepfunctions(handlers, payloads, invoke, stats)
+        else:
+            run_queue(mode, handlers, payloads, invoke, stats)
+        n = max(stats['crossings'], 1)
+        stats.update({
+            'ddb_calls_per_crossing': round(invoke.cost['calls'] / n, 2),
+            'wcu_per_crossing': round(invoke.cost['wcu'] / n, 2),
+            'handler_ms_per_crossing': round(invoke.elapsed_ms / n, 2),
+            'crossings_per_second': round(n / (invoke.elapsed_ms / 1000), 1) if invoke.elapsed_ms else None,
+            'order_violations': check_order(payloads, since)
+        })
+        report[mode] = stats
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print()
+    print('=' * 96)
+    print('⏱️  MODOS DE PROCESAMIENTO (secuencial, handlers en proceso)')
+    print('=' * 96)
+    print(f"{'modo':<15}{'cruces':>8}{'invoc.':>8}{'transic.':>10}{'ddb/cruce':>11}{'wcu/cruce':>11}"
+          f"{'ms/cruce':>10}{'cruces/s':>10}{'desorden':>10}")
+    for mode, stats in report.items():
+        print(f"{mode:<15}{stats['crossings']:>8}{stats['invocations']:>8}{stats['transitions']:>10}"
+              f"{stats['ddb_calls_per_crossing']:>11}{stats['wcu_per_crossing']:>11}"
+              f"{stats['handler_ms_per_crossing']:>10}{stats['crossings_per_second'] or 0:>10}"
+              f"{stats['order_violations']:>10}")
+    if 'fifo' in report:
+        print(f"\nfifo: {report['fifo']['groups']} grupos (concurrencia máxima del consumidor), "
+              f"grupo más largo {report['fifo']['largest_group']} cruces en serie")
+
+
+if __name__ == '__main__':
+    main()
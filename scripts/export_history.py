@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Exporta Transactions e Invoices a archivos columnares (Parquet o Arrow IPC)
+particionados por día y peaje_id, para análisis offline con
+scripts/history_analytics.py sin consumir capacidad de lectura de DynamoDB.
+
+El scan se divide en segmentos paralelos (Segment/TotalSegments), uno por hilo;
+cada segmento escribe sus propios archivos de parte, así que no hay
+coordinación entre hilos. Estructura de salida (particionado estilo Hive):
+
+    <out>/transactions/day=2025-11-12/peaje_id=PEAJE_ZONA10/part-03-0000.parquet
+    <out>/invoices/day=2025-11-12/peaje_id=none/part-00-0000.parquet
+    <out>/<tabla>/_manifest.json
+
+Uso:
+    python scripts/export_history.py --stage dev
+    python scripts/export_history.py --stage prod --segments 16 --out export/2025-11 --overwrite
+    python scripts/export_history.py --stage dev --tables invoices --format arrow
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import boto3
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+
+DEFAULT_STAGE = 'dev'
+DEFAULT_OUT = os.path.join(PROJECT_ROOT, 'export')
+DEFAULT_SEGMENTS = 8
+# Filas por partición que un segmento acumula antes de escribir un archivo de parte
+ROWS_PER_PART = 50000
+NO_PEAJE = 'none'
+
+TIMESTAMP = pa.timestamp('ms', tz='UTC')
+
+TRANSACTIONS_SCHEMA = pa.schema([
+    ('event_id', pa.string()),
+    ('placa', pa.string()),
+    ('peaje_id', pa.string()),
+    ('user_type', pa.string()),
+    ('tag_id', pa.string()),
+    ('status', pa.string()),
+    ('requires_payment', pa.bool_()),
+    ('amount', pa.float64()),
+    ('subtotal', pa.float64()),
+    ('tax', pa.float64()),
+    ('late_fee', pa.float64()),
+    ('total_with_late_fee', pa.float64()),
+    ('tag_debt', pa.float64()),
+    ('timestamp', TIMESTAMP),
+    ('created_at', TIMESTAMP),
+    ('completed_at', TIMESTAMP)
+])
+
+INVOICES_SCHEMA = pa.schema([
+    ('invoice_id', pa.string()),
+    ('placa', pa.string()),
+    ('event_id', pa.string()),
+    ('peaje_id', pa.string()),
+    ('status', pa.string()),
+    ('period', pa.string()),
+    ('crossings', pa.int32()),
+    ('amount', pa.float64()),
+    ('subtotal', pa.float64()),
+    ('tax', pa.float64()),
+    ('late_fee', pa.float64()),
+    ('created_at', TIMESTAMP),
+    ('closed_at', TIMESTAMP)
+])
+
+TABLES = {
+    'transactions': {'name': 'Transactions-{stage}', 'schema': TRANSACTIONS_SCHEMA, 'day_field': 'timestamp'},
+    'invoices': {'name': 'Invoices-{stage}', 'schema': INVOICES_SCHEMA, 'day_field': 'created_at'}
+}
+
+
+def parse_timestamp(value):
+    """ISO 8601 → datetime UTC (None si falta o no es válido)."""
+    if not value:
+        return None
+    try:
+        moment = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def to_row(item, schema):
+    """Convierte un item de DynamoDB a una fila con los tipos del esquema."""
+    row = {}
+    for field in schema:
+        value = item.get(field.name)
+        if field.type == TIMESTAMP:
+            row[field.name] = parse_timestamp(value)
+        elif pa.types.is_floating(field.type):
+            row[field.name] = float(value) if value is not None else 0.0
+        elif pa.types.is_integer(field.type):
+            row[field.name] = int(value) if value is not None else 1
+        elif pa.types.is_boolean(field.type):
+            row[field.name] = bool(value)
+        else:
+            row[field.name] = str(value) if value is not None else None
+    return row
+
+
+def partition_of(row, day_field):
+    moment = row.get(day_field) or row.get('created_at')
+    day = moment.strftime('%Y-%m-%d') if moment else 'unknown'
+    return day, row.get('peaje_id') or NO_PEAJE
+
+
+class SegmentWriter:
+    """Acumula filas por partición y escribe archivos de parte de un segmento."""
+
+    def __init__(self, root, schema, segment, file_format):
+        self.root = root
+        self.schema = schema
+        self.segment = segment
+        self.file_format = file_format
+        self.buffers = {}
+        self.parts = 0
+        self.rows = 0
+
+    def add(self, partition, row):
+        buffer = self.buffers.setdefault(partition, [])
+        buffer.append(row)
+        if len(buffer) >= ROWS_PER_PART:
+            self.flush(partition)
+
+    def flush(self, partition):
+        rows = self.buffers.pop(partition, [])
+        if not rows:
+            return
+        day, peaje_id = partition
+        directory = os.path.join(self.root, f'day={day}', f'peaje_id={peaje_id}')
+        os.makedirs(directory, exist_ok=True)
+        # peaje_id va en la ruta de la partición, no en el archivo
+        schema = pa.schema([field for field in self.schema if field.name != 'peaje_id'])
+        table = pa.Table.from_pylist(rows, schema=schema)
+        extension = 'parquet' if self.file_format == 'parquet' else 'arrow'
+        path = os.path.join(directory, f'part-{self.segment:02d}-{self.parts:04d}.{extension}')
+        if self.file_format == 'parquet':
+            pq.write_table(table, path, compression='zstd')
+        else:
+            feather.write_feather(table, path, compression='zstd')
+        self.parts += 1
+        self.rows += len(rows)
+
+    def close(self):
+        for partition in list(self.buffers):
+            self.flush(partition)
+
+
+def export_segment(table_key, stage, root, segment, total_segments, file_format, region=None):
+    """
+    Exporta un segmento del scan. Cada hilo usa su propia sesión (los
+    recursos de boto3 no son thread-safe).
+    """
+    spec = TABLES[table_key]
+    dynamodb = boto3.session.Session(region_name=region).resource('dynamodb')
+    table = dynamodb.Table(spec['name'].format(stage=stage))
+    writer = SegmentWriter(root, spec['schema'], segment, file_format)
+    kwargs = {'Segment': segment, 'TotalSegments': total_segments}
+
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            row = to_row(item, spec['schema'])
+            writer.add(partition_of(row, spec['day_field']), row)
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    writer.close()
+    return {'rows': writer.rows, 'files': writer.parts}
+
+
+def export_table(table_key, stage, out, segments, file_format, region=None, overwrite=False):
+    root = os.path.join(out, table_key)
+    if os.path.exists(root):
+        if not overwrite:
+            raise FileExistsError(f'{root} ya existe (usa --overwrite para reemplazarlo)')
+        shutil.rmtree(root)
+    os.makedirs(root)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [
+            executor.submit(export_segment, table_key, stage, root, segment, segments, file_format, region)
+            for segment in range(segments)
+        ]
+        results = [future.result() for future in futures]
+
+    manifest = {
+        'table': TABLES[table_key]['name'].format(stage=stage),
+        'format': file_format,
+        'partitioning': ['day', 'peaje_id'],
+        'rows': sum(result['rows'] for result in results),
+        'files': sum(result['files'] for result in results),
+        'segments': segments,
+        'exported_at': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+        'elapsed_seconds': round(time.perf_counter() - start, 2)
+    }
+    with open(os.path.join(root, '_manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Exporta Transactions e Invoices a Parquet/Arrow particionado por día y peaje'
+    )
+    parser.add_argument('--stage', type=str, default=DEFAULT_STAGE,
+                        help=f'Stage del deployment (default: {DEFAULT_STAGE})')
+    parser.add_argument('--out', type=str, default=DEFAULT_OUT,
+                        help='Directorio de salida (default: export/)')
+    parser.add_argument('--tables', nargs='+', choices=sorted(TABLES), default=sorted(TABLES),
+                        help='Tablas a exportar (default: todas)')
+    parser.add_argument('--segments', type=int, default=DEFAULT_SEGMENTS,
+                        help=f'Segmentos de scan paralelos (default: {DEFAULT_SEGMENTS})')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet',
+                        help='Formato de archivo (default: parquet)')
+    parser.add_argument('--region', type=str, default=None,
+                        help='Región AWS (default: la configurada en el entorno)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Reemplazar una exportación previa en el mismo directorio')
+    args = parser.parse_args()
+
+    for table_key in args.tables:
+        print(f"📦 Exportando {table_key} ({args.stage}) con {args.segments} segmentos...")
+        try:
+            manifest = export_table(table_key, args.stage, args.out, args.segments,
+                                    args.format, args.region, args.overwrite)
+        except FileExistsError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        print(f"✅ {manifest['rows']} filas en {manifest['files']} archivos ({manifest['elapsed_seconds']}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Análisis offline sobre la exportación columnar de scripts/export_history.py.
+
+Carga las particiones necesarias con pyarrow.dataset (los filtros por día y
+peaje_id se resuelven con la ruta, sin abrir archivos de otras particiones) y
+calcula con operaciones vectorizadas de Arrow/NumPy:
+
+    - revenue: cobrado, facturado y ticket promedio por día / peaje / user_type
+    - debt_aging: saldo pendiente por antigüedad (0-30, 31-60, 61-90, >90 días)
+    - late_fees: mora cobrada y mora acumulada de transacciones aún pendientes
+
+Puede usarse como módulo (funciones que reciben/retornan pyarrow.Table) o por CLI.
+
+Uso:
+    python scripts/history_analytics.py --path export --month 2025-11
+    python scripts/history_analytics.py --path export --from 2025-11-01 --to 2025-11-15 --group-by peaje_id --json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date, datetime, timezone
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+DEFAULT_PATH = os.path.join(PROJECT_ROOT, 'export')
+
+# Misma regla que complete_pending_transaction: 1 GTQ por minuto de atraso
+LATE_FEE_PER_MINUTE = 1.0
+AGING_BUCKETS = ('0-30', '31-60', '61-90', '>90')
+AGING_EDGES = np.array([31, 61, 91])
+
+PARTITIONING = ds.partitioning(pa.schema([('day', pa.string()), ('peaje_id', pa.string())]), flavor='hive')
+
+
+def load(path, table='transactions', day_from=None, day_to=None, peaje_ids=None, columns=None):
+    """
+    Carga una tabla exportada como pyarrow.Table. day_from/day_to (YYYY-MM-DD,
+    inclusive) y peaje_ids filtran por partición.
+    """
+    root = os.path.join(path, table)
+    with open(os.path.join(root, '_manifest.json'), encoding='utf-8') as f:
+        fmt = 'ipc' if json.load(f).get('format') == 'arrow' else 'parquet'
+    dataset = ds.dataset(root, format=fmt, partitioning=PARTITIONING,
+                         exclude_invalid_files=True, ignore_prefixes=['_', '.'])
+    condition = None
+    for clause in (
+        ds.field('day') >= day_from if day_from else None,
+        ds.field('day') <= day_to if day_to else None,
+        ds.field('peaje_id').isin(list(peaje_ids)) if peaje_ids else None
+    ):
+        if clause is not None:
+            condition = clause if condition is None else condition & clause
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+def _collected(transactions):
+    """Monto cobrado por fila: total con mora si existe, 0 si aún requiere pago."""
+    amount = transactions['amount']
+    with_late_fee = transactions['total_with_late_fee']
+    paid = pc.and_(pc.equal(transactions['status'], 'completed'),
+                   pc.invert(transactions['requires_payment']))
+    gross = pc.if_else(pc.greater(with_late_fee, 0), with_late_fee, amount)
+    return pc.if_else(paid, gross, 0.0)
+
+
+def revenue(transactions, group_by=('day',)):
+    """
+    Cobrado, facturado, cruces y ticket promedio (facturado / cruces) agrupado
+    por columnas de la tabla (day, peaje_id, user_type, placa...).
+    """
+    table = transactions.append_column('collected', _collected(transactions))
+    grouped = table.group_by(list(group_by)).aggregate([
+        ('amount', 'sum'),
+        ('collected', 'sum'),
+        ('amount', 'count'),
+        ('late_fee', 'sum')
+    ])
+    grouped = grouped.rename_columns(list(group_by) + ['billed', 'collected', 'crossings', 'late_fee'])
+    average = pc.divide(grouped['billed'], pc.cast(grouped['crossings'], pa.float64()))
+    grouped = grouped.append_column('average_ticket', average)
+    return grouped.sort_by([(column, 'ascending') for column in group_by])
+
+
+def _outstanding(transactions):
+    """Saldo pendiente por fila: deuda del tag si existe, si no el monto del cruce."""
+    pending = transactions['requires_payment'].to_numpy(zero_copy_only=False)
+    tag_debt = transactions['tag_debt'].to_numpy(zero_copy_only=False)
+    amount = transactions['amount'].to_numpy(zero_copy_only=False)
+    return pending, np.where(tag_debt > 0, tag_debt, amount) * pending
+
+
+def _age_minutes(transactions, as_of):
+    crossed = pc.coalesce(transactions['timestamp'], transactions['created_at'])
+    crossed = crossed.cast(pa.int64()).to_numpy(zero_copy_only=False)
+    as_of_ms = int(as_of.timestamp() * 1000)
+    return np.maximum(as_of_ms - crossed, 0) / 60000.0
+
+
+def debt_aging(transactions, as_of=None):
+    """
+    Saldo pendiente (requires_payment) por antigüedad del cruce en días.
+    Retorna {bucket: {'count', 'amount'}} más 'total'.
+    """
+    as_of = as_of or datetime.now(timezone.utc)
+    pending, outstanding = _outstanding(transactions)
+    days = _age_minutes(transactions, as_of) / (60 * 24)
+    buckets = np.digitize(days, AGING_EDGES)
+    counts = np.bincount(buckets[pending], minlength=len(AGING_BUCKETS))
+    amounts = np.bincount(buckets[pending], weights=outstanding[pending], minlength=len(AGING_BUCKETS))
+    report = {
+        bucket: {'count': int(counts[i]), 'amount': round(float(amounts[i]), 2)}
+        for i, bucket in enumerate(AGING_BUCKETS)
+    }
+    report['total'] = {'count': int(pending.sum()), 'amount': round(float(outstanding.sum()), 2)}
+    return report
+
+
+def late_fees(transactions, as_of=None):
+    """
+    Mora cobrada (transacciones completadas con late_fee) y mora acumulada a
+    la fecha de las pendientes según LATE_FEE_PER_MINUTE.
+    """
+    as_of = as_of or datetime.now(timezone.utc)
+    charged = transactions['late_fee'].to_numpy(zero_copy_only=False)
+    pending, _ = _outstanding(transactions)
+    accrued = np.floor(_age_minutes(transactions, as_of)) * LATE_FEE_PER_MINUTE * pending
+    return {
+        'charged': round(float(charged.sum()), 2),
+        'charged_count': int(np.count_nonzero(charged)),
+        'accrued_pending': round(float(accrued.sum()), 2),
+        'pending_count': int(pending.sum())
+    }
+
+
+def summary(transactions, as_of=None):
+    """Totales del periodo: cobrado, facturado, cruces, ticket promedio, deuda y mora."""
+    billed = float(pc.sum(transactions['amount']).as_py() or 0)
+    collected = float(pc.sum(_collected(transactions)).as_py() or 0)
+    crossings = transactions.num_rows
+    return {
+        'crossings': crossings,
+        'billed': round(billed, 2),
+        'collected': round(collected, 2),
+        'average_ticket': round(billed / crossings, 2) if crossings else 0.0,
+        'debt_aging': debt_aging(transactions, as_of),
+        'late_fees': late_fees(transactions, as_of)
+    }
+
+
+def month_range(month):
+    year, number = (int(part) for part in month.split('-'))
+    first = date(year, number, 1)
+    last = date(year + (number == 12), number % 12 + 1, 1).toordinal() - 1
+    return first.isoformat(), date.fromordinal(last).isoformat()
+
+
+def print_report(report, breakdown):
+    print()
+    print('=' * 78)
+    print('📊 RESUMEN DE TRANSACCIONES')
+    print('=' * 78)
+    print(f"Cruces: {report['crossings']}   Facturado: Q{report['billed']:.2f}   "
+          f"Cobrado: Q{report['collected']:.2f}   Ticket promedio: Q{report['average_ticket']:.2f}")
+    print('\nDeuda por antigüedad (días):')
+    for bucket in AGING_BUCKETS + ('total',):
+        stats = report['debt_aging'][bucket]
+        print(f"  {bucket:<8}{stats['count']:>8}  Q{stats['amount']:>12.2f}")
+    fees = report['late_fees']
+    print(f"\nMora cobrada: Q{fees['charged']:.2f} ({fees['charged_count']} transacciones)   "
+          f"Mora acumulada pendiente: Q{fees['accrued_pending']:.2f} ({fees['pending_count']})")
+    if breakdown is not None:
+        print()
+        columns = breakdown.column_names
+        print(''.join(f'{column:>16}' for column in columns))
+        for row in breakdown.to_pylist():
+            print(''.join(f'{value:>16.2f}' if isinstance(value, float) else f'{str(value):>16}'
+                          for value in (row[column] for column in columns)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ingresos, ticket promedio, antigüedad de deuda y mora sobre la exportación columnar'
+    )
+    parser.add_argument('--path', type=str, default=DEFAULT_PATH,
+                        help='Directorio de la exportación (default: export/)')
+    parser.add_argument('--month', type=str, default=None, help='Mes a analizar (YYYY-MM)')
+    parser.add_argument('--from', dest='day_from', type=str, default=None, help='Día inicial (YYYY-MM-DD)')
+    parser.add_argument('--to', dest='day_to', type=str, default=None, help='Día final (YYYY-MM-DD)')
+    parser.add_argument('--peaje', action='append', default=None, help='Filtrar por peaje_id (repetible)')
+    parser.add_argument('--group-by', nargs='+', default=None,
+                        help='Desglose de ingresos (ej: day peaje_id user_type)')
+    parser.add_argument('--json', action='store_true', help='Imprimir el reporte como JSON')
+    args = parser.parse_args()
+
+    day_from, day_to = args.day_from, args.day_to
+    if args.month:
+        day_from, day_to = month_range(args.month)
+
+    start = time.perf_counter()
+    try:
+        transactions = load(args.path, 'transactions', day_from, day_to, args.peaje)
+    except FileNotFoundError:
+        print(f"❌ No hay exportación de transacciones en {args.path} (ejecuta scripts/export_history.py)")
+        sys.exit(1)
+    report = summary(transactions)
+    breakdown = revenue(transactions, args.group_by) if args.group_by else None
+    report['elapsed_seconds'] = round(time.perf_counter() - start, 3)
+
+    if args.json:
+        if breakdown is not None:
+            report['breakdown'] = breakdown.to_pylist()
+        print(json.dumps(report, indent=2, default=str))
+    else:
+        print_report(report, breakdown)
+        print(f"\nFilas analizadas: {transactions.num_rows} ({report['elapsed_seconds']}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,11 @@ Script para cargar datos CSV directamente a DynamoDB sin necesidad de rebuild/de
 Uso:
     python scripts/load_csv_data.py --stage dev
     python scripts/load_csv_data.py --stage dev --clientes data/clientes.csv --peajes data/peajes.csv
+    python scripts/load_csv_data.py --stage dev --sync --segments 8
+
+Con --sync solo se escriben las filas nuevas o cambiadas (huella por fila,
+ver src/layers/common/seed_sync.py) y se conservan los campos vivos: el
+balance, la deuda y el status de los tags y el saldo_disponible de los usuarios.
 """
 
 import argparse
@@ -19,11 +24,19 @@ from botocore.exceptions import ClientError
 # Obtener el directorio raíz del proyecto (donde está este script)
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+LAYER_DIR = os.path.join(PROJECT_ROOT, 'src', 'layers', 'common')
+if LAYER_DIR not in sys.path:
+    sys.path.insert(0, LAYER_DIR)
+
+import cache_versions  # noqa: E402
+import classification_cache  # noqa: E402
+import seed_sync  # noqa: E402
 
 # Configuración por defecto (rutas relativas al directorio raíz del proyecto)
 DEFAULT_CLIENTES_CSV = os.path.join(PROJECT_ROOT, 'data', 'clientes.csv')
 DEFAULT_PEAJES_CSV = os.path.join(PROJECT_ROOT, 'data', 'peajes.csv')
 DEFAULT_STAGE = 'dev'
+DEFAULT_SEGMENTS = 4
 
 
 def to_decimal(value):
@@ -47,6 +60,49 @@ def to_bool(value):
     return False
 
 
+def user_item_from_row(row):
+    """Item de UsersVehicles a partir de una fila de clientes.csv (None si el campo viene vacío)."""
+    return {
+        'placa': row.get('placa', '').strip(),
+        'nombre': row.get('nombre', '').strip(),
+        'email': row.get('email', '').strip() or None,
+        'telefono': row.get('telefono', '').strip() or None,
+        'tipo_usuario': row.get('tipo_usuario', 'no_registrado').strip(),
+        'tiene_tag': to_bool(row.get('tiene_tag', 'false')),
+        'tag_id': row.get('tag_id', '').strip() or None,
+        'saldo_disponible': to_decimal(row.get('saldo_disponible', '0.00')),
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+
+
+def tag_item_from_user(user_item):
+    """Item de Tags del usuario (saldo inicial = saldo_disponible)."""
+    return {
+        'tag_id': user_item['tag_id'],
+        'placa': user_item['placa'],
+        'status': 'active',
+        'balance': user_item['saldo_disponible'],
+        'debt': Decimal('0.00'),
+        'late_fee': Decimal('0.00'),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'last_updated': datetime.now(timezone.utc).isoformat()
+    }
+
+
+def toll_item_from_row(row):
+    """Item de TollsCatalog a partir de una fila de peajes.csv."""
+    return {
+        'peaje_id': row.get('peaje_id', '').strip(),
+        'nombre': row.get('nombre', '').strip(),
+        'carretera': row.get('carretera', '').strip() or None,
+        'km': int(row.get('km', 0)) if row.get('km', '').strip() else None,
+        'tarifa_no_registrado': to_decimal(row.get('monto_no_registrado', '0.00')),
+        'tarifa_registrado': to_decimal(row.get('monto_registrado', '0.00')),
+        'tarifa_tag': to_decimal(row.get('monto_tag', '0.00')),
+        'created_at': datetime.now(timezone.utc).isoformat()
+    }
+
+
 def load_clientes(dynamodb, stage, csv_path):
     """Carga datos de clientes desde CSV a las tablas UsersVehicles y Tags."""
     users_table_name = f'UsersVehicles-{stage}'
@@ -72,31 +128,9 @@ def load_clientes(dynamodb, stage, csv_path):
             if not placa:
                 continue
             
-            # Preparar datos del usuario
-            email_value = row.get('email', '').strip()
-            telefono_value = row.get('telefono', '').strip()
-            tag_id_value = row.get('tag_id', '').strip()
-            
-            user_item = {
-                'placa': placa,
-                'nombre': row.get('nombre', '').strip(),
-                'tipo_usuario': row.get('tipo_usuario', 'no_registrado').strip(),
-                'tiene_tag': to_bool(row.get('tiene_tag', 'false')),
-                'saldo_disponible': to_decimal(row.get('saldo_disponible', '0.00')),
-                'created_at': datetime.now(timezone.utc).isoformat()
-            }
-            
-            # Solo incluir email si tiene valor (índice sparse - no puede ser NULL para GSI)
-            if email_value:
-                user_item['email'] = email_value
-            
-            # Solo incluir telefono si tiene valor
-            if telefono_value:
-                user_item['telefono'] = telefono_value
-            
-            # Solo incluir tag_id si tiene valor
-            if tag_id_value:
-                user_item['tag_id'] = tag_id_value
+            # Preparar datos del usuario (email, telefono y tag_id solo si tienen
+            # valor: índice sparse, no pueden ser NULL para GSI)
+            user_item = {key: value for key, value in user_item_from_row(row).items() if value is not None}
             
             # Guardar usuario
             try:
@@ -110,16 +144,7 @@ def load_clientes(dynamodb, stage, csv_path):
             
             # Si tiene tag, crear/actualizar registro en tabla Tags
             if user_item.get('tiene_tag') and user_item.get('tag_id'):
-                tag_item = {
-                    'tag_id': user_item['tag_id'],
-                    'placa': placa,
-                    'status': 'active',
-                    'balance': user_item['saldo_disponible'],
-                    'debt': Decimal('0.00'),
-                    'late_fee': Decimal('0.00'),
-                    'created_at': datetime.now(timezone.utc).isoformat(),
-                    'last_updated': datetime.now(timezone.utc).isoformat()
-                }
+                tag_item = tag_item_from_user(user_item)
                 try:
                     tags_table.put_item(Item=tag_item)
                     tags_count += 1
@@ -152,16 +177,7 @@ def load_peajes(dynamodb, stage, csv_path):
                 continue
             
             # Preparar datos del peaje
-            toll_item = {
-                'peaje_id': peaje_id,
-                'nombre': row.get('nombre', '').strip(),
-                'carretera': row.get('carretera', '').strip() or None,
-                'km': int(row.get('km', 0)) if row.get('km', '').strip() else None,
-                'tarifa_no_registrado': to_decimal(row.get('monto_no_registrado', '0.00')),
-                'tarifa_registrado': to_decimal(row.get('monto_registrado', '0.00')),
-                'tarifa_tag': to_decimal(row.get('monto_tag', '0.00')),
-                'created_at': datetime.now(timezone.utc).isoformat()
-            }
+            toll_item = toll_item_from_row(row)
             
             # Guardar peaje
             try:
@@ -176,6 +192,84 @@ def load_peajes(dynamodb, stage, csv_path):
     return tolls_count
 
 
+def read_rows(csv_path, key_name):
+    """Filas del CSV con llave (None si el archivo no existe)."""
+    if not os.path.exists(csv_path):
+        print(f"❌ Error: No se encontró el archivo {csv_path}")
+        return None
+    with open(csv_path, 'r', encoding='utf-8') as csvfile:
+        return [row for row in csv.DictReader(csvfile) if row.get(key_name, '').strip()]
+
+
+def print_sync_result(label, result):
+    print(f"  ✓ {label}: {len(result['inserted'])} nuevos, {len(result['updated'])} actualizados, "
+          f"{result['unchanged']} sin cambios")
+
+
+def sync_clientes(dynamodb, stage, csv_path, segments=DEFAULT_SEGMENTS):
+    """
+    Sincroniza clientes.csv con UsersVehicles y Tags escribiendo solo las
+    filas nuevas o cambiadas. Los tags existentes conservan balance, deuda y
+    status; saldo_disponible solo se escribe en usuarios nuevos.
+    Retorna (resultado_usuarios, resultado_tags).
+    """
+    print(f"📖 Leyendo {csv_path}...")
+    rows = read_rows(csv_path, 'placa')
+    if rows is None:
+        return None, None
+
+    users = [user_item_from_row(row) for row in rows]
+    tags = [
+        {**tag_item_from_user(user), 'has_debt': False, 'version': 1}
+        for user in users if user['tiene_tag'] and user['tag_id']
+    ]
+    print(f"🔍 Comparando {len(users)} usuarios y {len(tags)} tags ({segments} segmentos de scan)...")
+    users_result = seed_sync.sync_items(dynamodb, f'UsersVehicles-{stage}', 'placa', users,
+                                        insert_only=seed_sync.USERS_INSERT_ONLY, segments=segments)
+    tags_result = seed_sync.sync_items(dynamodb, f'Tags-{stage}', 'tag_id', tags,
+                                       insert_only=seed_sync.TAGS_INSERT_ONLY, touch='last_updated',
+                                       versioned=True, segments=segments)
+    print_sync_result('Usuarios', users_result)
+    print_sync_result('Tags', tags_result)
+
+    # Invalida las cachés de clasificación de las placas que cambiaron
+    cache_versions.CACHE_VERSIONS_TABLE = f'CacheVersions-{stage}'
+    changed_tags = tags_result['inserted'] + tags_result['updated']
+    if changed_tags:
+        cache_versions.bump(dynamodb, cache_versions.TAGS_KEY)
+    tag_placas = {tag['tag_id']: tag['placa'] for tag in tags}
+    placas = set(users_result['inserted'] + users_result['updated'])
+    placas.update(tag_placas[tag_id] for tag_id in changed_tags)
+    for placa in sorted(placas):
+        classification_cache.bump(dynamodb, placa)
+    return users_result, tags_result
+
+
+def sync_peajes(dynamodb, stage, csv_path, segments=DEFAULT_SEGMENTS):
+    """Sincroniza peajes.csv con TollsCatalog escribiendo solo los peajes nuevos o cambiados."""
+    print(f"📖 Leyendo {csv_path}...")
+    rows = read_rows(csv_path, 'peaje_id')
+    if rows is None:
+        return None
+    result = seed_sync.sync_items(dynamodb, f'TollsCatalog-{stage}', 'peaje_id',
+                                  [toll_item_from_row(row) for row in rows],
+                                  insert_only=seed_sync.TOLLS_INSERT_ONLY, segments=segments)
+    print_sync_result('Peajes', result)
+
+    # Los contenedores con el catálogo en memoria lo recargan (toll_catalog)
+    if written(result):
+        cache_versions.CACHE_VERSIONS_TABLE = f'CacheVersions-{stage}'
+        cache_versions.bump(dynamodb, cache_versions.TOLLS_KEY)
+    return result
+
+
+def written(result):
+    """Items escritos (nuevos + actualizados) de un resultado de sync."""
+    if not result:
+        return 0
+    return len(result['inserted']) + len(result['updated'])
+
+
 def verify_tables(dynamodb, stage):
     """Verifica que las tablas existan."""
     tables_to_check = [
@@ -223,6 +317,9 @@ Ejemplos:
 
   # Especificar rutas personalizadas
   python scripts/load_csv_data.py --clientes mi_clientes.csv --peajes mi_peajes.csv
+
+  # Re-seed incremental: solo filas nuevas o cambiadas, sin pisar balances
+  python scripts/load_csv_data.py --stage prod --sync --segments 8
         """
     )
     
@@ -259,6 +356,19 @@ Ejemplos:
         help='No cargar datos de peajes'
     )
     
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Escribir solo filas nuevas o cambiadas y conservar balances y deudas'
+    )
+    
+    parser.add_argument(
+        '--segments',
+        type=int,
+        default=DEFAULT_SEGMENTS,
+        help=f'Segmentos del scan paralelo en modo --sync (default: {DEFAULT_SEGMENTS})'
+    )
+    
     parser.add_argument(
         '--region',
         type=str,
@@ -294,9 +404,13 @@ Ejemplos:
         print("=" * 60)
         print("📋 CARGANDO CLIENTES")
         print("=" * 60)
-        users, tags = load_clientes(dynamodb, args.stage, args.clientes)
-        total_users = users
-        total_tags = tags
+        if args.sync:
+            users_result, tags_result = sync_clientes(dynamodb, args.stage, args.clientes, args.segments)
+            total_users, total_tags = written(users_result), written(tags_result)
+        else:
+            users, tags = load_clientes(dynamodb, args.stage, args.clientes)
+            total_users = users
+            total_tags = tags
         print()
     
     # Cargar peajes
@@ -304,16 +418,20 @@ Ejemplos:
         print("=" * 60)
         print("🛣️  CARGANDO PEAJES")
         print("=" * 60)
-        total_tolls = load_peajes(dynamodb, args.stage, args.peajes)
+        if args.sync:
+            total_tolls = written(sync_peajes(dynamodb, args.stage, args.peajes, args.segments))
+        else:
+            total_tolls = load_peajes(dynamodb, args.stage, args.peajes)
         print()
     
     # Resumen final
     print("=" * 60)
     print("📊 RESUMEN")
     print("=" * 60)
-    print(f"✅ Usuarios cargados: {total_users}")
-    print(f"✅ Tags cargados: {total_tags}")
-    print(f"✅ Peajes cargados: {total_tolls}")
+    verb = 'escritos' if args.sync else 'cargados'
+    print(f"✅ Usuarios {verb}: {total_users}")
+    print(f"✅ Tags {verb}: {total_tags}")
+    print(f"✅ Peajes {verb}: {total_tolls}")
     print()
     print("🎉 ¡Carga completada exitosamente!")
 
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+Ejecuta el flujo de ProcessToll localmente (sin API Gateway ni Step Functions),
+invocando los handlers en proceso contra las tablas DynamoDB de un stage.
+
+Reproduce la máquina de estados del template:
+    ingest_webhook → ValidateTransaction → CalculateCharge
+    → [UpdateTagBalance si user_type = tag] → PersistTransaction
+
+EventBridge se sustituye por un bus local que entrega el detail directamente a
+la máquina de estados; SendNotification no se invoca (no usa DynamoDB).
+La instrumentación DynamoDB (ddb_tracer) se activa siempre, así que al final se
+reporta el costo por cruce (llamadas, RCU, WCU, latencia) agrupado por user_type.
+
+Uso:
+    python scripts/local_pipeline.py --stage dev
+    python scripts/local_pipeline.py --stage dev --events tests/webhook_test.json --limit 10
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from decimal import Decimal
+from types import SimpleNamespace
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+FUNCTIONS_DIR = os.path.join(PROJECT_ROOT, 'src', 'functions')
+LAYER_DIR = os.path.join(PROJECT_ROOT, 'src', 'layers', 'common')
+
+DEFAULT_EVENTS = os.path.join(PROJECT_ROOT, 'tests', 'webhook_test.json')
+DEFAULT_STAGE = 'dev'
+
+PIPELINE_FUNCTIONS = [
+    'ingest_webhook',
+    'validate_transaction',
+    'calculate_charge',
+    'update_tag_balance',
+    'persist_transaction'
+]
+
+
+class LocalEventBus:
+    """Sustituto local de EventBridge: conserva los eventos publicados."""
+
+    def __init__(self):
+        self.entries = []
+
+    def put_events(self, Entries):
+        self.entries.extend(Entries)
+        return {
+            'FailedEntryCount': 0,
+            'Entries': [{'EventId': str(uuid.uuid4())} for _ in Entries]
+        }
+
+
+def configure_environment(stage, trace=True):
+    """Configura las variables de entorno que el template inyecta a las Lambdas."""
+    os.environ.setdefault('USERS_TABLE', f'UsersVehicles-{stage}')
+    os.environ.setdefault('TAGS_TABLE', f'Tags-{stage}')
+    os.environ.setdefault('TRANSACTIONS_TABLE', f'Transactions-{stage}')
+    os.environ.setdefault('INVOICES_TABLE', f'Invoices-{stage}')
+    os.environ.setdefault('TOLLS_CATALOG_TABLE', f'TollsCatalog-{stage}')
+    os.environ.setdefault('EVENT_BUS_NAME', f'guatepass-bus-{stage}')
+    if trace:
+        os.environ['DDB_TRACE_ENABLED'] = 'true'
+    if LAYER_DIR not in sys.path:
+        sys.path.insert(0, LAYER_DIR)
+
+
+def load_handler(name):
+    """Importa src/functions/<name>/app.py con un nombre de módulo único."""
+    path = os.path.join(FUNCTIONS_DIR, name, 'app.py')
+    spec = importlib.util.spec_from_file_location(f'{name}_app', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_pipeline(names=None):
+    """Carga los handlers del flujo y conecta ingest_webhook al bus local."""
+    handlers = {name: load_handler(name) for name in (names or PIPELINE_FUNCTIONS)}
+    bus = LocalEventBus()
+    if 'ingest_webhook' in handlers:
+        handlers['ingest_webhook'].eventbridge = bus
+    return handlers, bus
+
+
+def to_json_state(value):
+    """Simula la serialización JSON entre estados de Step Functions."""
+    def default(obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return str(obj)
+    return json.loads(json.dumps(value, default=default))
+
+
+class Invoker:
+    """Invoca handlers acumulando el costo DynamoDB reportado por ddb_tracer."""
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.reset()
+
+    def reset(self):
+        self.cost = {'calls': 0, 'rcu': 0.0, 'wcu': 0.0, 'latency_ms': 0.0}
+        self.elapsed_ms = 0.0
+
+    def __call__(self, name, module, event):
+        import ddb_tracer
+        context = SimpleNamespace(function_name=name)
+        output = io.StringIO()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(sys.stdout if self.verbose else output):
+                return module.lambda_handler(event, context)
+        finally:
+            self.elapsed_ms += (time.perf_counter() - start) * 1000
+            summary = ddb_tracer.last_summary() or {}
+            for key in self.cost:
+                self.cost[key] += summary.get(key, 0)
+
+
+def run_state_machine(handlers, detail, invoke):
+    """Ejecuta los estados de ProcessToll para un evento ya ingerido."""
+    state = to_json_state(invoke('validate_transaction', handlers['validate_transaction'], {'detail': detail}))
+    state = to_json_state(invoke('calculate_charge', handlers['calculate_charge'], state))
+    if state.get('user_type') == 'tag':
+        state['tag_balance_update'] = to_json_state(invoke('update_tag_balance', handlers['update_tag_balance'], {
+            'tag_id': state['tag_info']['tag_id'],
+            'amount': state['charge']['total'],
+            'transaction_id': state['event_id'],
+            'timestamp': state['timestamp']
+        }))
+    return to_json_state(invoke('persist_transaction', handlers['persist_transaction'], state))
+
+
+def run_crossing(handlers, bus, payload, invoke):
+    """
+    Procesa un cruce completo: webhook + máquina de estados.
+    Retorna (resultado, user_type) o lanza la excepción del estado que falló.
+    """
+    response = invoke('ingest_webhook', handlers['ingest_webhook'], {'body': payload})
+    if response['statusCode'] != 200:
+        raise ValueError(f"ingest_webhook {response['statusCode']}: {response['body']}")
+    entry = bus.entries.pop()
+    detail = json.loads(entry['Detail'])
+    result = run_state_machine(handlers, detail, invoke)
+    return result, result.get('user_type', 'unknown')
+
+
+def print_report(report):
+    """Imprime el costo promedio por cruce agrupado por user_type."""
+    print()
+    print('=' * 78)
+    print('💰 COSTO DYNAMODB POR CRUCE (promedio)')
+    print('=' * 78)
+    print(f"{'user_type':<15}{'cruces':>8}{'llamadas':>10}{'RCU':>10}{'WCU':>10}{'ddb ms':>11}{'total ms':>11}")
+    for user_type, stats in sorted(report.items()):
+        n = stats['crossings']
+        print(f"{user_type:<15}{n:>8}"
+              f"{stats['calls'] / n:>10.1f}{stats['rcu'] / n:>10.2f}{stats['wcu'] / n:>10.2f}"
+              f"{stats['latency_ms'] / n:>11.1f}{stats['elapsed_ms'] / n:>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ejecuta el flujo ProcessToll localmente y reporta costo DynamoDB por cruce'
+    )
+    parser.add_argument('--stage', type=str, default=DEFAULT_STAGE,
+                        help=f'Stage del deployment (default: {DEFAULT_STAGE})')
+    parser.add_argument('--events', type=str, default=DEFAULT_EVENTS,
+                        help='Archivo JSON con la lista de payloads del webhook')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Procesar solo los primeros N eventos')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Mostrar los logs de cada handler')
+    parser.add_argument('--json', action='store_true',
+                        help='Imprimir el reporte como JSON')
+    args = parser.parse_args()
+
+    configure_environment(args.stage)
+    handlers, bus = load_pipeline()
+    invoke = Invoker(verbose=args.verbose)
+
+    with open(args.events, 'r', encoding='utf-8') as f:
+        payloads = json.load(f)
+    if args.limit:
+        payloads = payloads[:args.limit]
+
+    report = {}
+    failures = 0
+    for payload in payloads:
+        invoke.reset()
+        try:
+            _, user_type = run_crossing(handlers, bus, payload, invoke)
+        except Exception as e:
+            failures += 1
+            user_type = 'failed'
+            print(f"  ❌ {payload.get('placa') or payload.get('tag_id')}: {e}")
+        stats = report.setdefault(user_type, {
+            'crossings': 0, 'calls': 0, 'rcu': 0.0, 'wcu': 0.0, 'latency_ms': 0.0, 'elapsed_ms': 0.0
+        })
+        stats['crossings'] += 1
+        for key in invoke.cost:
+            stats[key] += invoke.cost[key]
+        stats['elapsed_ms'] += invoke.elapsed_ms
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    print(f"\nCruces procesados: {len(payloads)} (fallidos: {failures})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Migra las transacciones con event_id UUID al formato ordenable por tiempo
+(<ULID>-<placa>, ver src/layers/common/event_ids.py).
+
+Cada fila se reescribe con ts = event_id nuevo en una transacción que inserta
+el item nuevo y borra el anterior; el UUID original queda en legacy_event_id y
+el invoice asociado (INV-<uuid[:8]>-<placa>) se actualiza con el event_id nuevo.
+El ID nuevo se deriva del UUID original, así que el script es idempotente y
+puede re-ejecutarse si se interrumpe.
+
+El scan se divide en segmentos paralelos (Segment/TotalSegments), uno por hilo.
+
+Orden de despliegue recomendado (CloudFormation solo crea o elimina un GSI
+por actualización; cada paso es un deploy con el parámetro TransactionIndexes):
+    1. TransactionIndexes=migration: código nuevo, by_event y
+       placa-timestamp-index se mantienen y se crea by_legacy_event
+    2. Ejecutar este script
+    3. TransactionIndexes=without-timestamp-index: quita placa-timestamp-index
+    4. TransactionIndexes=legacy-only: quita by_event. Queda by_legacy_event
+       (disperso, solo filas migradas) para completar transacciones por su UUID
+
+Uso:
+    python scripts/migrate_transaction_keys.py --stage dev --dry-run
+    python scripts/migrate_transaction_keys.py --stage dev --segments 16
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.exceptions import ClientError
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+LAYER_DIR = os.path.join(PROJECT_ROOT, 'src', 'layers', 'common')
+if LAYER_DIR not in sys.path:
+    sys.path.insert(0, LAYER_DIR)
+
+import event_ids  # noqa: E402
+
+DEFAULT_STAGE = 'dev'
+DEFAULT_SEGMENTS = 8
+
+
+def legacy_invoice_id(event_id, placa):
+    """invoice_id generado por persist_transaction antes de la migración."""
+    return f"INV-{event_id[:8]}-{placa}"
+
+
+def migrate_item(dynamodb, transactions_table_name, invoices_table_name, item, dry_run=False):
+    """
+    Migra una transacción. Retorna 'migrated', 'skipped' (ya migrada) o
+    'conflict' (la fila cambió durante la migración).
+    """
+    if event_ids.is_event_id(item['ts']):
+        return 'skipped'
+
+    placa = item['placa']
+    legacy_id = item.get('event_id') or item['ts']
+    crossing_time = item.get('timestamp') or item.get('created_at')
+    new_id = event_ids.new_event_id(placa, crossing_time, seed=legacy_id)
+    if dry_run:
+        return 'migrated'
+
+    new_item = {**item, 'ts': new_id, 'event_id': new_id, 'legacy_event_id': legacy_id}
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=[
+            {
+                'Put': {
+                    'TableName': transactions_table_name,
+                    'Item': new_item,
+                    'ConditionExpression': 'attribute_not_exists(ts)'
+                }
+            },
+            {
+                'Delete': {
+                    'TableName': transactions_table_name,
+                    'Key': {'placa': placa, 'ts': item['ts']},
+                    'ConditionExpression': 'attribute_exists(ts)'
+                }
+            }
+        ])
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'TransactionCanceledException':
+            return 'conflict'
+        raise
+
+    try:
+        dynamodb.Table(invoices_table_name).update_item(
+            Key={'placa': placa, 'invoice_id': legacy_invoice_id(legacy_id, placa)},
+            UpdateExpression='SET event_id = :new_id, legacy_event_id = :legacy_id',
+            ConditionExpression='attribute_exists(invoice_id) AND event_id = :legacy_id',
+            ExpressionAttributeValues={':new_id': new_id, ':legacy_id': legacy_id}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    return 'migrated'
+
+
+def migrate_segment(stage, segment, total_segments, region=None, dry_run=False):
+    """
+    Recorre un segmento del scan de Transactions y migra sus filas. Cada hilo
+    usa su propia sesión (los recursos de boto3 no son thread-safe).
+    """
+    dynamodb = boto3.session.Session(region_name=region).resource('dynamodb')
+    transactions_table_name = f'Transactions-{stage}'
+    invoices_table_name = f'Invoices-{stage}'
+    table = dynamodb.Table(transactions_table_name)
+    counts = {'migrated': 0, 'skipped': 0, 'conflict': 0, 'failed': 0}
+    kwargs = {'Segment': segment, 'TotalSegments': total_segments}
+
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            try:
+                outcome = migrate_item(dynamodb, transactions_table_name, invoices_table_name, item, dry_run)
+            except ClientError as e:
+                outcome = 'failed'
+                print(f"  ❌ {item.get('placa')}/{item.get('ts')}: {e}")
+            counts[outcome] += 1
+        if 'LastEvaluatedKey' not in response:
+            return counts
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Migra Transactions a event_id/ts ordenables por tiempo'
+    )
+    parser.add_argument('--stage', type=str, default=DEFAULT_STAGE,
+                        help=f'Stage del deployment (default: {DEFAULT_STAGE})')
+    parser.add_argument('--segments', type=int, default=DEFAULT_SEGMENTS,
+                        help=f'Segmentos de scan paralelos (default: {DEFAULT_SEGMENTS})')
+    parser.add_argument('--region', type=str, default=None,
+                        help='Región AWS (default: la configurada en el entorno)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Solo contar las filas a migrar, sin escribir')
+    args = parser.parse_args()
+
+    print(f"🔄 Migrando Transactions-{args.stage} con {args.segments} segmentos"
+          f"{' (dry-run)' if args.dry_run else ''}...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.segments) as executor:
+        futures = [
+            executor.submit(migrate_segment, args.stage, segment, args.segments, args.region, args.dry_run)
+            for segment in range(args.segments)
+        ]
+        results = [future.result() for future in futures]
+
+    totals = {key: sum(result[key] for result in results) for key in results[0]}
+    elapsed = time.perf_counter() - start
+    print(f"✅ Migradas: {totals['migrated']}  Ya migradas: {totals['skipped']}  "
+          f"Conflictos: {totals['conflict']}  Fallidas: {totals['failed']}  ({elapsed:.1f}s)")
+    if totals['conflict'] or totals['failed']:
+        print("⚠️  Re-ejecuta el script para reintentar las filas con conflicto o fallidas")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Re-procesa en paralelo los cruces fallidos guardados en FailedCrossings
+(paso CaptureFailure de ProcessToll, ver src/layers/common/failed_crossings.py).
+
+Cada cruce se vuelve a ejecutar en la máquina de estados con su detail
+original:
+    - Concurrencia acotada (--concurrency hilos) y límite de inicios por
+      segundo (--rate) para no repetir la saturación que causó los fallos.
+    - Idempotente por event_id: los cruces cuya transacción ya está en
+      Transactions se marcan resolved sin re-ejecutarse. Cada cruce se
+      reclama con una escritura condicional antes de iniciar la ejecución,
+      cuyo nombre es redrive-<event_id>-<intento> (Step Functions rechaza un
+      nombre repetido).
+    - Los errores no re-procesables (invalid_input) se omiten salvo con
+      --include-permanent. Los cruces con el tag ya descontado (needs_review)
+      solo se re-procesan con --include-charged: en modo in-place el débito
+      no es idempotente; en modo ledger sí (append por event_id). Por eso
+      --include-charged exige que update_tag_balance desplegado tenga
+      TAG_LEDGER_ENABLED=true y solo toma los cruces cuyo débito original fue
+      un append al ledger (tag_balance_update.debit_mode = ledger).
+
+Con --wait espera el resultado de cada ejecución y marca resolved las que
+terminan bien; las que fallan de nuevo vuelven a pending por CaptureFailure.
+
+Uso:
+    python scripts/redrive_failed_crossings.py --stage dev --dry-run
+    python scripts/redrive_failed_crossings.py --stage dev --concurrency 16 --rate 20 --wait
+    python scripts/redrive_failed_crossings.py --stage prod --classes throttling unavailable --report redrive.json
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(SCRIPT_DIR)
+LAYER_DIR = os.path.join(PROJECT_ROOT, 'src', 'layers', 'common')
+if LAYER_DIR not in sys.path:
+    sys.path.insert(0, LAYER_DIR)
+
+import failed_crossings  # noqa: E402
+
+DEFAULT_STAGE = 'dev'
+DEFAULT_PROJECT = 'guatepass'
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 10.0
+BATCH_GET_SIZE = 100
+POLL_SECONDS = 2.0
+TERMINAL_STATUSES = ('SUCCEEDED', 'FAILED', 'TIMED_OUT', 'ABORTED')
+
+
+class RateLimiter:
+    """Token bucket compartido por los hilos: a lo sumo `rate` inicios por segundo."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_for = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait_for > 0:
+            time.sleep(wait_for)
+
+
+class Progress:
+    """Conteo por resultado con una línea de progreso cada `every` cruces."""
+
+    def __init__(self, total, every=50):
+        self.total = total
+        self.every = every
+        self.counts = {}
+        self.done = 0
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+            self.done += 1
+            if self.done % self.every == 0 or self.done == self.total:
+                elapsed = time.perf_counter() - self.start
+                print(f"  … {self.done}/{self.total} ({self.done / elapsed:.1f}/s) {self.counts}")
+
+
+class Redriver:
+    def __init__(self, stage, state_machine_arn, region=None, rate=DEFAULT_RATE, dry_run=False):
+        self.stage = stage
+        self.state_machine_arn = state_machine_arn
+        self.region = region
+        self.limiter = RateLimiter(rate)
+        self.dry_run = dry_run
+        self.local = threading.local()
+        session = boto3.session.Session(region_name=region)
+        # Los clientes son thread-safe; los recursos DynamoDB se crean por hilo
+        self.sfn = session.client('stepfunctions')
+        self.transactions_table = f'Transactions-{stage}'
+
+    def dynamodb(self):
+        if not hasattr(self.local, 'dynamodb'):
+            self.local.dynamodb = boto3.session.Session(region_name=self.region).resource('dynamodb')
+        return self.local.dynamodb
+
+    def candidates(self, statuses, limit=None):
+        """Cruces en los estados pedidos (query al índice status-index, los más antiguos primero)."""
+        table = self.dynamodb().Table(failed_crossings.FAILED_CROSSINGS_TABLE)
+        items = []
+        for status in statuses:
+            kwargs = {
+                'IndexName': failed_crossings.STATUS_INDEX,
+                'KeyConditionExpression': Key('status').eq(status)
+            }
+            while True:
+                response = table.query(**kwargs)
+                items.extend(response.get('Items', []))
+                if limit and len(items) >= limit:
+                    return items[:limit]
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        return items
+
+    def persisted(self, items):
+        """event_ids con transacción en Transactions (batch_get_item por placa + ts)."""
+        keys = [{'placa': item['placa'], 'ts': item['event_id']} for item in items if item.get('placa')]
+        found = set()
+        dynamodb = self.dynamodb()
+        for start in range(0, len(keys), BATCH_GET_SIZE):
+            request = {self.transactions_table: {'Keys': keys[start:start + BATCH_GET_SIZE], 'ProjectionExpression': 'ts'}}
+            while request:
+                response = dynamodb.batch_get_item(RequestItems=request)
+                found.update(item['ts'] for item in response.get('Responses', {}).get(self.transactions_table, []))
+                request = response.get('UnprocessedKeys') or None
+        return found
+
+    def execution_name(self, event_id, attempt):
+        """Nombre de ejecución determinista (máx. 80 caracteres, [A-Za-z0-9-_])."""
+        return re.sub(r'[^A-Za-z0-9_-]', '_', f'redrive-{event_id}')[:72] + f'-{attempt}'
+
+    def redrive(self, item):
+        """Re-ejecuta un cruce. Retorna (resultado, execution_arn)."""
+        event_id = item['event_id']
+        if self.dry_run:
+            return 'would_redrive', None
+        attempt = int(item.get('redrive_count', 0)) + 1
+        dynamodb = self.dynamodb()
+        if not failed_crossings.transition(dynamodb, event_id, item['status'], failed_crossings.REDRIVING,
+                                           redrive_count=attempt):
+            return 'claimed_elsewhere', None
+
+        self.limiter.wait()
+        name = self.execution_name(event_id, attempt)
+        try:
+            response = self.sfn.start_execution(
+                stateMachineArn=self.state_machine_arn,
+                name=name,
+                input=json.dumps({'detail': item['crossing']}, default=str)
+            )
+            execution_arn = response['executionArn']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ExecutionAlreadyExists':
+                failed_crossings.transition(dynamodb, event_id, failed_crossings.REDRIVING, item['status'])
+                print(f"  ❌ {event_id}: {e}")
+                return 'error', None
+            execution_arn = self.state_machine_arn.replace(':stateMachine:', ':execution:') + f':{name}'
+
+        failed_crossings.transition(dynamodb, event_id, failed_crossings.REDRIVING, failed_crossings.REDRIVEN,
+                                    redrive_execution_arn=execution_arn)
+        return 'started', execution_arn
+
+    def wait_for(self, event_id, execution_arn):
+        """Espera el fin de la ejecución; marca resolved si terminó bien."""
+        while True:
+            status = self.sfn.describe_execution(executionArn=execution_arn)['status']
+            if status in TERMINAL_STATUSES:
+                break
+            time.sleep(POLL_SECONDS)
+        if status == 'SUCCEEDED':
+            failed_crossings.transition(self.dynamodb(), event_id, failed_crossings.REDRIVEN, failed_crossings.RESOLVED)
+            return 'succeeded'
+        return 'failed_again'
+
+
+def resolve_state_machine_arn(stage, project, region=None):
+    name = f'{project}-process-toll-{stage}'
+    client = boto3.session.Session(region_name=region).client('stepfunctions')
+    for page in client.get_paginator('list_state_machines').paginate():
+        for machine in page['stateMachines']:
+            if machine['name'] == name:
+                return machine['stateMachineArn']
+    raise ValueError(f'No se encontró la máquina de estados {name}')
+
+
+def deployed_ledger_enabled(stage, project, region=None):
+    """TAG_LEDGER_ENABLED de la función update_tag_balance desplegada en el stack."""
+    name = f'{project}-update-tag-balance-{stage}'
+    client = boto3.session.Session(region_name=region).client('lambda')
+    variables = client.get_function_configuration(FunctionName=name).get('Environment', {}).get('Variables', {})
+    return variables.get('TAG_LEDGER_ENABLED', 'false').lower() == 'true'
+
+
+def charged_in_ledger(item):
+    """True si el débito ya hecho al tag fue un append al ledger (idempotente por event_id)."""
+    return (item.get('tag_balance_update') or {}).get('debit_mode') == 'ledger'
+
+
+def select(items, classes=None, include_permanent=False):
+    """Separa los cruces a re-procesar de los omitidos por clase de error."""
+    selected, skipped = [], []
+    for item in items:
+        if classes and item.get('error_class') not in classes:
+            skipped.append((item, 'skipped_class'))
+        elif not item.get('retryable', True) and not include_permanent:
+            skipped.append((item, 'skipped_permanent'))
+        elif item.get('status') == failed_crossings.NEEDS_REVIEW and not charged_in_ledger(item):
+            # Re-ejecutarlo descontaría el tag otra vez
+            skipped.append((item, 'skipped_charged'))
+        else:
+            selected.append(item)
+    return selected, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Re-procesa en paralelo los cruces fallidos de ProcessToll'
+    )
+    parser.add_argument('--stage', type=str, default=DEFAULT_STAGE,
+                        help=f'Stage del deployment (default: {DEFAULT_STAGE})')
+    parser.add_argument('--project', type=str, default=DEFAULT_PROJECT,
+                        help=f'ProjectName del template (default: {DEFAULT_PROJECT})')
+    parser.add_argument('--state-machine-arn', type=str, default=None,
+                        help='ARN de ProcessToll (default: se busca por nombre)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help=f'Cruces en paralelo (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        help=f'Inicios de ejecución por segundo (default: {DEFAULT_RATE})')
+    parser.add_argument('--limit', type=int, default=None,
+                        help='Máximo de cruces a re-procesar')
+    parser.add_argument('--classes', nargs='*', default=None,
+                        help='Solo estas clases de error (throttling, unavailable, conflict, invalid_input, unknown)')
+    parser.add_argument('--include-permanent', action='store_true',
+                        help='Re-procesar también errores no re-procesables (invalid_input)')
+    parser.add_argument('--include-charged', action='store_true',
+                        help='Re-procesar cruces con el tag ya descontado en el ledger (requiere TagLedgerEnabled en el stack)')
+    parser.add_argument('--wait', action='store_true',
+                        help='Esperar el resultado de cada ejecución')
+    parser.add_argument('--report', type=str, default=None,
+                        help='Archivo JSON con el resultado por cruce')
+    parser.add_argument('--region', type=str, default=None,
+                        help='Región AWS (default: la configurada en el entorno)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Solo listar lo que se re-procesaría')
+    args = parser.parse_args()
+
+    if args.include_charged and not deployed_ledger_enabled(args.stage, args.project, args.region):
+        parser.error('--include-charged requiere TAG_LEDGER_ENABLED=true en update_tag_balance '
+                     f'({args.project}-update-tag-balance-{args.stage}): en modo in-place el débito no es idempotente')
+
+    failed_crossings.FAILED_CROSSINGS_TABLE = f'FailedCrossings-{args.stage}'
+    state_machine_arn = args.state_machine_arn or resolve_state_machine_arn(args.stage, args.project, args.region)
+    redriver = Redriver(args.stage, state_machine_arn, args.region, args.rate, args.dry_run)
+
+    statuses = [failed_crossings.PENDING, failed_crossings.REDRIVEN]
+    if args.include_charged:
+        statuses.append(failed_crossings.NEEDS_REVIEW)
+    items = redriver.candidates(statuses, args.limit)
+    print(f"🔍 {len(items)} cruces en {', '.join(statuses)} (FailedCrossings-{args.stage})")
+
+    # Idempotencia: lo que ya está en Transactions no se re-ejecuta
+    persisted = redriver.persisted(items)
+    results = []
+    for item in items:
+        if item['event_id'] in persisted:
+            if not args.dry_run:
+                failed_crossings.transition(redriver.dynamodb(), item['event_id'], item['status'], failed_crossings.RESOLVED)
+            results.append({'event_id': item['event_id'], 'outcome': 'already_processed'})
+    pending = [item for item in items if item['event_id'] not in persisted and item['status'] != failed_crossings.REDRIVEN]
+    selected, skipped = select(pending, args.classes, args.include_permanent)
+    results.extend({'event_id': item['event_id'], 'outcome': outcome} for item, outcome in skipped)
+
+    print(f"🚀 Re-procesando {len(selected)} cruces (concurrencia {args.concurrency}, {args.rate}/s)"
+          f"{' (dry-run)' if args.dry_run else ''}...")
+    progress = Progress(len(selected))
+
+    def run(item):
+        outcome, execution_arn = redriver.redrive(item)
+        if args.wait and outcome == 'started':
+            outcome = redriver.wait_for(item['event_id'], execution_arn)
+        progress.add(outcome)
+        return {
+            'event_id': item['event_id'],
+            'placa': item.get('placa'),
+            'error_class': item.get('error_class'),
+            'failed_state': item.get('failed_state'),
+            'outcome': outcome,
+            'execution_arn': execution_arn
+        }
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run, item) for item in selected]
+        for future in as_completed(futures):
+            results.append(future.result())
+    elapsed = time.perf_counter() - start
+
+    totals, by_class = {}, {}
+    for result in results:
+        totals[result['outcome']] = totals.get(result['outcome'], 0) + 1
+        if result.get('error_class'):
+            counts = by_class.setdefault(result['error_class'], {})
+            counts[result['outcome']] = counts.get(result['outcome'], 0) + 1
+    print(f"✅ Resultado ({elapsed:.1f}s): {totals}")
+    for error_class, counts in sorted(by_class.items()):
+        print(f"   {error_class}: {counts}")
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump({'stage': args.stage, 'elapsed_seconds': round(elapsed, 2), 'totals': totals,
+                       'by_class': by_class, 'results': results}, f, indent=2, default=str)
+        print(f"📄 Reporte: {args.report}")
+    if totals.get('error') or totals.get('failed_again'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
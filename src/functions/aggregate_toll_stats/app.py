@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+import ddb_tracer
+import toll_aggregates
+
+dynamodb = ddb_tracer.resource()
+deserializer = TypeDeserializer()
+
+TOLL_AGGREGATES_TABLE = os.environ.get('TOLL_AGGREGATES_TABLE')
+
+
+def to_decimal(value):
+    """Convierte a Decimal."""
+    if value is None:
+        return Decimal('0')
+    return Decimal(str(value))
+
+
+def image(record, name):
+    raw = record.get('dynamodb', {}).get(name)
+    if not raw:
+        return None
+    return {key: deserializer.deserialize(value) for key, value in raw.items()}
+
+
+def accumulate(batch, record):
+    """
+    Suma un registro del stream al acumulador en memoria del batch.
+    - INSERT: un cruce nuevo (conteo, montos y desglose por user_type)
+    - MODIFY: mora agregada al completar un pago pendiente
+    Las filas reescritas por scripts/migrate_transaction_keys.py se ignoran.
+    """
+    new = image(record, 'NewImage')
+    if not new or new.get('legacy_event_id') or not new.get('peaje_id'):
+        return
+    
+    if record['eventName'] == 'INSERT':
+        deltas = {
+            'crossings': Decimal('1'),
+            'amount': to_decimal(new.get('amount')),
+            'subtotal': to_decimal(new.get('subtotal')),
+            'tax': to_decimal(new.get('tax'))
+        }
+        user_type = new.get('user_type')
+        if user_type in toll_aggregates.USER_TYPES:
+            deltas[f'crossings_{user_type}'] = Decimal('1')
+            deltas[f'amount_{user_type}'] = deltas['amount']
+    else:
+        old = image(record, 'OldImage') or {}
+        late_fee = to_decimal(new.get('late_fee')) - to_decimal(old.get('late_fee'))
+        if late_fee <= 0:
+            return
+        deltas = {'late_fee': late_fee}
+    
+    hour = toll_aggregates.hour_of(new.get('timestamp') or new.get('created_at'))
+    key = toll_aggregates.aggregate_id(new['peaje_id'], hour)
+    entry = batch.setdefault(key, {'peaje_id': new['peaje_id'], 'hour': hour, 'deltas': {}, 'event_ids': []})
+    for name, value in deltas.items():
+        entry['deltas'][name] = entry['deltas'].get(name, Decimal('0')) + value
+    entry['event_ids'].append(record.get('eventID', ''))
+
+
+def flush(key, entry, updated_at):
+    """
+    Aplica los incrementos acumulados de una llave en un solo update_item.
+    El batch_id (hash de los eventID que aportaron) hace idempotente el
+    reintento del mismo batch. Retorna False si ya estaba aplicado.
+    """
+    batch_id = hashlib.sha256('|'.join(sorted(entry['event_ids'])).encode('utf-8')).hexdigest()[:16]
+    names = {'#hour': 'hour'}
+    values = {
+        ':peaje_id': entry['peaje_id'],
+        ':hour': entry['hour'],
+        ':updated_at': updated_at,
+        ':batch_set': {batch_id},
+        ':batch_id': batch_id
+    }
+    additions = []
+    for index, (name, value) in enumerate(sorted(entry['deltas'].items())):
+        names[f'#c{index}'] = name
+        values[f':c{index}'] = value
+        additions.append(f'#c{index} :c{index}')
+    try:
+        dynamodb.Table(TOLL_AGGREGATES_TABLE).update_item(
+            Key={'aggregate_id': key},
+            UpdateExpression='SET peaje_id = :peaje_id, #hour = :hour, updated_at = :updated_at '
+                             'ADD applied_batches :batch_set, ' + ', '.join(additions),
+            ConditionExpression='NOT contains(applied_batches, :batch_id)',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Mantiene los contadores por peaje y hora desde el stream de Transactions.
+    Los registros del batch se acumulan en memoria y cada llave peaje#hora se
+    escribe una sola vez (ADD atómico), sin importar cuántos cruces traiga.
+    
+    Trigger: DynamoDB Streams de Transactions (INSERT y MODIFY).
+    Si una escritura falla se lanza la excepción y Lambda reintenta el batch
+    completo; las llaves ya aplicadas se omiten por su batch_id.
+    """
+    batch = {}
+    for record in event.get('Records', []):
+        if record.get('eventName') in ('INSERT', 'MODIFY'):
+            accumulate(batch, record)
+    
+    updated_at = datetime.utcnow().isoformat() + 'Z'
+    applied = 0
+    skipped = 0
+    for key, entry in batch.items():
+        if flush(key, entry, updated_at):
+            applied += 1
+        else:
+            skipped += 1
+    
+    print(json.dumps({
+        'records': len(event.get('Records', [])),
+        'aggregates': len(batch),
+        'applied': applied,
+        'already_applied': skipped,
+        'status': 'aggregated'
+    }))
+    
+    return {'aggregates': len(batch), 'applied': applied}
@@ -0,0 +1,119 @@
+import json
+import os
+import boto3
+from botocore.exceptions import ClientError
+import ddb_tracer
+import plate_matcher
+
+dynamodb = ddb_tracer.resource()
+s3 = boto3.client('s3')
+
+USERS_TABLE = os.environ.get('USERS_TABLE')
+INDEXES_BUCKET = os.environ.get('INDEXES_BUCKET')
+BATCH_GET_SIZE = 100
+
+
+def added_placas(records):
+    """Placas nuevas del batch (INSERT del stream KEYS_ONLY de UsersVehicles)."""
+    return {
+        record['dynamodb']['Keys']['placa']['S']
+        for record in records
+        if record.get('eventName') == 'INSERT' and 'placa' in record.get('dynamodb', {}).get('Keys', {})
+    }
+
+
+def scan_registered():
+    """
+    Placas de UsersVehicles que pueden reclamar un cruce (registradas o con
+    tag). Las de tipo no_registrado no se indexan.
+    """
+    table = dynamodb.Table(USERS_TABLE)
+    kwargs = {
+        'ProjectionExpression': 'placa, tipo_usuario',
+        'FilterExpression': 'attribute_not_exists(tipo_usuario) OR tipo_usuario <> :no_registrado',
+        'ExpressionAttributeValues': {':no_registrado': 'no_registrado'}
+    }
+    while True:
+        response = table.scan(**kwargs)
+        for item in response.get('Items', []):
+            yield item['placa']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def registered(placas):
+    """Placas del stream (KEYS_ONLY) que existen y no son no_registrado."""
+    placas = sorted(placas)
+    found = []
+    for start in range(0, len(placas), BATCH_GET_SIZE):
+        request = {USERS_TABLE: {
+            'Keys': [{'placa': placa} for placa in placas[start:start + BATCH_GET_SIZE]],
+            'ProjectionExpression': 'placa, tipo_usuario'
+        }}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            found.extend(
+                item['placa'] for item in response['Responses'].get(USERS_TABLE, [])
+                if item.get('tipo_usuario') != 'no_registrado'
+            )
+            request = response.get('UnprocessedKeys') or None
+    return found
+
+
+def publish_plate_index(index):
+    s3.put_object(
+        Bucket=INDEXES_BUCKET,
+        Key=plate_matcher.PLATE_INDEX_KEY,
+        Body=index.to_bytes(),
+        ContentType='application/json',
+        Metadata={'keys': str(len(index))}
+    )
+
+
+def rebuild_plate_index():
+    index = plate_matcher.PlateIndex()
+    for placa in scan_registered():
+        index.add(placa)
+    publish_plate_index(index)
+    return {'keys': len(index), 'mode': 'rebuild'}
+
+
+def add_plates(placas):
+    """Agrega al índice publicado las placas nuevas del stream (sin scan)."""
+    try:
+        body = s3.get_object(Bucket=INDEXES_BUCKET, Key=plate_matcher.PLATE_INDEX_KEY)['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return rebuild_plate_index()
+        raise
+    index = plate_matcher.PlateIndex.from_bytes(body)
+    added = registered(placas)
+    for placa in added:
+        index.add(placa)
+    publish_plate_index(index)
+    return {'keys': len(index), 'added': len(added), 'mode': 'incremental'}
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Construye y publica en S3 el índice de placas registradas que usa la
+    coincidencia tolerante a OCR (plate_matcher).
+    
+    Triggers:
+    - EventBridge Schedule: reconstrucción completa (descarta placas borradas)
+    - DynamoDB Streams de UsersVehicles (INSERT): agrega las placas nuevas
+      al índice publicado
+    - Invocación directa: {} (reconstrucción completa)
+    
+    Corre con concurrencia reservada de 1 para que las publicaciones no se pisen.
+    """
+    if 'Records' in event:
+        placas = added_placas(event['Records'])
+        result = add_plates(placas) if placas else {'added': 0, 'mode': 'incremental'}
+    else:
+        result = rebuild_plate_index()
+    
+    print(json.dumps({**result, 'status': 'published'}))
+    return result
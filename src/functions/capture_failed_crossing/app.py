@@ -0,0 +1,46 @@
+import json
+import ddb_tracer
+import failed_crossings
+
+dynamodb = ddb_tracer.resource()
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Guarda el cruce fallido en FailedCrossings (paso CaptureFailure, después
+    de HandleError). El input es la salida de HandleError:
+    {
+        "error": {"Error": "...", "Cause": "..."},
+        "input": { ...estado de la ejecución al fallar... },
+        "execution_input": {"detail": { ...cruce original... }},
+        "error_timestamp": "...",
+        "execution_arn": "..."
+    }
+    Retorna el mismo input más la clasificación; la ejecución termina en FailState.
+    """
+    item = failed_crossings.record_failure(dynamodb, event)
+
+    print(json.dumps({
+        'event_id': item['event_id'],
+        'placa': item.get('placa'),
+        'peaje_id': item.get('peaje_id'),
+        'failed_state': item['failed_state'],
+        'error': item.get('error'),
+        'error_class': item['error_class'],
+        'retryable': item['retryable'],
+        'tag_charged': item['tag_charged'],
+        'failure_count': int(item['failure_count']),
+        'status': 'failure_captured'
+    }))
+
+    return {
+        **event,
+        'capture': {
+            'event_id': item['event_id'],
+            'error_class': item['error_class'],
+            'retryable': item['retryable'],
+            'failed_state': item['failed_state'],
+            'status': item['status']
+        }
+    }
@@ -0,0 +1,54 @@
+import json
+import os
+from datetime import datetime
+import ddb_tracer
+import period_invoices
+
+dynamodb = ddb_tracer.resource()
+
+INVOICES_TABLE = os.environ.get('INVOICES_TABLE')
+
+# Periodos terminados que se revisan en cada ejecución (recupera ejecuciones perdidas)
+LOOKBACK_PERIODS = {'daily': 7, 'monthly': 2}
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Cierra los invoices de periodo (INVOICE_PERIOD = daily | monthly) cuyo
+    periodo ya terminó. Solo lee el índice disperso de invoices abiertos, así
+    que el costo es proporcional a las placas con cruces en el periodo.
+    
+    Triggers:
+    - EventBridge Schedule (diario, 00:15 UTC)
+    - Invocación directa: {"periods": ["2025-11-12"]}
+    """
+    if not period_invoices.is_enabled():
+        print(json.dumps({'status': 'skipped', 'invoice_period': period_invoices.INVOICE_PERIOD}))
+        return {'closed': 0, 'periods': []}
+    
+    now = datetime.utcnow()
+    periods = event.get('periods') or period_invoices.previous_periods(
+        LOOKBACK_PERIODS[period_invoices.INVOICE_PERIOD], now=now
+    )
+    # Nunca cerrar el periodo en curso
+    current = period_invoices.period_key(now)
+    periods = [key for key in periods if key < current]
+    
+    closed = 0
+    amount = 0.0
+    for key in periods:
+        for invoice_key in period_invoices.open_invoices(dynamodb, INVOICES_TABLE, key):
+            invoice = period_invoices.close(dynamodb, INVOICES_TABLE, invoice_key, now=now)
+            if invoice:
+                closed += 1
+                amount += float(invoice.get('amount', 0))
+    
+    print(json.dumps({
+        'periods': periods,
+        'closed': closed,
+        'amount': round(amount, 2),
+        'status': 'closed'
+    }))
+    
+    return {'closed': closed, 'periods': periods}
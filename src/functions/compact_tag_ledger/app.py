@@ -0,0 +1,79 @@
+import json
+import os
+import ddb_tracer
+import tag_ledger
+
+dynamodb = ddb_tracer.resource()
+
+TAGS_TABLE = os.environ.get('TAGS_TABLE')
+
+
+def tag_ids_from_stream(records):
+    """Agrupa los registros del stream de TagLedger por tag_id."""
+    grouped = {}
+    for record in records:
+        keys = record.get('dynamodb', {}).get('Keys', {})
+        tag_id = keys.get('tag_id', {}).get('S')
+        entry_id = keys.get('entry_id', {}).get('S', '')
+        if not tag_id or not entry_id.startswith(tag_ledger.ENTRY_PREFIX):
+            continue
+        grouped.setdefault(tag_id, []).append(record['dynamodb'].get('SequenceNumber'))
+    return grouped
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Compacta el ledger de balances: pliega en el snapshot de Tags las entradas
+    acumuladas y avanza el watermark (una escritura a Tags por tag y batch).
+    
+    Triggers:
+    - DynamoDB Streams de TagLedger: cada tag_id del batch se compacta una sola vez.
+      Reporta batchItemFailures para reintentar solo los tags que fallaron.
+    - Invocación directa: {"tag_ids": ["TAG-001"], "reconcile": true}
+      Con reconcile=true además reconstruye el balance desde todas las entradas.
+    """
+    if 'Records' in event:
+        grouped = tag_ids_from_stream(event['Records'])
+        failures = []
+        failed_tags = []
+        folded = 0
+        for tag_id, sequence_numbers in grouped.items():
+            try:
+                folded += tag_ledger.compact(dynamodb, TAGS_TABLE, tag_id)
+            except Exception as e:
+                print(json.dumps({
+                    'error': 'Compaction failed',
+                    'tag_id': tag_id,
+                    'message': str(e)
+                }))
+                failed_tags.append(tag_id)
+                failures.extend({'itemIdentifier': seq} for seq in sequence_numbers if seq)
+        
+        print(json.dumps({
+            'tags': len(grouped),
+            'entries_folded': folded,
+            'failed_tags': failed_tags,
+            'status': 'compacted'
+        }))
+        return {'batchItemFailures': failures}
+    
+    tag_ids = event.get('tag_ids') or []
+    if not tag_ids:
+        raise ValueError('Missing required field: tag_ids')
+    
+    results = []
+    for tag_id in tag_ids:
+        result = {'tag_id': tag_id, 'entries_folded': tag_ledger.compact(dynamodb, TAGS_TABLE, tag_id)}
+        if event.get('reconcile'):
+            result['reconciliation'] = tag_ledger.reconcile(dynamodb, TAGS_TABLE, tag_id)
+        results.append(result)
+    
+    print(json.dumps({
+        'tags': len(results),
+        'entries_folded': sum(r['entries_folded'] for r in results),
+        'inconsistent': [r['tag_id'] for r in results if r.get('reconciliation', {}).get('consistent') is False],
+        'status': 'compacted'
+    }))
+    
+    return {'results': results}
@@ -3,16 +3,25 @@ import os
 from datetime import datetime
 from decimal import Decimal
 import boto3
+import ddb_tracer
+import event_ids
+import http_encoding
+import period_invoices
+import tag_ledger
+import tag_versions
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
 from dateutil import parser
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = ddb_tracer.resource()
 sns = boto3.client('sns')
 
 TRANSACTIONS_TABLE = os.environ.get('TRANSACTIONS_TABLE')
 INVOICES_TABLE = os.environ.get('INVOICES_TABLE')
 SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
 TAGS_TABLE = os.environ.get('TAGS_TABLE')
+# GSIs de Transactions desplegados (parámetro TransactionIndexes del template)
+TRANSACTION_INDEXES = os.environ.get('TRANSACTION_INDEXES', 'legacy-only')
 
 # Configuración de mora
 LATE_FEE_PER_MINUTE = Decimal('1.00')  # 1 GTQ por cada minuto de atraso
@@ -54,6 +63,40 @@ def calculate_late_fee_by_minutes(minutes_elapsed):
     return LATE_FEE_PER_MINUTE * Decimal(str(minutes_elapsed))
 
 
+def find_transaction(transactions_table, event_id):
+    """
+    Transacción por event_id. El ID ordenable incluye la placa (HASH key) y
+    es la RANGE key: lectura directa sin índice. Un event_id UUID anterior a
+    scripts/migrate_transaction_keys.py se busca en by_legacy_event (filas
+    migradas) y, mientras by_event siga desplegado, en by_event (sin migrar).
+    """
+    parsed_id = event_ids.parse(event_id)
+    if parsed_id:
+        return transactions_table.get_item(
+            Key={'placa': parsed_id['placa'], 'ts': event_id}
+        ).get('Item')
+
+    keys = transactions_table.query(
+        IndexName='by_legacy_event',
+        KeyConditionExpression=Key('legacy_event_id').eq(event_id),
+        Limit=1
+    ).get('Items', [])
+    if keys:
+        return transactions_table.get_item(
+            Key={'placa': keys[0]['placa'], 'ts': keys[0]['ts']}
+        ).get('Item')
+
+    if TRANSACTION_INDEXES != 'legacy-only':
+        items = transactions_table.query(
+            IndexName='by_event',
+            KeyConditionExpression=Key('event_id').eq(event_id),
+            Limit=1
+        ).get('Items', [])
+        if items:
+            return items[0]
+    return None
+
+
 def build_response(status_code, payload):
     return {
         'statusCode': status_code,
@@ -65,6 +108,7 @@ def build_response(status_code, payload):
     }
 
 
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Completa una transacción pendiente de usuario no registrado.
@@ -72,7 +116,7 @@ def lambda_handler(event, context):
     
     Input (body):
     {
-        "event_id": "uuid",
+        "event_id": "01JD3Q8W5ZK4M7XN2P9RTVB6CH-P-123ABC",
         "payment_method": "cash|card",
         "paid_at": "2025-11-17T16:35:03Z"
     }
@@ -82,7 +126,7 @@ def lambda_handler(event, context):
         if 'pathParameters' in event and event['pathParameters']:
             event_id = event['pathParameters'].get('event_id')
         else:
-            body = json.loads(event.get('body', '{}')) if isinstance(event.get('body'), str) else event.get('body', {})
+            body = http_encoding.request_json(event)
             event_id = body.get('event_id')
         
         if not event_id:
@@ -94,20 +138,15 @@ def lambda_handler(event, context):
         transactions_table = dynamodb.Table(TRANSACTIONS_TABLE)
         invoices_table = dynamodb.Table(INVOICES_TABLE)
         
-        # Buscar transacción por event_id usando GSI
-        response = transactions_table.query(
-            IndexName='by_event',
-            KeyConditionExpression='event_id = :event_id',
-            ExpressionAttributeValues={':event_id': event_id}
-        )
-        
-        if not response.get('Items'):
+        transaction = find_transaction(transactions_table, event_id)
+        if not transaction:
             return build_response(404, {
                 'error': 'Transaction not found',
                 'message': f'Transaction with event_id {event_id} not found'
             })
+        # Un UUID migrado se resuelve a su event_id actual (invoice, ledger, respuesta)
+        event_id = transaction.get('event_id') or event_id
         
-        transaction = response['Items'][0]
         transaction_status = transaction.get('status')
         requires_payment = transaction.get('requires_payment', False)
         
@@ -178,55 +217,92 @@ def lambda_handler(event, context):
         tag_id = transaction.get('tag_id')
         if tag_id:
             try:
-                tags_table = dynamodb.Table(TAGS_TABLE)
-                # Obtener tag actual
-                tag_response = tags_table.get_item(Key={'tag_id': tag_id})
-                if 'Item' in tag_response:
-                    tag = tag_response['Item']
-                    current_debt = to_decimal(tag.get('debt', 0))
-                    current_late_fee = to_decimal(tag.get('late_fee', 0))
-                    
-                    # Si la transacción tenía deuda, actualizar el tag
-                    transaction_debt = to_decimal(transaction.get('tag_debt', 0))
-                    if transaction_debt > 0:
+                # Si la transacción tenía deuda, actualizar el tag
+                transaction_debt = to_decimal(transaction.get('tag_debt', 0))
+                if transaction_debt > 0 and tag_ledger.TAG_LEDGER_ENABLED:
+                    # Modo ledger: liquidación y mora se registran como entradas
+                    for entry_type, entry_amount in (('settlement', transaction_debt), ('late_fee', late_fee)):
+                        if entry_amount <= 0:
+                            continue
+                        try:
+                            tag_ledger.append(dynamodb, TAGS_TABLE, tag_id, entry_type, entry_amount, reference=event_id)
+                        except tag_ledger.DuplicateEntry:
+                            pass
+                elif transaction_debt > 0:
+                    tags_table = dynamodb.Table(TAGS_TABLE)
+                    # Obtener tag actual
+                    tag = tags_table.get_item(Key={'tag_id': tag_id}).get('Item')
+                    for _ in range(tag_versions.MAX_VERSION_ATTEMPTS):
+                        if tag is None:
+                            break
+                        current_debt = to_decimal(tag.get('debt', 0))
+                        current_late_fee = to_decimal(tag.get('late_fee', 0))
+                        
                         # Reducir deuda y actualizar mora
                         new_debt = max(Decimal('0.00'), current_debt - transaction_debt)
                         new_late_fee = current_late_fee + late_fee
                         
-                        tags_table.update_item(
-                            Key={'tag_id': tag_id},
-                            UpdateExpression='SET debt = :debt, late_fee = :late_fee, has_debt = :has_debt, last_updated = :last_updated',
-                            ExpressionAttributeValues={
-                                ':debt': new_debt,
-                                ':late_fee': new_late_fee,
-                                ':has_debt': (new_debt > 0),
-                                ':last_updated': current_time.isoformat() + 'Z'
-                            }
-                        )
+                        # Condicionado a la versión leída (un débito concurrente cambia la deuda)
+                        try:
+                            tags_table.update_item(**tag_versions.versioned({
+                                'Key': {'tag_id': tag_id},
+                                'UpdateExpression': 'SET debt = :debt, late_fee = :late_fee, has_debt = :has_debt, last_updated = :last_updated',
+                                'ExpressionAttributeValues': {
+                                    ':debt': new_debt,
+                                    ':late_fee': new_late_fee,
+                                    ':has_debt': (new_debt > 0),
+                                    ':last_updated': current_time.isoformat() + 'Z'
+                                }
+                            }, expected=tag_versions.current(tag)))
+                            break
+                        except ClientError as e:
+                            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                                raise
+                            tag = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item')
+                    else:
+                        raise tag_versions.VersionConflict(tag_id, tag_versions.current(tag))
             except Exception as e:
                 print(f'Warning: Failed to update tag debt: {str(e)}')
         
         # Crear invoice ahora que el pago está completo
-        invoice_id = f"INV-{event_id[:8]}-{placa}"
+        invoice_id = None
         invoice_created_at = current_time.isoformat() + 'Z'
         
-        invoice_item = {
-            'placa': placa,
-            'invoice_id': invoice_id,
-            'event_id': event_id,
-            'amount': total_with_late_fee,  # Incluir mora en el invoice
-            'subtotal': to_decimal(transaction.get('subtotal', 0)),
-            'tax': to_decimal(transaction.get('tax', 0)),
-            'late_fee': late_fee,
-            'currency': transaction.get('currency', 'GTQ'),
-            'peaje_id': transaction.get('peaje_id'),
-            'status': 'paid',
-            'payment_method': 'cash',  # Por defecto, puede venir en el body
-            'created_at': invoice_created_at,
-            'transactions': [transaction]
-        }
+        if period_invoices.is_enabled():
+            # Facturación por periodo: el pago se agrega al invoice abierto de la placa
+            invoice_id = period_invoices.append(
+                dynamodb, INVOICES_TABLE, placa, event_id,
+                {
+                    'total': total_with_late_fee,
+                    'subtotal': transaction.get('subtotal', 0),
+                    'tax': transaction.get('tax', 0),
+                    'currency': transaction.get('currency', 'GTQ')
+                },
+                peaje_id=transaction.get('peaje_id'),
+                late_fee=late_fee,
+                timestamp=transaction.get('timestamp'),
+                now=current_time
+            )
         
-        invoices_table.put_item(Item=invoice_item)
+        if not invoice_id:
+            invoice_id = f"INV-{event_id}"
+            invoice_item = {
+                'placa': placa,
+                'invoice_id': invoice_id,
+                'event_id': event_id,
+                'amount': total_with_late_fee,  # Incluir mora en el invoice
+                'subtotal': to_decimal(transaction.get('subtotal', 0)),
+                'tax': to_decimal(transaction.get('tax', 0)),
+                'late_fee': late_fee,
+                'currency': transaction.get('currency', 'GTQ'),
+                'peaje_id': transaction.get('peaje_id'),
+                'status': 'paid',
+                'payment_method': 'cash',  # Por defecto, puede venir en el body
+                'created_at': invoice_created_at,
+                'transactions': [transaction]
+            }
+            
+            invoices_table.put_item(Item=invoice_item)
         
         # Enviar notificación de pago completado
         try:
@@ -261,11 +337,12 @@ def lambda_handler(event, context):
                     tag_response = tags_table.get_item(Key={'tag_id': tag_id})
                     if 'Item' in tag_response:
                         tag = tag_response['Item']
+                        state = tag_ledger.read_state(dynamodb, tag)
                         notification_message['tag_info'] = {
                             'tag_id': tag_id,
-                            'current_balance': float(tag.get('balance', 0)),
-                            'debt': float(tag.get('debt', 0)),
-                            'late_fee': float(tag.get('late_fee', 0))
+                            'current_balance': float(state['balance']),
+                            'debt': float(state['debt']),
+                            'late_fee': float(state['late_fee'])
                         }
                 except Exception as e:
                     print(f'Warning: Could not fetch tag info for notification: {str(e)}')
@@ -1,76 +1,211 @@
 import json
+import math
 import os
-import uuid
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 import boto3
+import admission_control
+import cache_versions
+import ddb_tracer
+import event_ids
+import http_encoding
+import negative_cache
+import toll_catalog
+import warmup
 from botocore.exceptions import ClientError
 
 eventbridge = boto3.client('events')
-dynamodb = boto3.resource('dynamodb')
+sqs = boto3.client('sqs')
+dynamodb = ddb_tracer.resource()
 
 EVENT_BUS_NAME = os.environ.get('EVENT_BUS_NAME')
 TAGS_TABLE = os.environ.get('TAGS_TABLE')
-TOLLS_CATALOG_TABLE = os.environ.get('TOLLS_CATALOG_TABLE')
+# ProcessingMode=fifo: los cruces van a la cola FIFO con un grupo por tag/placa
+TOLL_FIFO_QUEUE_URL = os.environ.get('TOLL_FIFO_QUEUE_URL')
+# La lectura del tag corre en paralelo con el peaje y el control de admisión;
+# la espera total por las lecturas está acotada por INGEST_LOOKUP_DEADLINE_MS
+INGEST_CONCURRENT_LOOKUPS = os.environ.get('INGEST_CONCURRENT_LOOKUPS', 'true').lower() == 'true'
+INGEST_LOOKUP_DEADLINE_MS = int(os.environ.get('INGEST_LOOKUP_DEADLINE_MS', '1000'))
+INGEST_LOOKUP_WORKERS = int(os.environ.get('INGEST_LOOKUP_WORKERS', '4'))
+# IngestMode=accept: solo esquema + peaje en el catálogo en memoria, se publica
+# y se responde 202; tag y usuario los valida validate_transaction y los
+# cruces inválidos se consultan en GET /tolls/{peaje_id}/rejections.
+# validate (default): validación completa antes de publicar, responde 200
+INGEST_MODE = os.environ.get('INGEST_MODE', 'validate')
 
+# Catálogo de peajes en memoria (se carga en la fase de init)
+catalog = toll_catalog.TollCatalog(dynamodb)
 
-def build_response(status_code, payload):
+# Resultados negativos recientes ('toll:<peaje_id>', 'tag:<tag_id>'): una
+# ráfaga de un pórtico mal configurado se responde sin leer DynamoDB.
+# manage_tags incrementa la versión 'tags' al cambiar un tag; antes de usar
+# una entrada de tag se verifica (a lo sumo cada NEGATIVE_CACHE_VERSION_CHECK_SECONDS).
+# Ese intervalo acota cuánto tiempo un tag recién creado o reactivado puede
+# seguir recibiendo el 400 guardado
+negative = negative_cache.NegativeCache()
+tags_version = cache_versions.VersionWatcher(
+    dynamodb, cache_versions.TAGS_KEY,
+    int(os.environ.get('NEGATIVE_CACHE_VERSION_CHECK_SECONDS', '5'))
+)
+
+# Token bucket por peaje_id: una plaza con ráfagas no consume la concurrencia
+# de las demás (responde 429 con Retry-After al exceder su presupuesto)
+admission = admission_control.AdmissionController(dynamodb)
+
+# Hilos para las lecturas de tags. Usan el cliente del recurso (thread-safe);
+# las cachés (negativa, versión) solo se tocan desde el hilo del handler
+lookups = ThreadPoolExecutor(max_workers=INGEST_LOOKUP_WORKERS)
+
+
+def build_response(status_code, payload, headers=None):
     return {
         'statusCode': status_code,
         'headers': {
             'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'Access-Control-Allow-Origin': '*',
+            **(headers or {})
         },
         'body': json.dumps(payload)
     }
 
 
-def validate_toll(peaje_id):
-    tolls_table = dynamodb.Table(TOLLS_CATALOG_TABLE)
-    response = tolls_table.get_item(Key={'peaje_id': peaje_id})
-    return response.get('Item')
-
-
-def get_tag_info(tag_id):
+def publish_crossing(event_detail):
     """
-    Obtiene la información del tag. Retorna el tag si existe, None si no.
+    Publica el cruce en EventBridge o, en modo fifo, en la cola FIFO con
+    MessageGroupId = tag_id o placa: los cruces de una misma cuenta se procesan
+    en orden y los de cuentas distintas en paralelo.
+    Retorna (destino, respuesta).
     """
-    tags_table = dynamodb.Table(TAGS_TABLE)
-    response = tags_table.get_item(Key={'tag_id': tag_id})
+    if TOLL_FIFO_QUEUE_URL:
+        response = sqs.send_message(
+            QueueUrl=TOLL_FIFO_QUEUE_URL,
+            MessageBody=json.dumps({'detail': event_detail}),
+            MessageGroupId=event_detail.get('tag_id') or event_detail['placa'],
+            MessageDeduplicationId=event_detail['event_id']
+        )
+        return 'fifo', response
+    response = eventbridge.put_events(
+        Entries=[
+            {
+                'Source': 'guatepass.toll',
+                'DetailType': 'Toll Transaction Event',
+                'Detail': json.dumps(event_detail),
+                'EventBusName': EVENT_BUS_NAME
+            }
+        ]
+    )
+    return 'eventbridge', response
+
+
+def schema_errors(body):
+    """Tipos y formato de los campos (modo accept): lista de errores."""
+    errors = [
+        f'"{field}" debe ser un texto'
+        for field in ('peaje_id', 'placa', 'tag_id', 'timestamp')
+        if body.get(field) is not None and not isinstance(body[field], str)
+    ]
+    if not errors:
+        try:
+            event_ids.to_millis(body['timestamp'])
+        except ValueError:
+            errors.append(f'"timestamp" no es ISO 8601: {body["timestamp"]}')
+    return errors
+
+
+def validate_toll(peaje_id, fetch_missing=True):
+    if negative.get(f'toll:{peaje_id}'):
+        return None
+    item = catalog.get(peaje_id, fetch_missing=fetch_missing)
+    if item is None:
+        negative.put(f'toll:{peaje_id}', 'not_found')
+    return item
+
+
+def cached_tag_error(tag_id):
+    """Error guardado para el tag, descartando la caché de tags si manage_tags la invalidó."""
+    if f'tag:{tag_id}' not in negative.entries:
+        return None
+    if tags_version.changed():
+        negative.clear('tag:')
+        return None
+    return negative.get(f'tag:{tag_id}')
+
+
+def fetch_tag(tag_id):
+    """get_item del tag con el cliente (se puede llamar desde los hilos de lookups)."""
+    response = dynamodb.meta.client.get_item(TableName=TAGS_TABLE, Key={'tag_id': tag_id})
     return response.get('Item')
 
 
-def validate_tag(tag_id, placa=None):
+def resolved(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def start_tag_lookup(tag_id):
     """
-    Valida que el tag existe, está activo y corresponde a la placa (si se proporciona).
-    
-    NOTA: Esta es una validación temprana (fail-fast) para mejorar la experiencia
-    del usuario. La validación completa también se realiza en ValidateTransactionFunction
-    dentro del flujo de Step Functions para garantizar consistencia.
-    
-    Args:
-        tag_id: ID del tag a validar
-        placa: Placa opcional para validar correspondencia
-    
-    Returns:
-        tuple: (error_message, tag_info) - Si error_message es None, el tag es válido
+    Inicia la validación del tag. La caché negativa y la versión de tags se
+    resuelven aquí (hilo del handler); solo el get_item va al pool.
+    Retorna un Future con ('error', mensaje) o ('tag', item o None).
     """
-    tag = get_tag_info(tag_id)
+    cached_error = cached_tag_error(tag_id)
+    if cached_error:
+        return resolved(('error', cached_error))
+    if tags_version.version is None:
+        # Versión base leída antes que el tag: un cambio posterior la invalida
+        tags_version.changed()
+    if not INGEST_CONCURRENT_LOOKUPS:
+        return resolved(('tag', fetch_tag(tag_id)))
+    return lookups.submit(lambda: ('tag', fetch_tag(tag_id)))
+
+
+def finish_tag_validation(tag_id, placa, lookup):
+    """Evalúa el resultado de start_tag_lookup: (error_message, tag_info)."""
+    kind, value = lookup
+    if kind == 'error':
+        return (value, None)
+    tag = value
     if not tag:
+        negative.put(f'tag:{tag_id}', 'Tag no encontrado')
         return ('Tag no encontrado', None)
     if tag.get('status') != 'active':
+        negative.put(f'tag:{tag_id}', 'Tag inactivo')
         return ('Tag inactivo', None)
     if placa and tag.get('placa') != placa:
         return (f'Tag {tag_id} pertenece a {tag.get("placa")}, no a {placa}', None)
     return (None, tag)
 
 
+def prime_publisher():
+    """Abre la conexión con el destino de los cruces (EventBridge o la cola FIFO)."""
+    if TOLL_FIFO_QUEUE_URL:
+        sqs.get_queue_attributes(QueueUrl=TOLL_FIFO_QUEUE_URL, AttributeNames=['QueueArn'])
+    else:
+        eventbridge.describe_event_bus(Name=EVENT_BUS_NAME)
+
+
+# Fase de init: catálogo, versión base de la caché de tags y
+# conexiones TLS con DynamoDB y el destino de publicación
+warmup.prime('ingest_webhook', {
+    'toll_catalog': catalog.load,
+    'tags_version': tags_version.changed,
+    'publisher': prime_publisher
+})
+
+
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Endpoint de ingesta de webhooks de peajes.
     Realiza una validación temprana y publica el evento en EventBridge.
+    En modo accept los eventos con placa se publican sin leer DynamoDB (202).
     """
+    if warmup.is_warmup(event):
+        return warmup.respond(event, context)
     try:
-        body = json.loads(event.get('body', '{}')) if isinstance(event.get('body'), str) else event.get('body', {})
+        body = http_encoding.request_json(event)
 
         # Validar campos requeridos: peaje_id y timestamp son obligatorios
         # placa O tag_id deben estar presentes (al menos uno)
@@ -93,42 +228,95 @@ def lambda_handler(event, context):
                 'message': 'Debe proporcionarse al menos "placa" o "tag_id"'
             })
 
-        # Si solo viene tag_id, obtener la placa del tag
-        if tag_id and not placa:
-            tag_error, tag_info = validate_tag(tag_id)
-            if tag_error:
+        # Modo accept: un evento solo con tag_id sigue el camino completo
+        # (lectura del tag y admisión, 200): la placa del tag es parte del
+        # event_id y sin ella no se puede publicar
+        accept = INGEST_MODE == 'accept' and bool(placa)
+        if accept:
+            errors = schema_errors(body)
+            if errors:
                 return build_response(400, {
-                    'error': 'Invalid tag',
-                    'message': tag_error
-                })
-            # Obtener placa del tag
-            placa = tag_info.get('placa')
-            if not placa:
-                return build_response(400, {
-                    'error': 'Invalid tag',
-                    'message': f'Tag {tag_id} no tiene placa asociada'
+                    'error': 'Invalid fields',
+                    'messages': errors
                 })
 
-        # Validar que el peaje existe
-        peaje_info = validate_toll(body['peaje_id'])
+        # La lectura del tag va al pool mientras este hilo valida el peaje y
+        # el control de admisión: la latencia queda acotada por la lectura más
+        # lenta y no por la suma. Una sola lectura sirve para obtener la placa
+        # (si solo viene tag_id) y para validar la correspondencia
+        deadline = time.monotonic() + INGEST_LOOKUP_DEADLINE_MS / 1000
+        tag_lookup = start_tag_lookup(tag_id) if tag_id and not accept else None
+
+        # Validar que el peaje existe (en modo accept solo contra el catálogo en memoria)
+        peaje_info = validate_toll(body['peaje_id'], fetch_missing=not accept)
         if not peaje_info:
             return build_response(400, {
                 'error': 'Invalid peaje_id',
                 'message': f'Peaje {body["peaje_id"]} no existe'
             })
 
+        # Control de admisión por plaza antes de validar el tag y publicar.
+        # En modo accept no se aplica: sus leases leen y escriben AdmissionBuckets
+        # y el 202 no hace llamadas a DynamoDB
+        if accept:
+            admitted, retry_after = True, 0
+        else:
+            admitted, retry_after = admission.admit(body['peaje_id'], peaje_info)
+            # Admitted/Shed de esta invocación (no se difieren a la siguiente)
+            admission.flush_metrics()
+        if not admitted:
+            return build_response(429, {
+                'error': 'Too many requests',
+                'message': f'Peaje {body["peaje_id"]} excedió su tasa de eventos',
+                'retry_after': round(retry_after, 3)
+            }, headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
         # Validación temprana de tag si se proporciona (fail-fast)
         # Esta validación se repite en ValidateTransactionFunction para garantizar consistencia
         # pero permite rechazar eventos inválidos antes de entrar al flujo de Step Functions
-        if tag_id:
-            tag_error, _ = validate_tag(tag_id, placa)
-            if tag_error:
-                return build_response(400, {
-                    'error': 'Invalid tag',
-                    'message': tag_error
-                })
+        if tag_lookup is not None:
+            try:
+                lookup = tag_lookup.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                lookup = None
+            if lookup is None and not placa:
+                # Sin la placa del tag no se puede publicar el cruce
+                print(json.dumps({
+                    'tag_id': tag_id,
+                    'peaje_id': body['peaje_id'],
+                    'deadline_ms': INGEST_LOOKUP_DEADLINE_MS,
+                    'status': 'tag_lookup_timeout'
+                }))
+                return build_response(503, {
+                    'error': 'Lookup timeout',
+                    'message': f'No se pudo validar el tag {tag_id} a tiempo'
+                }, headers={'Retry-After': '1'})
+            if lookup is None:
+                # Con placa se publica igual: validate_transaction valida el tag
+                print(json.dumps({
+                    'tag_id': tag_id,
+                    'placa': placa,
+                    'deadline_ms': INGEST_LOOKUP_DEADLINE_MS,
+                    'status': 'tag_lookup_deferred'
+                }))
+            else:
+                tag_error, tag_info = finish_tag_validation(tag_id, placa, lookup)
+                if tag_error:
+                    return build_response(400, {
+                        'error': 'Invalid tag',
+                        'message': tag_error
+                    })
+                # Si solo vino tag_id, la placa es la del tag
+                if not placa:
+                    placa = tag_info.get('placa')
+                    if not placa:
+                        return build_response(400, {
+                            'error': 'Invalid tag',
+                            'message': f'Tag {tag_id} no tiene placa asociada'
+                        })
 
-        event_id = str(uuid.uuid4())
+        # ID ordenable por tiempo del cruce; también es la RANGE key (ts) en Transactions
+        event_id = event_ids.new_event_id(placa, body['timestamp'])
         event_detail = {
             'event_id': event_id,
             'placa': placa,  # Ahora siempre tenemos placa (obtenida del tag si es necesario)
@@ -138,28 +326,26 @@ def lambda_handler(event, context):
             'ingested_at': datetime.utcnow().isoformat() + 'Z'
         }
 
-        response = eventbridge.put_events(
-            Entries=[
-                {
-                    'Source': 'guatepass.toll',
-                    'DetailType': 'Toll Transaction Event',
-                    'Detail': json.dumps(event_detail),
-                    'EventBusName': EVENT_BUS_NAME
-                }
-            ]
-        )
+        destination, response = publish_crossing(event_detail)
 
+        status = 'accepted' if accept else 'queued'
         print(json.dumps({
             'event_id': event_id,
             'placa': placa,  # Usar variable placa (obtenida del tag si es necesario)
             'peaje_id': body['peaje_id'],
-            'status': 'queued',
-            'eventbridge_response': response
+            'status': status,
+            f'{destination}_response': response
         }))
 
+        if accept:
+            return build_response(202, {
+                'event_id': event_id,
+                'status': status,
+                'message': 'Event accepted; tag and user are validated asynchronously'
+            })
         return build_response(200, {
             'event_id': event_id,
-            'status': 'queued',
+            'status': status,
             'message': 'Event successfully queued for processing'
         })
 
@@ -1,25 +1,41 @@
+import hashlib
 import json
 import os
 from datetime import datetime
 from decimal import Decimal
-import boto3
+import cache_versions
+import classification_cache
+import ddb_tracer
+import http_encoding
+import sharded_balance
+import tag_ledger
+import tag_versions
 from botocore.exceptions import ClientError
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = ddb_tracer.resource()
 
 TAGS_TABLE = os.environ.get('TAGS_TABLE')
 USERS_TABLE = os.environ.get('USERS_TABLE')
 
 
-def build_response(status_code, payload):
-    """Construye respuesta HTTP estándar."""
+# GET /users/{placa}/tag: el cliente guarda la respuesta pero la revalida
+# siempre (If-None-Match); el balance puede cambiar en cualquier cruce
+TAG_CACHE_CONTROL = 'private, no-cache'
+
+# placa -> tag_id resuelto en GET (se verifica contra el item leído)
+tag_ids = {}
+
+
+def build_response(status_code, payload, headers=None):
+    """Construye respuesta HTTP estándar (sin body si payload es None)."""
     return {
         'statusCode': status_code,
         'headers': {
             'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
+            'Access-Control-Allow-Origin': '*',
+            **(headers or {})
         },
-        'body': json.dumps(payload, default=str)
+        'body': json.dumps(payload, default=str) if payload is not None else ''
     }
 
 
@@ -35,6 +51,81 @@ def to_decimal(value):
         return Decimal('0.00')
 
 
+def strong_etag(payload):
+    """ETag fuerte del cuerpo: cambia con cualquier campo (balance, status, last_updated)."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return '"' + hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """Comparación débil de If-None-Match (RFC 9110): ignora el prefijo W/."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [value.strip() for value in if_none_match.split(',')]
+    return etag in [value[2:] if value.startswith('W/') else value for value in candidates]
+
+
+def find_tag_by_placa(tags_table, users_table, placa, consistent=False):
+    """
+    Tag de la placa con lecturas por llave: UsersVehicles.tag_id (recordado
+    en el contenedor) y get_item en Tags. Si no hay referencia o el tag ya no
+    está activo para la placa, se busca con scan como antes (activo o el primero).
+    consistent=True lee el item de Tags con lectura consistente (PUT/DELETE).
+    """
+    tag_id = tag_ids.get(placa)
+    if tag_id is None:
+        user = users_table.get_item(Key={'placa': placa}, ProjectionExpression='tag_id').get('Item') or {}
+        tag_id = user.get('tag_id')
+    if tag_id:
+        tag = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=consistent).get('Item')
+        if tag and tag.get('placa') == placa and tag.get('status') == 'active':
+            tag_ids[placa] = tag_id
+            return tag
+    tag_ids.pop(placa, None)
+    
+    response = tags_table.scan(
+        FilterExpression='placa = :placa',
+        ExpressionAttributeValues={':placa': placa},
+        ConsistentRead=consistent
+    )
+    tags = response.get('Items', [])
+    if not tags:
+        return None
+    tag = next((t for t in tags if t.get('status') == 'active'), tags[0])
+    if tag.get('status') == 'active':
+        tag_ids[placa] = tag['tag_id']
+    return tag
+
+
+def tag_payload(tag, state):
+    """Representación del tag (GET y PUT); su hash es el ETag de If-None-Match e If-Match."""
+    return {
+        'tag': {
+            'tag_id': tag['tag_id'],
+            'placa': tag['placa'],
+            'status': tag.get('status', 'active'),
+            'balance': float(state['balance']),
+            'debt': float(state['debt']),
+            'late_fee': float(state['late_fee']),
+            'has_debt': state['debt'] > 0 if tag_ledger.TAG_LEDGER_ENABLED else tag.get('has_debt', False),
+            'version': tag_versions.current(tag),
+            'created_at': tag.get('created_at'),
+            'last_updated': tag.get('last_updated')
+        }
+    }
+
+
+def precondition_failed(tag, state):
+    """412: el tag cambió desde que el cliente lo leyó; se envía el ETag actual."""
+    return build_response(412, {
+        'error': 'Precondition failed',
+        'message': f"El tag {tag['tag_id']} cambió desde la versión leída",
+        'version': tag_versions.current(tag)
+    }, headers={'ETag': strong_etag(tag_payload(tag, state)), 'Access-Control-Expose-Headers': 'ETag'})
+
+
 def validate_placa_exists(placa):
     """Valida que la placa existe en UsersVehicles."""
     users_table = dynamodb.Table(USERS_TABLE)
@@ -42,6 +133,7 @@ def validate_placa_exists(placa):
     return 'Item' in response
 
 
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Maneja operaciones CRUD para tags asociados a placas.
@@ -56,7 +148,7 @@ def lambda_handler(event, context):
         http_method = event.get('httpMethod', '')
         path = event.get('path', '')
         path_params = event.get('pathParameters', {}) or {}
-        body = json.loads(event.get('body', '{}')) if isinstance(event.get('body'), str) else event.get('body', {})
+        body = http_encoding.request_json(event)
         
         placa = path_params.get('placa')
         
@@ -112,10 +204,21 @@ def lambda_handler(event, context):
                 'late_fee': to_decimal('0.00'),
                 'has_debt': False,
                 'created_at': timestamp,
-                'last_updated': timestamp
+                'last_updated': timestamp,
+                'version': 1
             }
             
-            tags_table.put_item(Item=tag_item)
+            if tag_ledger.TAG_LEDGER_ENABLED:
+                # Modo ledger: el snapshot inicia en cero y el saldo inicial es la
+                # primera entrada del ledger (permite reconciliar desde el origen)
+                tag_item['balance'] = to_decimal('0.00')
+                tags_table.put_item(Item=tag_item)
+                if balance > 0:
+                    tag_ledger.append(dynamodb, TAGS_TABLE, tag_id, 'credit', balance, reference='opening')
+            else:
+                tags_table.put_item(Item=tag_item)
+            # Invalida las cachés negativas de tags de ingest_webhook
+            cache_versions.bump(dynamodb, cache_versions.TAGS_KEY, timestamp)
             
             # Actualizar UsersVehicles para indicar que tiene tag
             try:
@@ -130,6 +233,8 @@ def lambda_handler(event, context):
             except ClientError:
                 # Si falla, no es crítico, solo un log
                 print(f'Warning: Could not update UsersVehicles for placa {placa}')
+            # Invalida la clasificación en caché de validate_transaction (después de ambas escrituras)
+            classification_cache.bump(dynamodb, placa, timestamp)
             
             return build_response(201, {
                 'message': 'Tag created successfully',
@@ -146,149 +251,183 @@ def lambda_handler(event, context):
         
         # GET - Obtener tag por placa
         elif http_method == 'GET':
-            # Buscar tag por placa (requiere scan, pero es aceptable para este caso)
-            # En producción, considera agregar un GSI por placa
-            response = tags_table.scan(
-                FilterExpression='placa = :placa',
-                ExpressionAttributeValues={':placa': placa}
-            )
+            # Lecturas por llave; scan solo para placas sin referencia al tag
+            active_tag = find_tag_by_placa(tags_table, users_table, placa)
             
-            tags = response.get('Items', [])
-            
-            if not tags:
+            if active_tag is None:
                 return build_response(404, {
                     'error': 'Tag not found',
                     'message': f'No se encontró tag para la placa {placa}'
                 })
             
-            # Si hay múltiples tags, devolver el activo o el primero
-            active_tag = next((t for t in tags if t.get('status') == 'active'), tags[0])
+            payload = tag_payload(active_tag, tag_ledger.read_state(dynamodb, active_tag))
             
-            return build_response(200, {
-                'tag': {
-                    'tag_id': active_tag['tag_id'],
-                    'placa': active_tag['placa'],
-                    'status': active_tag.get('status', 'active'),
-                    'balance': float(active_tag.get('balance', 0)),
-                    'debt': float(active_tag.get('debt', 0)),
-                    'late_fee': float(active_tag.get('late_fee', 0)),
-                    'has_debt': active_tag.get('has_debt', False),
-                    'created_at': active_tag.get('created_at'),
-                    'last_updated': active_tag.get('last_updated')
-                }
-            })
+            # Polling de la app: sin cambios se responde 304 sin body
+            etag = strong_etag(payload)
+            cache_headers = {
+                'ETag': etag,
+                'Cache-Control': TAG_CACHE_CONTROL,
+                'Access-Control-Expose-Headers': 'ETag'
+            }
+            if etag_matches(http_encoding.header(event, 'If-None-Match'), etag):
+                return build_response(304, None, headers=cache_headers)
+            return build_response(200, payload, headers=cache_headers)
         
         # PUT - Actualizar tag
         elif http_method == 'PUT':
-            # Buscar tag por placa
-            response = tags_table.scan(
-                FilterExpression='placa = :placa',
-                ExpressionAttributeValues={':placa': placa}
-            )
-            
-            tags = response.get('Items', [])
-            
-            if not tags:
-                return build_response(404, {
-                    'error': 'Tag not found',
-                    'message': f'No se encontró tag para la placa {placa}'
-                })
-            
-            # Usar el tag activo o el primero
-            tag = next((t for t in tags if t.get('status') == 'active'), tags[0])
-            tag_id = tag['tag_id']
-            
-            # Construir expresión de actualización
-            update_expression_parts = []
-            expression_values = {}
-            
-            # Campos actualizables
-            if 'balance' in body:
-                update_expression_parts.append('balance = :balance')
-                expression_values[':balance'] = to_decimal(body['balance'])
-            
-            if 'status' in body:
-                update_expression_parts.append('status = :status')
-                expression_values[':status'] = body['status']
-            
-            if 'debt' in body:
-                update_expression_parts.append('debt = :debt')
-                expression_values[':debt'] = to_decimal(body['debt'])
-            
-            if 'late_fee' in body:
-                update_expression_parts.append('late_fee = :late_fee')
-                expression_values[':late_fee'] = to_decimal(body['late_fee'])
-            
-            if 'has_debt' in body:
-                update_expression_parts.append('has_debt = :has_debt')
-                expression_values[':has_debt'] = bool(body['has_debt'])
-            
-            if not update_expression_parts:
-                return build_response(400, {
-                    'error': 'No fields to update',
-                    'message': 'Debe proporcionar al menos un campo para actualizar'
+            # If-Match (opcional): el cambio solo se aplica si el tag sigue igual
+            # a la representación que el operador leyó (ETag del GET)
+            if_match = http_encoding.header(event, 'If-Match')
+            
+            for _ in range(tag_versions.MAX_VERSION_ATTEMPTS):
+                tag = find_tag_by_placa(tags_table, users_table, placa, consistent=True)
+                
+                if tag is None:
+                    return build_response(404, {
+                        'error': 'Tag not found',
+                        'message': f'No se encontró tag para la placa {placa}'
+                    })
+                
+                tag_id = tag['tag_id']
+                state = tag_ledger.read_state(dynamodb, tag)
+                if if_match and not etag_matches(if_match, strong_etag(tag_payload(tag, state))):
+                    return precondition_failed(tag, state)
+                
+                # Construir expresión de actualización
+                update_expression_parts = []
+                expression_values = {}
+                expression_names = {}
+                balance_fields = [field for field in ('balance', 'debt', 'late_fee') if field in body]
+                
+                # Balance fragmentado (tags de flota): balance_shards activa/cambia/desactiva
+                # el modo, y un balance absoluto se reparte entre los shards
+                target_shards = int(body['balance_shards'] or 0) if 'balance_shards' in body else None
+                sharded_after = target_shards > 0 if target_shards is not None else sharded_balance.is_sharded(tag)
+                shard_balance = 'balance' in body and (sharded_balance.is_sharded(tag) or sharded_after)
+                if shard_balance:
+                    balance_fields.remove('balance')
+                
+                ledger_deltas = None
+                if tag_ledger.TAG_LEDGER_ENABLED and balance_fields:
+                    # Modo ledger: los valores absolutos se registran como un ajuste
+                    # (delta contra snapshot + cola) en lugar de sobrescribir el tag
+                    ledger_deltas = {f'{field}_delta': to_decimal(body[field]) - state[field] for field in balance_fields}
+                else:
+                    # Campos actualizables
+                    if 'balance' in balance_fields:
+                        update_expression_parts.append('balance = :balance')
+                        expression_values[':balance'] = to_decimal(body['balance'])
+                    
+                    if 'debt' in body:
+                        update_expression_parts.append('debt = :debt')
+                        expression_values[':debt'] = to_decimal(body['debt'])
+                    
+                    if 'late_fee' in body:
+                        update_expression_parts.append('late_fee = :late_fee')
+                        expression_values[':late_fee'] = to_decimal(body['late_fee'])
+                    
+                    if 'has_debt' in body:
+                        update_expression_parts.append('has_debt = :has_debt')
+                        expression_values[':has_debt'] = bool(body['has_debt'])
+                
+                if 'status' in body:
+                    # status es palabra reservada de DynamoDB
+                    update_expression_parts.append('#status = :status')
+                    expression_names['#status'] = 'status'
+                    expression_values[':status'] = body['status']
+                
+                if not update_expression_parts and target_shards is None and not shard_balance and not ledger_deltas:
+                    return build_response(400, {
+                        'error': 'No fields to update',
+                        'message': 'Debe proporcionar al menos un campo para actualizar'
+                    })
+                
+                # Siempre actualizar last_updated
+                update_expression_parts.append('last_updated = :last_updated')
+                expression_values[':last_updated'] = timestamp
+                
+                # Actualizar tag condicionado a la versión leída: un débito o un pago
+                # aplicado entre la lectura y esta escritura no se pierde
+                update_kwargs = {
+                    'Key': {'tag_id': tag_id},
+                    'UpdateExpression': 'SET ' + ', '.join(update_expression_parts),
+                    'ExpressionAttributeValues': expression_values
+                }
+                if expression_names:
+                    update_kwargs['ExpressionAttributeNames'] = expression_names
+                try:
+                    tags_table.update_item(**tag_versions.versioned(update_kwargs, expected=tag_versions.current(tag)))
+                    break
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+                    if if_match:
+                        current = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item') or tag
+                        return precondition_failed(current, tag_ledger.read_state(dynamodb, current))
+            else:
+                return build_response(409, {
+                    'error': 'Concurrent update',
+                    'message': f'El tag de la placa {placa} cambió durante la actualización, intente de nuevo'
                 })
             
-            # Siempre actualizar last_updated
-            update_expression_parts.append('last_updated = :last_updated')
-            expression_values[':last_updated'] = timestamp
-            
-            update_expression = 'SET ' + ', '.join(update_expression_parts)
-            
-            # Actualizar tag
-            response = tags_table.update_item(
-                Key={'tag_id': tag_id},
-                UpdateExpression=update_expression,
-                ExpressionAttributeValues=expression_values,
-                ReturnValues='ALL_NEW'
-            )
-            
-            updated_tag = response['Attributes']
+            # Cambios de balance fuera del item de Tags, después de ganar la versión
+            if target_shards is not None:
+                if shard_balance and not sharded_after:
+                    # Al desactivar, el balance nuevo se deja en los shards para que enable() lo mueva a Tags
+                    sharded_balance.set_total(dynamodb, tag_id, to_decimal(body['balance']), sharded_balance.shard_count(tag))
+                sharded_balance.enable(dynamodb, TAGS_TABLE, tag, target_shards)
+            if shard_balance and sharded_after:
+                shards = target_shards if target_shards is not None else sharded_balance.shard_count(tag)
+                sharded_balance.set_total(dynamodb, tag_id, to_decimal(body['balance']), shards)
+            if ledger_deltas:
+                tag_ledger.append(dynamodb, TAGS_TABLE, tag_id, 'adjustment', **ledger_deltas)
+            
+            updated_tag = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True)['Item']
+            cache_versions.bump(dynamodb, cache_versions.TAGS_KEY, timestamp)
+            classification_cache.bump(dynamodb, updated_tag['placa'], timestamp)
+            payload = tag_payload(updated_tag, tag_ledger.read_state(dynamodb, updated_tag))
             
             return build_response(200, {
                 'message': 'Tag updated successfully',
-                'tag': {
-                    'tag_id': updated_tag['tag_id'],
-                    'placa': updated_tag['placa'],
-                    'status': updated_tag.get('status', 'active'),
-                    'balance': float(updated_tag.get('balance', 0)),
-                    'debt': float(updated_tag.get('debt', 0)),
-                    'late_fee': float(updated_tag.get('late_fee', 0)),
-                    'has_debt': updated_tag.get('has_debt', False),
-                    'created_at': updated_tag.get('created_at'),
-                    'last_updated': updated_tag.get('last_updated')
-                }
-            })
+                **payload
+            }, headers={'ETag': strong_etag(payload), 'Access-Control-Expose-Headers': 'ETag'})
         
         # DELETE - Desactivar tag
         elif http_method == 'DELETE':
-            # Buscar tag por placa
-            response = tags_table.scan(
-                FilterExpression='placa = :placa',
-                ExpressionAttributeValues={':placa': placa}
-            )
-            
-            tags = response.get('Items', [])
+            if_match = http_encoding.header(event, 'If-Match')
+            tag = find_tag_by_placa(tags_table, users_table, placa, consistent=bool(if_match))
             
-            if not tags:
+            if tag is None:
                 return build_response(404, {
                     'error': 'Tag not found',
                     'message': f'No se encontró tag para la placa {placa}'
                 })
             
-            # Usar el tag activo o el primero
-            tag = next((t for t in tags if t.get('status') == 'active'), tags[0])
             tag_id = tag['tag_id']
-            
-            # Desactivar tag (soft delete)
-            tags_table.update_item(
-                Key={'tag_id': tag_id},
-                UpdateExpression='SET status = :status, last_updated = :last_updated',
-                ExpressionAttributeValues={
-                    ':status': 'inactive',
-                    ':last_updated': timestamp
-                }
-            )
+            expected = None
+            if if_match:
+                state = tag_ledger.read_state(dynamodb, tag)
+                if not etag_matches(if_match, strong_etag(tag_payload(tag, state))):
+                    return precondition_failed(tag, state)
+                expected = tag_versions.current(tag)
+            
+            # Desactivar tag (soft delete); con If-Match, solo si la versión no cambió
+            try:
+                tags_table.update_item(**tag_versions.versioned({
+                    'Key': {'tag_id': tag_id},
+                    'UpdateExpression': 'SET #status = :status, last_updated = :last_updated',
+                    'ExpressionAttributeNames': {'#status': 'status'},
+                    'ExpressionAttributeValues': {
+                        ':status': 'inactive',
+                        ':last_updated': timestamp
+                    }
+                }, expected=expected))
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                current = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item') or tag
+                return precondition_failed(current, tag_ledger.read_state(dynamodb, current))
+            cache_versions.bump(dynamodb, cache_versions.TAGS_KEY, timestamp)
             
             # Actualizar UsersVehicles
             try:
@@ -301,6 +440,7 @@ def lambda_handler(event, context):
                 )
             except ClientError:
                 print(f'Warning: Could not update UsersVehicles for placa {placa}')
+            classification_cache.bump(dynamodb, placa, timestamp)
             
             return build_response(200, {
                 'message': 'Tag deactivated successfully',
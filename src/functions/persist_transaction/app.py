@@ -2,14 +2,16 @@ import json
 import os
 from datetime import datetime
 from decimal import Decimal
-import boto3
+import ddb_tracer
+import period_invoices
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = ddb_tracer.resource()
 
 TRANSACTIONS_TABLE = os.environ.get('TRANSACTIONS_TABLE')
 INVOICES_TABLE = os.environ.get('INVOICES_TABLE')
 
 
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Persiste la transacción en DynamoDB (tabla de transacciones e invoices).
@@ -75,14 +77,13 @@ def lambda_handler(event, context):
             create_invoice = True
         
         # Crear registro de transacción
-        # Asegurar que timestamp tenga un valor válido (requerido para GSI placa-timestamp-index)
         if not timestamp:
             timestamp = datetime.utcnow().isoformat() + 'Z'
         
-        # Usar event_id como ts (RANGE key) para garantizar unicidad
-        # El timestamp del evento se guarda en el campo 'timestamp' para el GSI placa-timestamp-index
-        # Esto evita colisiones cuando dos transacciones de la misma placa tienen timestamps similares
-        ts = event_id  # Garantiza unicidad absoluta para cada transacción
+        # event_id es ordenable por tiempo del cruce (event_ids): usarlo como ts
+        # (RANGE key) deja la tabla base ordenada cronológicamente por placa y
+        # garantiza unicidad aunque dos cruces tengan el mismo timestamp
+        ts = event_id
         
         transaction_item = {
             'placa': placa,  # HASH key
@@ -95,12 +96,17 @@ def lambda_handler(event, context):
             'subtotal': to_decimal(charge.get('subtotal', 0)),
             'tax': to_decimal(charge.get('tax', 0)),
             'currency': charge.get('currency', 'GTQ'),
-            'timestamp': timestamp,  # CRÍTICO: Debe tener valor para que funcione el GSI placa-timestamp-index
+            'timestamp': timestamp,
             'status': transaction_status,
             'requires_payment': requires_payment,
             'created_at': datetime.utcnow().isoformat() + 'Z'
         }
         
+        # Placa corregida por coincidencia OCR (validate_transaction)
+        if event.get('placa_detectada'):
+            transaction_item['placa_detectada'] = event['placa_detectada']
+            transaction_item['source_event_id'] = event.get('source_event_id')
+        
         # Agregar información de deuda si aplica (para tags)
         if user_type == 'tag' and event.get('tag_balance_update'):
             balance_update = event.get('tag_balance_update', {})
@@ -116,8 +122,16 @@ def lambda_handler(event, context):
         invoice_id = None
         
         # Crear invoice solo si corresponde
-        if create_invoice:
-            invoice_id = f"INV-{event_id[:8]}-{placa}"
+        if create_invoice and period_invoices.is_enabled():
+            # Facturación por periodo: el cruce se agrega al invoice abierto de la placa
+            invoice_id = period_invoices.append(
+                dynamodb, INVOICES_TABLE, placa, event_id, charge,
+                peaje_id=event.get('peaje_id'), timestamp=timestamp
+            )
+        
+        if create_invoice and not invoice_id:
+            # event_id ya incluye la placa: INV-<ULID>-<placa>
+            invoice_id = f"INV-{event_id}"
             created_at = datetime.utcnow().isoformat() + 'Z'
             invoice_item = {
                 'placa': placa,  # HASH key
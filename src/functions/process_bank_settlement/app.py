@@ -0,0 +1,197 @@
+import csv
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import unquote_plus
+import boto3
+import ddb_tracer
+import notifications
+import tag_topups
+
+s3 = boto3.client('s3')
+sns = boto3.client('sns')
+
+TAGS_TABLE = os.environ.get('TAGS_TABLE')
+USERS_TABLE = os.environ.get('USERS_TABLE')
+TRANSACTIONS_TABLE = os.environ.get('TRANSACTIONS_TABLE')
+SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
+SETTLEMENT_WORKERS = int(os.environ.get('SETTLEMENT_WORKERS', '16'))
+SETTLEMENT_REPORTS_PREFIX = os.environ.get('SETTLEMENT_REPORTS_PREFIX', 'reports/')
+
+REQUIRED_COLUMNS = ('reference', 'amount')
+
+# Un recurso DynamoDB por hilo del pool (los recursos de boto3 no son
+# thread-safe; los clientes sí)
+_local = threading.local()
+
+
+def thread_dynamodb():
+    if not hasattr(_local, 'dynamodb'):
+        _local.dynamodb = ddb_tracer.resource()
+    return _local.dynamodb
+
+
+def parse_rows(text):
+    """
+    Lee el archivo de liquidación (CSV con encabezado):
+        reference,placa,tag_id,amount,paid_at,payment_method
+    placa o tag_id identifica el tag. Las referencias repetidas dentro del
+    archivo se reportan y solo se aplica la primera.
+    Retorna (filas válidas, rechazos).
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        raise ValueError(f'Settlement file is missing columns: {", ".join(missing)}')
+
+    rows, rejected, seen = [], [], set()
+    for line, row in enumerate(reader, start=2):
+        row = {key: (value or '').strip() for key, value in row.items() if key}
+        reference = row.get('reference')
+        if not reference or not (row.get('placa') or row.get('tag_id')):
+            rejected.append({'line': line, 'reference': reference, 'status': 'invalid', 'message': 'reference and placa or tag_id are required'})
+            continue
+        if reference in seen:
+            rejected.append({'line': line, 'reference': reference, 'status': 'duplicate_in_file'})
+            continue
+        try:
+            amount = tag_topups.to_decimal(row.get('amount'))
+        except Exception:
+            amount = tag_topups.ZERO
+        if amount <= 0:
+            rejected.append({'line': line, 'reference': reference, 'status': 'invalid', 'message': 'amount must be greater than zero'})
+            continue
+        seen.add(reference)
+        rows.append({**row, 'line': line, 'amount': amount})
+    return rows, rejected
+
+
+def group_by_tag(rows):
+    """
+    Agrupa las filas por tag (o placa): las recargas de un mismo tag se
+    aplican en secuencia, en el orden del archivo, y los grupos en paralelo.
+    Así las recargas de un archivo casi no compiten por el mismo item de Tags
+    (un tag con filas por tag_id y por placa queda en dos grupos; esas
+    recargas se ordenan con la condición de tag_topups y se reintentan).
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(row.get('tag_id') or f"placa:{row['placa']}", []).append(row)
+    return list(groups.values())
+
+
+def apply_row(ddb, row, source_file):
+    tag = tag_topups.resolve_tag(ddb, TAGS_TABLE, USERS_TABLE, placa=row.get('placa') or None, tag_id=row.get('tag_id') or None)
+    if tag is None:
+        return {'line': row['line'], 'reference': row['reference'], 'status': 'tag_not_found'}
+    record, duplicate = tag_topups.topup(
+        ddb, TAGS_TABLE, TRANSACTIONS_TABLE, tag, row['amount'], row['reference'],
+        source='bank_file', source_file=source_file,
+        paid_at=row.get('paid_at') or None, payment_method=row.get('payment_method') or None
+    )
+    if not duplicate:
+        publish_topup(record)
+    return {
+        'line': row['line'],
+        'reference': row['reference'],
+        'tag_id': record['tag_id'],
+        'status': 'duplicate' if duplicate else 'applied',
+        'amount': float(record['amount']),
+        'debt_paid': float(record['debt_paid']),
+        'late_fee_paid': float(record['late_fee_paid']),
+        'settled_transactions': len(record.get('settled_transactions', []))
+    }
+
+
+def apply_group(rows, source_file):
+    ddb = thread_dynamodb()
+    results = []
+    for row in rows:
+        try:
+            results.append(apply_row(ddb, row, source_file))
+        except Exception as e:
+            # Un fallo no detiene el archivo: la referencia queda sin aplicar y
+            # se puede reprocesar subiendo el archivo de nuevo (idempotente)
+            results.append({'line': row['line'], 'reference': row['reference'], 'status': 'failed', 'message': str(e)})
+    return results
+
+
+def publish_topup(record):
+    try:
+        message, subject, attributes = notifications.build_topup_message(record)
+        sns.publish(
+            TopicArn=SNS_TOPIC_ARN,
+            Message=json.dumps(message, default=str),
+            Subject=subject,
+            MessageAttributes=attributes
+        )
+    except Exception as e:
+        print(f'Warning: Failed to send top-up notification: {str(e)}')
+
+
+def process_file(bucket, key):
+    """Aplica las recargas de un archivo y escribe el reporte junto al archivo."""
+    started_at = datetime.utcnow()
+    text = s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8-sig')
+    rows, results = parse_rows(text)
+
+    with ThreadPoolExecutor(max_workers=SETTLEMENT_WORKERS) as executor:
+        for group_results in executor.map(lambda group: apply_group(group, key), group_by_tag(rows)):
+            results.extend(group_results)
+    results.sort(key=lambda result: result['line'])
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    report = {
+        'bucket': bucket,
+        'key': key,
+        'rows': len(results),
+        'counts': counts,
+        'amount_applied': round(sum(r.get('amount', 0) for r in results if r['status'] == 'applied'), 2),
+        'started_at': started_at.isoformat() + 'Z',
+        'elapsed_seconds': round((datetime.utcnow() - started_at).total_seconds(), 2),
+        'results': results
+    }
+    report_key = SETTLEMENT_REPORTS_PREFIX + os.path.basename(key) + '.report.json'
+    s3.put_object(Bucket=bucket, Key=report_key, Body=json.dumps(report, default=str).encode('utf-8'),
+                  ContentType='application/json')
+    return report_key, report
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Procesa archivos de liquidación bancaria subidos a S3 (settlements/*.csv).
+    Cada fila es una recarga con idempotencia por referencia bancaria: subir
+    el mismo archivo dos veces no duplica saldo (las filas ya aplicadas se
+    reportan como 'duplicate').
+    """
+    reports = []
+    for record in event.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        try:
+            report_key, report = process_file(bucket, key)
+        except Exception as e:
+            print(json.dumps({
+                'error': 'Settlement file failed',
+                'message': str(e),
+                'bucket': bucket,
+                'key': key
+            }))
+            raise
+        print(json.dumps({
+            'key': key,
+            'report_key': report_key,
+            'rows': report['rows'],
+            'counts': report['counts'],
+            'amount_applied': report['amount_applied'],
+            'elapsed_seconds': report['elapsed_seconds'],
+            'status': 'settlement_processed'
+        }))
+        reports.append({'key': key, 'report_key': report_key, 'counts': report['counts']})
+    return {'files': reports}
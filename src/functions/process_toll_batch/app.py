@@ -0,0 +1,639 @@
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+import boto3
+from botocore.exceptions import ClientError
+import ddb_tracer
+import event_ids
+import failed_crossings
+import notifications
+import period_invoices
+import plate_matcher
+import sharded_balance
+import tag_ledger
+import tag_versions
+import toll_charges
+
+dynamodb = ddb_tracer.resource()
+sns = boto3.client('sns')
+
+USERS_TABLE = os.environ.get('USERS_TABLE')
+TAGS_TABLE = os.environ.get('TAGS_TABLE')
+TOLLS_CATALOG_TABLE = os.environ.get('TOLLS_CATALOG_TABLE')
+TRANSACTIONS_TABLE = os.environ.get('TRANSACTIONS_TABLE')
+INVOICES_TABLE = os.environ.get('INVOICES_TABLE')
+SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
+PLATE_MATCHING_ENABLED = os.environ.get('PLATE_MATCHING_ENABLED', 'true').lower() == 'true'
+
+BATCH_GET_SIZE = 100
+SNS_BATCH_SIZE = 10
+# Cruces por transacción de un tag: 1 update del tag + hasta 2 puts por cruce (< 100 acciones)
+CROSSINGS_PER_TRANSACTION = 40
+MAX_TAG_ATTEMPTS = 3
+ZERO = Decimal('0.00')
+
+# Índice de placas registradas publicado por build_plate_index
+plate_index = plate_matcher.IndexLoader()
+
+
+class InvalidCrossing(Exception):
+    """Cruce inválido (peaje o tag): no se reintenta, igual que HandleError en Step Functions."""
+
+
+def to_decimal(value):
+    """Convierte a Decimal, maneja None."""
+    if value is None:
+        return ZERO
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def parse_records(records):
+    """
+    Extrae el detail de cada mensaje SQS. La regla de EventBridge entrega el
+    evento completo; también se acepta el detail directo (redrive manual).
+    Retorna [(message_id, detail)].
+    """
+    parsed = []
+    for record in records:
+        body = json.loads(record['body'])
+        detail = body['detail'] if isinstance(body.get('detail'), dict) else body
+        parsed.append((record['messageId'], detail))
+    return parsed
+
+
+def with_fifo_order(records, failures):
+    """
+    Cola FIFO (ProcessingMode=fifo): a partir del primer mensaje fallido de un
+    grupo, los siguientes del mismo grupo también se reportan para que SQS los
+    re-entregue en orden. Los que ya se persistieron se detectan como re-entregas.
+    """
+    failed_groups = set()
+    ordered = set(failures)
+    for record in records:
+        group = record.get('attributes', {}).get('MessageGroupId')
+        if group is None:
+            continue
+        if group in failed_groups:
+            ordered.add(record['messageId'])
+        elif record['messageId'] in failures:
+            failed_groups.add(group)
+    return ordered
+
+
+def batch_get(requests, consistent_tables=()):
+    """
+    batch_get_item sobre varias tablas a la vez.
+    requests: {table_name: (key_name, [valores])}
+    Retorna {table_name: {valor: item}}.
+    """
+    found = {table_name: {} for table_name in requests}
+    pending = [
+        (table_name, key_name, value)
+        for table_name, (key_name, values) in requests.items()
+        for value in sorted(set(values))
+    ]
+    for start in range(0, len(pending), BATCH_GET_SIZE):
+        chunk = pending[start:start + BATCH_GET_SIZE]
+        request = {}
+        for table_name, key_name, value in chunk:
+            entry = request.setdefault(table_name, {'Keys': []})
+            entry['Keys'].append({key_name: value})
+            if table_name in consistent_tables:
+                entry['ConsistentRead'] = True
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for table_name, items in response.get('Responses', {}).items():
+                key_name = requests[table_name][0]
+                for item in items:
+                    found[table_name][item[key_name]] = item
+            request = response.get('UnprocessedKeys') or None
+    return found
+
+
+def existing_transactions(crossings):
+    """Transacciones ya persistidas (mensajes re-entregados por SQS): {event_id: item}."""
+    keys = [{'placa': c['placa'], 'ts': c['event_id']} for c in crossings]
+    existing = {}
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {TRANSACTIONS_TABLE: {'Keys': keys[start:start + BATCH_GET_SIZE]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(TRANSACTIONS_TABLE, []):
+                existing[item['ts']] = item
+            request = response.get('UnprocessedKeys') or None
+    return existing
+
+
+def restore_invoice(crossing, transaction):
+    """
+    Re-entrega de un cruce ya persistido: completa el invoice por si el intento
+    anterior falló después de guardar la transacción (ambos caminos son idempotentes).
+    """
+    if transaction.get('status') != 'completed' or transaction.get('requires_payment'):
+        return
+    if period_invoices.is_enabled():
+        period_invoices.append(
+            dynamodb, INVOICES_TABLE, transaction['placa'], transaction['event_id'], crossing['charge'],
+            peaje_id=transaction.get('peaje_id'), timestamp=transaction.get('timestamp')
+        )
+        return
+    invoice = build_invoice(crossing, transaction, transaction['created_at'])
+    try:
+        dynamodb.Table(INVOICES_TABLE).put_item(Item=invoice, ConditionExpression='attribute_not_exists(invoice_id)')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def resolve_plates(details, users):
+    """
+    Coincidencia tolerante a OCR (como validate_transaction) para placas sin
+    registro exacto y sin tag_id. Confirma los candidatos únicos con un
+    batch_get y retorna {placa_detectada: item_del_usuario}.
+    """
+    misses = [d['placa'] for d in details if d.get('placa') and not d.get('tag_id') and d['placa'] not in users]
+    if not misses or not PLATE_MATCHING_ENABLED:
+        return {}
+    index = plate_index.get()
+    if index is None:
+        return {}
+    candidates = {}
+    for placa in misses:
+        matches = index.candidates(placa) - {placa}
+        if len(matches) == 1:
+            candidates[placa] = matches.pop()
+    if not candidates:
+        return {}
+    confirmed = batch_get({USERS_TABLE: ('placa', list(candidates.values()))})[USERS_TABLE]
+    return {
+        observed: confirmed[match] for observed, match in candidates.items()
+        if match in confirmed and confirmed[match].get('tipo_usuario') != 'no_registrado'
+    }
+
+
+def classify(detail, tolls, users, tags, corrected):
+    """
+    Valida el cruce y determina el tipo de usuario con los items ya leídos
+    (mismas reglas que validate_transaction). Lanza InvalidCrossing.
+    """
+    peaje_id = detail.get('peaje_id')
+    placa = detail.get('placa')
+    tag_id = detail.get('tag_id')
+    if not peaje_id:
+        raise InvalidCrossing('Missing required field: peaje_id')
+    toll = tolls.get(peaje_id)
+    if not toll:
+        raise InvalidCrossing(f'Peaje {peaje_id} no encontrado en el catálogo')
+
+    tag = tags.get(tag_id) if tag_id else None
+    if not placa and tag_id:
+        if not tag or not tag.get('placa'):
+            raise InvalidCrossing(f'Tag {tag_id} no encontrado o sin placa asociada')
+        placa = tag['placa']
+    if not placa:
+        raise InvalidCrossing('Missing required field: debe proporcionarse placa o tag_id')
+
+    placa_detectada = placa
+    user_info = users.get(placa)
+    if user_info is None and placa in corrected:
+        user_info = corrected[placa]
+        placa = user_info['placa']
+
+    user_type = 'no_registrado'
+    if user_info is not None and user_info.get('tipo_usuario', 'registrado') != 'no_registrado':
+        user_type = 'registrado'
+
+    if tag_id:
+        if tag is not None:
+            tag_placa = tag.get('placa')
+            if (tag_placa and tag_placa != placa and PLATE_MATCHING_ENABLED
+                    and plate_matcher.is_ocr_variant(placa_detectada, tag_placa)):
+                placa = tag_placa
+            if tag.get('status') == 'active' and tag_placa == placa:
+                user_type = 'tag'
+            else:
+                raise InvalidCrossing(f'Tag {tag_id} no está activo o no corresponde a la placa {placa}')
+
+    event_id = detail.get('event_id')
+    crossing = {
+        'event_id': event_id,
+        'placa': placa,
+        'peaje_id': peaje_id,
+        'peaje_info': toll,
+        'user_type': user_type,
+        'user_info': user_info,
+        'tag_info': tag if user_type == 'tag' else None,
+        'timestamp': detail.get('timestamp') or datetime.utcnow().isoformat() + 'Z',
+        'validated_at': detail.get('ingested_at')
+    }
+    if placa != placa_detectada:
+        crossing['placa_detectada'] = placa_detectada
+        crossing['source_event_id'] = event_id
+        if event_ids.is_event_id(event_id):
+            crossing['event_id'] = event_ids.new_event_id(placa, detail.get('timestamp'), seed=event_id)
+    crossing['charge'] = toll_charges.compute_charge(user_type, toll)
+    return crossing
+
+
+def reject(detail, reason):
+    """Publica el cruce inválido en el flujo de rechazos de su plaza (best-effort)."""
+    # Sin tabla (pipeline local) no hay flujo de rechazos
+    if not detail.get('event_id') or not failed_crossings.FAILED_CROSSINGS_TABLE:
+        return
+    try:
+        failed_crossings.record_rejection(dynamodb, detail, reason)
+    except ClientError as e:
+        print(f"Warning: Could not record rejection for {detail['event_id']}: {e}")
+
+
+def settle_status(crossing):
+    """status / requires_payment / create_invoice con las reglas de persist_transaction."""
+    if crossing['user_type'] == 'no_registrado':
+        return 'pending', True, False
+    if crossing['user_type'] == 'tag':
+        update = crossing.get('tag_balance_update', {})
+        if update.get('has_debt') or update.get('requires_payment'):
+            return 'completed', True, False
+    return 'completed', False, True
+
+
+def transaction_item(crossing, created_at):
+    charge = crossing['charge']
+    status, requires_payment, _ = settle_status(crossing)
+    item = {
+        'placa': crossing['placa'],
+        'ts': crossing['event_id'],
+        'event_id': crossing['event_id'],
+        'peaje_id': crossing['peaje_id'],
+        'user_type': crossing['user_type'],
+        'tag_id': crossing['tag_info']['tag_id'] if crossing.get('tag_info') else None,
+        'amount': to_decimal(charge['total']),
+        'subtotal': to_decimal(charge['subtotal']),
+        'tax': to_decimal(charge['tax']),
+        'currency': charge.get('currency', 'GTQ'),
+        'timestamp': crossing['timestamp'],
+        'status': status,
+        'requires_payment': requires_payment,
+        'created_at': created_at
+    }
+    if crossing.get('placa_detectada'):
+        item['placa_detectada'] = crossing['placa_detectada']
+        item['source_event_id'] = crossing.get('source_event_id')
+    update = crossing.get('tag_balance_update')
+    if update:
+        item['tag_balance_before'] = to_decimal(update['previous_balance'])
+        item['tag_balance_after'] = to_decimal(update['new_balance'])
+        if update.get('has_debt'):
+            item['tag_debt'] = to_decimal(update['debt'])
+            item['tag_late_fee'] = to_decimal(update['late_fee'])
+    return item
+
+
+def invoice_item(crossing, transaction, created_at):
+    """Invoice por cruce (INVOICE_PERIOD=crossing); None si no corresponde."""
+    _, _, create_invoice = settle_status(crossing)
+    if not create_invoice or period_invoices.is_enabled():
+        return None
+    return build_invoice(crossing, transaction, created_at)
+
+
+def build_invoice(crossing, transaction, created_at):
+    charge = crossing['charge']
+    return {
+        'placa': crossing['placa'],
+        'invoice_id': f"INV-{crossing['event_id']}",
+        'event_id': crossing['event_id'],
+        'amount': to_decimal(charge['total']),
+        'subtotal': to_decimal(charge['subtotal']),
+        'tax': to_decimal(charge['tax']),
+        'currency': charge.get('currency', 'GTQ'),
+        'peaje_id': crossing['peaje_id'],
+        'status': 'paid',
+        'created_at': created_at,
+        'transactions': [transaction]
+    }
+
+
+def apply_debits(state, crossings, tag_id):
+    """
+    Aplica en memoria los débitos de los cruces (en orden) sobre el estado
+    del tag, con las reglas de update_tag_balance. Retorna el estado final.
+    """
+    balance, debt, late_fee = state['balance'], state['debt'], state['late_fee']
+    for crossing in crossings:
+        amount = to_decimal(crossing['charge']['total'])
+        previous = balance
+        balance = balance - amount
+        has_debt = balance < 0
+        if has_debt:
+            debt = debt + abs(balance)
+            balance = ZERO
+        crossing['tag_balance_update'] = balance_update(
+            tag_id, crossing, previous, {'balance': balance, 'debt': debt, 'late_fee': late_fee}, has_debt
+        )
+    return {'balance': balance, 'debt': debt, 'late_fee': late_fee}
+
+
+def balance_update(tag_id, crossing, previous_balance, state, has_debt):
+    """tag_balance_update de un cruce (mismo formato que update_tag_balance)."""
+    return {
+        'tag_id': tag_id,
+        'previous_balance': float(previous_balance),
+        'new_balance': float(state['balance']),
+        'debt': float(state['debt']),
+        'late_fee': float(state['late_fee']),
+        'has_debt': has_debt,
+        'requires_payment': has_debt,
+        'success': True,
+        'transaction_id': crossing['event_id']
+    }
+
+
+def charge_tag_in_place(tag, crossings, created_at):
+    """
+    Modo in-place: los cruces de un tag se aplican en memoria y se escriben en
+    una transacción por bloque (update condicional del tag + puts de
+    transacciones e invoices). La condición sobre la versión del tag detecta
+    escrituras concurrentes; attribute_not_exists(ts) detecta re-entregas.
+    """
+    tag_id = tag['tag_id']
+    client = dynamodb.meta.client
+    remaining = list(crossings)
+    attempts = 0
+    while remaining:
+        block = remaining[:CROSSINGS_PER_TRANSACTION]
+        expected = tag_ledger.snapshot_of(tag)
+        final = apply_debits(expected, block, tag_id)
+        updated_at = datetime.utcnow().isoformat() + 'Z'
+        actions = [{
+            'Update': tag_versions.versioned({
+                'TableName': TAGS_TABLE,
+                'Key': {'tag_id': tag_id},
+                'UpdateExpression': 'SET balance = :balance, debt = :debt, late_fee = :late_fee, '
+                                    'last_updated = :last_updated, has_debt = :has_debt',
+                'ExpressionAttributeValues': {
+                    ':balance': final['balance'],
+                    ':debt': final['debt'],
+                    ':late_fee': final['late_fee'],
+                    ':last_updated': updated_at,
+                    ':has_debt': final['debt'] > 0
+                }
+            }, expected=tag_versions.current(tag))
+        }]
+        owners = [None]
+        for crossing in block:
+            item = transaction_item(crossing, created_at)
+            actions.append({'Put': {
+                'TableName': TRANSACTIONS_TABLE,
+                'Item': item,
+                'ConditionExpression': 'attribute_not_exists(ts)'
+            }})
+            owners.append(crossing)
+            invoice = invoice_item(crossing, item, created_at)
+            if invoice:
+                crossing['invoice_id'] = invoice['invoice_id']
+                actions.append({'Put': {'TableName': INVOICES_TABLE, 'Item': invoice}})
+                owners.append(None)
+        try:
+            client.transact_write_items(TransactItems=actions)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            attempts += 1
+            if attempts >= MAX_TAG_ATTEMPTS:
+                raise
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+            # Cruces ya persistidos (re-entrega): el débito ya se aplicó con ellos
+            duplicated = {
+                owners[i]['event_id'] for i, code in enumerate(reasons)
+                if code == 'ConditionalCheckFailed' and owners[i] is not None
+            }
+            remaining = [c for c in remaining if c['event_id'] not in duplicated]
+            tag = dynamodb.Table(TAGS_TABLE).get_item(Key={'tag_id': tag_id}, ConsistentRead=True)['Item']
+            continue
+        tag = {**tag, **final, 'version': tag_versions.current(tag) + 1}
+        remaining = remaining[len(block):]
+        attempts = 0
+
+
+def charge_tag_per_crossing(tag, crossings):
+    """
+    Modos ledger y fragmentado: un débito por cruce con las funciones del
+    layer (append idempotente al ledger o débito en un shard).
+    """
+    tag_id = tag['tag_id']
+    if sharded_balance.is_sharded(tag):
+        for crossing in crossings:
+            amount = to_decimal(crossing['charge']['total'])
+            outcome = sharded_balance.debit(dynamodb, TAGS_TABLE, tag, amount, crossing['event_id'],
+                                            datetime.utcnow().isoformat() + 'Z')
+            debt = to_decimal(tag.get('debt', 0))
+            if not outcome.get('duplicate'):
+                debt += outcome['debt_added']
+            crossing['tag_balance_update'] = {
+                'tag_id': tag_id,
+                'previous_balance': float(outcome['previous_balance']),
+                'new_balance': float(outcome['new_balance']),
+                'debt': float(debt),
+                'late_fee': float(to_decimal(tag.get('late_fee', 0))),
+                'has_debt': outcome['debt_added'] > 0,
+                'requires_payment': outcome['debt_added'] > 0,
+                'success': True,
+                'transaction_id': crossing['event_id']
+            }
+        return
+    state = tag_ledger.read_state(dynamodb, tag)
+    for crossing in crossings:
+        state = apply_debits(state, [crossing], tag_id)
+        try:
+            tag_ledger.append(dynamodb, TAGS_TABLE, tag_id, 'debit',
+                              to_decimal(crossing['charge']['total']), reference=crossing['event_id'])
+        except tag_ledger.DuplicateEntry as e:
+            # Re-entrega: el débito ya estaba registrado. El resultado se
+            # reconstruye desde la entrada original y el estado se relee
+            # (ya la incluye, aunque la haya agregado otra invocación)
+            state = tag_ledger.read_state(dynamodb, tag)
+            before = tag_ledger.state_before(dynamodb, tag, e.entry)
+            if before is None:
+                # Ya compactada: igual que update_tag_balance, se reporta el estado actual
+                update = balance_update(tag_id, crossing, state['balance'], state, state['debt'] > 0)
+            else:
+                after = tag_ledger.apply_entry(before, e.entry)
+                update = balance_update(tag_id, crossing, before['balance'], after, after['debt'] > before['debt'])
+            update['duplicate'] = True
+            crossing['tag_balance_update'] = update
+
+
+def persist(crossings, created_at):
+    """Transacciones e invoices por cruce con batch_writer (puts idempotentes por llave)."""
+    with dynamodb.Table(TRANSACTIONS_TABLE).batch_writer(overwrite_by_pkeys=['placa', 'ts']) as transactions, \
+            dynamodb.Table(INVOICES_TABLE).batch_writer(overwrite_by_pkeys=['placa', 'invoice_id']) as invoices:
+        for crossing in crossings:
+            item = transaction_item(crossing, created_at)
+            transactions.put_item(Item=item)
+            invoice = invoice_item(crossing, item, created_at)
+            if invoice:
+                crossing['invoice_id'] = invoice['invoice_id']
+                invoices.put_item(Item=invoice)
+
+
+def append_period_invoices(crossings):
+    """Facturación por periodo: agrega los cruces cobrados al invoice abierto de la placa."""
+    for crossing in crossings:
+        if not settle_status(crossing)[2]:
+            continue
+        crossing['invoice_id'] = period_invoices.append(
+            dynamodb, INVOICES_TABLE, crossing['placa'], crossing['event_id'], crossing['charge'],
+            peaje_id=crossing['peaje_id'], timestamp=crossing['timestamp']
+        )
+
+
+def notify(crossings):
+    """Notificaciones SNS de los cruces registrados/tag con publish_batch (10 por llamada)."""
+    entries = []
+    for crossing in crossings:
+        if crossing['user_type'] == 'no_registrado':
+            continue
+        status, requires_payment, _ = settle_status(crossing)
+        event = {**crossing, 'status': status, 'requires_payment': requires_payment}
+        message, subject = notifications.build_notification_message(event)
+        entries.append({
+            'Id': str(len(entries)),
+            'Message': json.dumps(message, default=str),
+            'Subject': subject,
+            'MessageAttributes': notifications.message_attributes(event, message)
+        })
+    failed = 0
+    for start in range(0, len(entries), SNS_BATCH_SIZE):
+        try:
+            response = sns.publish_batch(TopicArn=SNS_TOPIC_ARN, PublishBatchRequestEntries=entries[start:start + SNS_BATCH_SIZE])
+            failed += len(response.get('Failed', []))
+        except ClientError as e:
+            # Igual que send_notification: una notificación fallida no reintenta el cobro
+            print(json.dumps({'error': 'Notification failed', 'message': str(e)}))
+            failed += len(entries[start:start + SNS_BATCH_SIZE])
+    return len(entries) - failed
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Procesa por lotes los cruces encolados en SQS, como alternativa a una
+    ejecución de Step Functions por cruce. Consume la cola estándar que llena la
+    regla de EventBridge (ProcessingMode=batch) y la cola FIFO en la que
+    ingest_webhook publica con un grupo por tag/placa (ProcessingMode=fifo):
+    1. Lee peajes, placas y tags del lote con batch_get_item
+    2. Valida y calcula el cobro de cada cruce en memoria
+    3. Descarta cruces ya persistidos (re-entregas de SQS) y copias del mismo event_id en el lote
+    4. Tags: agrupa por tag y aplica los débitos en orden (transacción por bloque en modo in-place)
+    5. Persiste el resto con batch_writer y publica notificaciones con publish_batch
+
+    Retorna batchItemFailures con los mensajes a reintentar; los cruces
+    inválidos se registran y se descartan.
+    """
+    records = event.get('Records', [])
+    parsed = parse_records(records)
+    created_at = datetime.utcnow().isoformat() + 'Z'
+
+    tag_ids = [d['tag_id'] for _, d in parsed if d.get('tag_id')]
+    found = batch_get({
+        TOLLS_CATALOG_TABLE: ('peaje_id', [d['peaje_id'] for _, d in parsed if d.get('peaje_id')]),
+        USERS_TABLE: ('placa', [d['placa'] for _, d in parsed if d.get('placa')]),
+        TAGS_TABLE: ('tag_id', tag_ids)
+    }, consistent_tables=(TAGS_TABLE,))
+    tags = found[TAGS_TABLE]
+    # Placas que solo llegan por tag_id
+    missing_users = [tags[t]['placa'] for t in tag_ids if t in tags and tags[t].get('placa') not in found[USERS_TABLE]]
+    if missing_users:
+        found[USERS_TABLE].update(batch_get({USERS_TABLE: ('placa', missing_users)})[USERS_TABLE])
+    corrected = resolve_plates([d for _, d in parsed], found[USERS_TABLE])
+
+    crossings = []
+    message_of = {}
+    # Mensajes repetidos dentro del lote (mismo event_id): se procesa solo el
+    # primero; dos puts del mismo item en un TransactWriteItems se rechazan
+    copies = {}
+    invalid = 0
+    for message_id, detail in parsed:
+        try:
+            crossing = classify(detail, found[TOLLS_CATALOG_TABLE], found[USERS_TABLE], tags, corrected)
+        except InvalidCrossing as e:
+            invalid += 1
+            print(json.dumps({'error': 'Validation failed', 'message': str(e), 'event': detail}, default=str))
+            reject(detail, str(e))
+            continue
+        if crossing['event_id'] in message_of:
+            copies.setdefault(crossing['event_id'], []).append(message_id)
+            continue
+        message_of[crossing['event_id']] = message_id
+        crossings.append(crossing)
+
+    duplicated = existing_transactions(crossings)
+    redelivered = [c for c in crossings if c['event_id'] in duplicated]
+    crossings = sorted((c for c in crossings if c['event_id'] not in duplicated), key=lambda c: c['event_id'])
+
+    failures = set()
+    processed = []
+    by_tag = {}
+    for crossing in crossings:
+        if crossing['user_type'] == 'tag':
+            by_tag.setdefault(crossing['tag_info']['tag_id'], []).append(crossing)
+
+    for tag_id, group in by_tag.items():
+        tag = tags[tag_id]
+        try:
+            if tag_ledger.TAG_LEDGER_ENABLED or sharded_balance.is_sharded(tag):
+                charge_tag_per_crossing(tag, group)
+                persist(group, created_at)
+            else:
+                charge_tag_in_place(tag, group, created_at)
+            processed.extend(group)
+        except (ClientError, ValueError) as e:
+            print(json.dumps({'error': 'Tag charge failed', 'tag_id': tag_id, 'message': str(e)}))
+            failures.update(message_of[c['event_id']] for c in group)
+
+    others = [c for c in crossings if c['user_type'] != 'tag']
+    try:
+        persist(others, created_at)
+        processed.extend(others)
+    except ClientError as e:
+        print(json.dumps({'error': 'Persistence failed', 'message': str(e)}))
+        failures.update(message_of[c['event_id']] for c in others)
+
+    if period_invoices.is_enabled():
+        for crossing in processed:
+            try:
+                append_period_invoices([crossing])
+            except (ClientError, ValueError) as e:
+                print(json.dumps({'error': 'Period invoice failed', 'event_id': crossing['event_id'], 'message': str(e)}))
+                failures.add(message_of[crossing['event_id']])
+
+    for crossing in redelivered:
+        try:
+            restore_invoice(crossing, duplicated[crossing['event_id']])
+        except (ClientError, ValueError) as e:
+            print(json.dumps({'error': 'Invoice restore failed', 'event_id': crossing['event_id'], 'message': str(e)}))
+            failures.add(message_of[crossing['event_id']])
+
+    notified = notify([c for c in processed if message_of[c['event_id']] not in failures])
+    # Las copias siguen la suerte del mensaje que se procesó
+    failures.update(m for event_id, ids in copies.items() if message_of[event_id] in failures for m in ids)
+    # Se notifican los cruces ya persistidos aunque su grupo FIFO se re-entregue
+    failures = with_fifo_order(records, failures)
+
+    print(json.dumps({
+        'records': len(parsed),
+        'processed': len(processed),
+        'duplicated': len(duplicated),
+        'batch_copies': sum(len(ids) for ids in copies.values()),
+        'invalid': invalid,
+        'failed': len(failures),
+        'tags': len(by_tag),
+        'notified': notified,
+        'status': 'batch_processed'
+    }))
+
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failures)]}
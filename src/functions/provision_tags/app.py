@@ -0,0 +1,335 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+import cache_versions
+import classification_cache
+import ddb_tracer
+import http_encoding
+import tag_ledger
+from botocore.exceptions import ClientError
+
+dynamodb = ddb_tracer.resource()
+
+TAGS_TABLE = os.environ.get('TAGS_TABLE')
+USERS_TABLE = os.environ.get('USERS_TABLE')
+MAX_BULK_TAGS = int(os.environ.get('MAX_BULK_TAGS', '1000'))
+PROVISION_WORKERS = int(os.environ.get('PROVISION_WORKERS', '8'))
+
+BATCH_GET_SIZE = 100
+# Límite de DynamoDB por TransactWriteItems
+TRANSACTION_MAX_ITEMS = 100
+MAX_TRANSACTION_ATTEMPTS = 3
+
+# Un recurso DynamoDB por hilo del pool (los recursos de boto3 no son
+# thread-safe; los clientes sí)
+_local = threading.local()
+
+
+def thread_dynamodb():
+    if not hasattr(_local, 'dynamodb'):
+        _local.dynamodb = ddb_tracer.resource()
+    return _local.dynamodb
+
+
+def build_response(status_code, payload):
+    """Construye respuesta HTTP estándar."""
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(payload, default=str)
+    }
+
+
+def to_decimal(value):
+    """Convierte a Decimal para compatibilidad con DynamoDB (None si no es un número)."""
+    if value is None:
+        return Decimal('0.00')
+    if isinstance(value, Decimal):
+        return value
+    try:
+        return Decimal(str(value))
+    except Exception:
+        return None
+
+
+def parse_items(items):
+    """
+    Valida la lista del body. Retorna (solicitudes válidas, rechazos); cada
+    solicitud lleva su posición (index) en la lista original.
+    """
+    requests, rejected = [], []
+    seen_tags, seen_placas = set(), set()
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        placa = str(item.get('placa') or '').strip()
+        tag_id = str(item.get('tag_id') or '').strip()
+        balance = to_decimal(item.get('balance', '0.00'))
+        status = item.get('status', 'active')
+        result = {'index': index, 'placa': placa or None, 'tag_id': tag_id or None}
+
+        if not placa or not tag_id:
+            rejected.append({**result, 'status': 'invalid', 'message': 'placa and tag_id are required'})
+        elif balance is None or balance < 0:
+            rejected.append({**result, 'status': 'invalid', 'message': 'balance must be a number >= 0'})
+        elif status not in ('active', 'inactive'):
+            rejected.append({**result, 'status': 'invalid', 'message': 'status must be active or inactive'})
+        elif tag_id in seen_tags or placa in seen_placas:
+            # Una transacción no puede escribir dos veces el mismo item
+            rejected.append({**result, 'status': 'duplicate_in_request'})
+        else:
+            seen_tags.add(tag_id)
+            seen_placas.add(placa)
+            requests.append({'index': index, 'placa': placa, 'tag_id': tag_id, 'balance': balance, 'status': status})
+    return requests, rejected
+
+
+def batch_get(requests):
+    """
+    batch_get_item sobre varias tablas a la vez (solo las llaves).
+    requests: {table_name: (key_name, [valores])}
+    Retorna {table_name: set(valores encontrados)}.
+    """
+    found = {table_name: set() for table_name in requests}
+    pending = [
+        (table_name, key_name, value)
+        for table_name, (key_name, values) in requests.items()
+        for value in sorted(set(values))
+    ]
+    for start in range(0, len(pending), BATCH_GET_SIZE):
+        request = {}
+        for table_name, key_name, value in pending[start:start + BATCH_GET_SIZE]:
+            entry = request.setdefault(table_name, {'Keys': [], 'ProjectionExpression': key_name})
+            entry['Keys'].append({key_name: value})
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for table_name, items in response.get('Responses', {}).items():
+                key_name = requests[table_name][0]
+                found[table_name].update(item[key_name] for item in items)
+            request = response.get('UnprocessedKeys') or None
+    return found
+
+
+def provision_items(request, timestamp):
+    """
+    Escrituras de un tag dentro de TransactWriteItems, cada una con el motivo
+    de rechazo si su condición falla:
+    - Put en Tags condicionado a que el tag_id no exista.
+    - Update de UsersVehicles condicionado a que la placa exista.
+    - En modo ledger, la entrada 'opening' con el saldo inicial (mismo
+      resultado que POST /users/{placa}/tag, sin el append posterior).
+    """
+    tag_item = {
+        'tag_id': request['tag_id'],
+        'placa': request['placa'],
+        'status': request['status'],
+        'balance': request['balance'],
+        'debt': Decimal('0.00'),
+        'late_fee': Decimal('0.00'),
+        'has_debt': False,
+        'created_at': timestamp,
+        'last_updated': timestamp,
+        'version': 1
+    }
+    opening = []
+    if tag_ledger.TAG_LEDGER_ENABLED:
+        tag_item['balance'] = Decimal('0.00')
+        if request['balance'] > 0:
+            _, opening = tag_ledger.entry_puts(request['tag_id'], 'credit', request['balance'], 'opening', timestamp)
+
+    items = [
+        ({
+            'Put': {
+                'TableName': TAGS_TABLE,
+                'Item': tag_item,
+                'ConditionExpression': 'attribute_not_exists(tag_id)'
+            }
+        }, 'tag_exists'),
+        ({
+            'Update': {
+                'TableName': USERS_TABLE,
+                'Key': {'placa': request['placa']},
+                'UpdateExpression': 'SET tiene_tag = :tiene_tag, tag_id = :tag_id',
+                'ConditionExpression': 'attribute_exists(placa)',
+                'ExpressionAttributeValues': {':tiene_tag': True, ':tag_id': request['tag_id']}
+            }
+        }, 'placa_not_found')
+    ]
+    items.extend((put, 'tag_exists') for put in opening)
+    return items
+
+
+def chunk_requests(requests, timestamp):
+    """Agrupa los tags en transacciones de hasta TRANSACTION_MAX_ITEMS escrituras."""
+    chunks, current, size = [], [], 0
+    for request in requests:
+        items = provision_items(request, timestamp)
+        if current and size + len(items) > TRANSACTION_MAX_ITEMS:
+            chunks.append(current)
+            current, size = [], 0
+        current.append((request, items))
+        size += len(items)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def write_chunk(chunk):
+    """
+    Escribe un grupo de tags en una transacción. Si una condición falla la
+    transacción se cancela completa: los tags rechazados se reportan según
+    CancellationReasons y el resto se reintenta sin ellos.
+    Retorna {index: (status, message)}.
+    """
+    outcome = {}
+    client = dynamodb.meta.client
+    for _ in range(MAX_TRANSACTION_ATTEMPTS):
+        if not chunk:
+            return outcome
+        owners = [(request, reason) for request, items in chunk for _, reason in items]
+        try:
+            client.transact_write_items(TransactItems=[item for _, items in chunk for item, _ in items])
+            for request, _ in chunk:
+                outcome[request['index']] = ('created', None)
+            return outcome
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+            rejected = {}
+            for (request, reason), code in zip(owners, reasons):
+                if code == 'ConditionalCheckFailed':
+                    rejected.setdefault(request['index'], reason)
+            for index, reason in rejected.items():
+                outcome[index] = (reason, None)
+            chunk = [(request, items) for request, items in chunk if request['index'] not in rejected]
+    for request, _ in chunk:
+        outcome[request['index']] = ('failed', f'Transaction cancelled after {MAX_TRANSACTION_ATTEMPTS} attempts')
+    return outcome
+
+
+def bump_classification(placa, timestamp):
+    classification_cache.bump(thread_dynamodb(), placa, timestamp)
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Alta masiva de tags (onboarding de flotas).
+    Endpoint: POST /tags/bulk
+
+    Input (body):
+    {
+        "tags": [
+            {"placa": "P-123ABC", "tag_id": "TAG-101", "balance": 100.00},
+            {"placa": "P-456DEF", "tag_id": "TAG-102", "balance": 50.00, "status": "active"}
+        ]
+    }
+    Cada tag se crea igual que en POST /users/{placa}/tag, pero la existencia
+    de placas y tags se verifica con batch_get_item y las escrituras se hacen
+    en transacciones de hasta 50 tags (25 en modo ledger con saldo inicial).
+    El resultado es por tag.
+    """
+    try:
+        body = http_encoding.request_json(event)
+        items = body.get('tags') if isinstance(body, dict) else None
+
+        if not isinstance(items, list) or not items:
+            return build_response(400, {
+                'error': 'Missing required field',
+                'message': 'tags must be a non-empty list'
+            })
+        if len(items) > MAX_BULK_TAGS:
+            return build_response(400, {
+                'error': 'Too many tags',
+                'message': f'A lo sumo {MAX_BULK_TAGS} tags por petición'
+            })
+
+        started_at = datetime.utcnow()
+        timestamp = started_at.isoformat() + 'Z'
+        requests, results = parse_items(items)
+
+        # Existencia de placas y tags en una pasada de batch_get_item
+        found = batch_get({
+            USERS_TABLE: ('placa', [r['placa'] for r in requests]),
+            TAGS_TABLE: ('tag_id', [r['tag_id'] for r in requests])
+        })
+        writable = []
+        for request in requests:
+            result = {'index': request['index'], 'placa': request['placa'], 'tag_id': request['tag_id']}
+            if request['placa'] not in found[USERS_TABLE]:
+                results.append({**result, 'status': 'placa_not_found'})
+            elif request['tag_id'] in found[TAGS_TABLE]:
+                results.append({**result, 'status': 'tag_exists'})
+            else:
+                writable.append(request)
+
+        outcome = {}
+        for chunk in chunk_requests(writable, timestamp):
+            try:
+                outcome.update(write_chunk(chunk))
+            except ClientError as e:
+                for request, _ in chunk:
+                    outcome[request['index']] = ('failed', str(e))
+
+        created = []
+        for request in writable:
+            status, message = outcome[request['index']]
+            result = {'index': request['index'], 'placa': request['placa'], 'tag_id': request['tag_id'], 'status': status}
+            if status == 'created':
+                result['balance'] = float(request['balance'])
+                created.append(request['placa'])
+            if message:
+                result['message'] = message
+            results.append(result)
+        results.sort(key=lambda result: result['index'])
+
+        if created:
+            # Invalida las cachés negativas de ingest_webhook y la clasificación
+            # en caché de validate_transaction de cada placa
+            cache_versions.bump(dynamodb, cache_versions.TAGS_KEY, timestamp)
+            with ThreadPoolExecutor(max_workers=PROVISION_WORKERS) as executor:
+                list(executor.map(lambda placa: bump_classification(placa, timestamp), created))
+
+        counts = {}
+        for result in results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+
+        print(json.dumps({
+            'requested': len(items),
+            'counts': counts,
+            'elapsed_seconds': round((datetime.utcnow() - started_at).total_seconds(), 3),
+            'status': 'tags_provisioned'
+        }))
+
+        return build_response(200, {
+            'requested': len(items),
+            'created': len(created),
+            'counts': counts,
+            'results': results
+        })
+
+    except ClientError as e:
+        error_msg = f'DynamoDB error: {str(e)}'
+        print(json.dumps({
+            'error': 'Bulk provisioning failed',
+            'message': error_msg
+        }))
+        return build_response(500, {
+            'error': 'Internal server error',
+            'message': error_msg
+        })
+    except Exception as e:
+        print(json.dumps({
+            'error': 'Bulk provisioning failed',
+            'message': str(e)
+        }))
+        return build_response(500, {
+            'error': 'Internal server error',
+            'message': str(e)
+        })
@@ -1,14 +1,29 @@
 import json
 import os
 from boto3.dynamodb.conditions import Key
-import boto3
+import ddb_tracer
+import event_ids
+import http_encoding
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = ddb_tracer.resource()
 
 TRANSACTIONS_TABLE = os.environ.get('TRANSACTIONS_TABLE')
 INVOICES_TABLE = os.environ.get('INVOICES_TABLE')
 
 
+def build_response(event, status_code, payload):
+    """Respuesta JSON comprimida según Accept-Encoding (http_encoding)."""
+    return http_encoding.encode_response({
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(payload, default=str)
+    }, event)
+
+
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Endpoint para consultar historial de pagos e invoices por placa.
@@ -23,22 +38,14 @@ def lambda_handler(event, context):
         placa = path_params.get('placa')
         
         if not placa:
-            return {
-                'statusCode': 400,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': 'Missing placa parameter'
-                })
-            }
+            return build_response(event, 400, {
+                'error': 'Missing placa parameter'
+            })
         
         # Determinar qué tabla consultar según el path
         if '/payments/' in path or '/history/transactions/' in path:
             # Consultar transacciones
             table = dynamodb.Table(TRANSACTIONS_TABLE)
-            index_name = 'placa-timestamp-index'
             
             # Obtener query parameters para paginación y filtros
             query_params = event.get('queryStringParameters') or {}
@@ -46,10 +53,27 @@ def lambda_handler(event, context):
             last_evaluated_key = query_params.get('last_key')
             status_filter = query_params.get('status')  # Filtrar por status: pending, completed
             requires_payment_filter = query_params.get('requires_payment')  # Filtrar por requires_payment: true, false
+            date_from = query_params.get('from')  # Rango de fechas del cruce (ISO 8601)
+            date_to = query_params.get('to')
+            
+            # ts (RANGE key) es ordenable por tiempo del cruce: el historial y el
+            # rango de fechas se resuelven sobre la tabla base, sin GSI
+            key_condition = Key('placa').eq(placa)
+            try:
+                if date_from and date_to:
+                    key_condition &= Key('ts').between(event_ids.range_start(date_from), event_ids.range_end(date_to))
+                elif date_from:
+                    key_condition &= Key('ts').gte(event_ids.range_start(date_from))
+                elif date_to:
+                    key_condition &= Key('ts').lte(event_ids.range_end(date_to))
+            except ValueError:
+                return build_response(event, 400, {
+                    'error': 'Invalid date range',
+                    'message': 'from/to deben ser timestamps ISO 8601'
+                })
             
             scan_kwargs = {
-                'IndexName': index_name,
-                'KeyConditionExpression': Key('placa').eq(placa),
+                'KeyConditionExpression': key_condition,
                 'Limit': limit,
                 'ScanIndexForward': False  # Orden descendente (más recientes primero)
             }
@@ -80,20 +104,13 @@ def lambda_handler(event, context):
             
             response = table.query(**scan_kwargs)
             
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'placa': placa,
-                    'type': 'payments',
-                    'count': len(response['Items']),
-                    'items': response['Items'],
-                    'last_evaluated_key': response.get('LastEvaluatedKey')
-                }, default=str)
-            }
+            return build_response(event, 200, {
+                'placa': placa,
+                'type': 'payments',
+                'count': len(response['Items']),
+                'items': response['Items'],
+                'last_evaluated_key': response.get('LastEvaluatedKey')
+            })
             
         elif '/invoices/' in path:
             # Consultar invoices
@@ -116,31 +133,17 @@ def lambda_handler(event, context):
             
             response = table.query(**scan_kwargs)
             
-            return {
-                'statusCode': 200,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'placa': placa,
-                    'type': 'invoices',
-                    'count': len(response['Items']),
-                    'items': response['Items'],
-                    'last_evaluated_key': response.get('LastEvaluatedKey')
-                }, default=str)
-            }
+            return build_response(event, 200, {
+                'placa': placa,
+                'type': 'invoices',
+                'count': len(response['Items']),
+                'items': response['Items'],
+                'last_evaluated_key': response.get('LastEvaluatedKey')
+            })
         else:
-            return {
-                'statusCode': 404,
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                },
-                'body': json.dumps({
-                    'error': 'Invalid endpoint'
-                })
-            }
+            return build_response(event, 404, {
+                'error': 'Invalid endpoint'
+            })
             
     except Exception as e:
         print(json.dumps({
@@ -148,15 +151,8 @@ def lambda_handler(event, context):
             'message': str(e),
             'event': event
         }))
-        return {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({
-                'error': 'Internal server error',
-                'message': str(e)
-            })
-        }
+        return build_response(event, 500, {
+            'error': 'Internal server error',
+            'message': str(e)
+        })
 
@@ -0,0 +1,108 @@
+import json
+from datetime import datetime, timedelta
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+import ddb_tracer
+import failed_crossings
+
+dynamodb = ddb_tracer.resource()
+
+DEFAULT_WINDOW_HOURS = 24
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 500
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return str(value)
+
+
+def build_response(status_code, payload):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(payload, default=json_default)
+    }
+
+
+def rejection_row(item):
+    crossing = item.get('crossing') or {}
+    return {
+        'event_id': item['event_id'],
+        'placa': item.get('placa'),
+        'tag_id': crossing.get('tag_id'),
+        'peaje_id': item.get('peaje_id'),
+        'timestamp': crossing.get('timestamp'),
+        'reason': item.get('rejection_reason'),
+        'rejected_at': item.get('failed_at')
+    }
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Flujo de rechazos por peaje (cruces aceptados con 202 que la validación
+    asíncrona descartó).
+    GET /tolls/{peaje_id}/rejections?since=2025-11-12T00:00:00Z&limit=100&last_key=...
+
+    Consulta el índice disperso rejections-index de FailedCrossings en orden
+    de rechazo. La plaza consulta con since = último rejected_at recibido, o
+    continúa con last_key. Default: últimas 24 horas.
+    """
+    try:
+        path_params = event.get('pathParameters') or {}
+        peaje_id = path_params.get('peaje_id')
+        if not peaje_id:
+            return build_response(400, {'error': 'Missing peaje_id parameter'})
+
+        query_params = event.get('queryStringParameters') or {}
+        since = query_params.get('since') or (
+            datetime.utcnow() - timedelta(hours=DEFAULT_WINDOW_HOURS)
+        ).isoformat() + 'Z'
+        try:
+            limit = int(query_params.get('limit', DEFAULT_LIMIT))
+            last_key = json.loads(query_params['last_key']) if query_params.get('last_key') else None
+        except ValueError:
+            return build_response(400, {
+                'error': 'Invalid parameters',
+                'message': 'limit debe ser un entero y last_key el last_evaluated_key de una respuesta anterior'
+            })
+        if not 1 <= limit <= MAX_LIMIT:
+            return build_response(400, {
+                'error': 'Invalid parameters',
+                'message': f'limit debe estar entre 1 y {MAX_LIMIT}'
+            })
+
+        query_kwargs = {
+            'IndexName': failed_crossings.REJECTIONS_INDEX,
+            'KeyConditionExpression': Key('rejected_peaje_id').eq(peaje_id) & Key('failed_at').gt(since),
+            'ScanIndexForward': True,
+            'Limit': limit
+        }
+        if last_key:
+            query_kwargs['ExclusiveStartKey'] = last_key
+        response = dynamodb.Table(failed_crossings.FAILED_CROSSINGS_TABLE).query(**query_kwargs)
+        rejections = [rejection_row(item) for item in response.get('Items', [])]
+
+        return build_response(200, {
+            'peaje_id': peaje_id,
+            'since': since,
+            'rejections': rejections,
+            'count': len(rejections),
+            'last_evaluated_key': response.get('LastEvaluatedKey')
+        })
+
+    except Exception as e:
+        print(json.dumps({
+            'error': 'Internal server error',
+            'message': str(e),
+            'event': event
+        }))
+        return build_response(500, {
+            'error': 'Internal server error',
+            'message': str(e)
+        })
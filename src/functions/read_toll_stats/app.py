@@ -0,0 +1,99 @@
+import json
+import os
+from datetime import datetime, timedelta
+import ddb_tracer
+import toll_aggregates
+
+dynamodb = ddb_tracer.resource()
+
+DEFAULT_WINDOW_HOURS = 24
+
+
+def json_number(value):
+    """Serializa Decimal: enteros como int (conteos), el resto como float."""
+    if value == value.to_integral_value():
+        return int(value)
+    return float(value)
+
+
+def build_response(status_code, payload):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(payload, default=json_number)
+    }
+
+
+def hour_row(hour, item):
+    """Fila de una hora con todos los contadores (cero si no hubo cruces)."""
+    row = toll_aggregates.empty_counters()
+    for name in row:
+        if item and name in item:
+            row[name] = item[name]
+    row['hour'] = hour
+    return row
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Endpoint de estadísticas por peaje y hora.
+    GET /tolls/{peaje_id}/stats?from=2025-11-12T00:00:00Z&to=2025-11-12T23:59:59Z
+    
+    Lee los agregados de aggregate_toll_stats: una clave por hora del rango
+    (batch_get_item), sin consultar Transactions. Default: últimas 24 horas.
+    """
+    try:
+        path_params = event.get('pathParameters') or {}
+        peaje_id = path_params.get('peaje_id')
+        if not peaje_id:
+            return build_response(400, {'error': 'Missing peaje_id parameter'})
+        
+        query_params = event.get('queryStringParameters') or {}
+        now = datetime.utcnow()
+        date_to = query_params.get('to') or now.isoformat() + 'Z'
+        date_from = query_params.get('from') or (now - timedelta(hours=DEFAULT_WINDOW_HOURS - 1)).isoformat() + 'Z'
+        
+        try:
+            hours = toll_aggregates.hours_between(date_from, date_to)
+        except ValueError:
+            return build_response(400, {
+                'error': 'Invalid date range',
+                'message': 'from/to deben ser timestamps ISO 8601'
+            })
+        if not hours or len(hours) > toll_aggregates.MAX_HOURS:
+            return build_response(400, {
+                'error': 'Invalid date range',
+                'message': f'El rango debe cubrir entre 1 y {toll_aggregates.MAX_HOURS} horas'
+            })
+        
+        items = toll_aggregates.read(dynamodb, peaje_id, hours)
+        rows = [hour_row(hour, items.get(hour)) for hour in hours]
+        
+        totals = toll_aggregates.empty_counters()
+        for row in rows:
+            for name in totals:
+                totals[name] += row[name]
+        
+        return build_response(200, {
+            'peaje_id': peaje_id,
+            'from_hour': hours[0],
+            'to_hour': hours[-1],
+            'hours_with_traffic': len(items),
+            'totals': totals,
+            'hours': rows
+        })
+    
+    except Exception as e:
+        print(json.dumps({
+            'error': 'Internal server error',
+            'message': str(e),
+            'event': event
+        }))
+        return build_response(500, {
+            'error': 'Internal server error',
+            'message': str(e)
+        })
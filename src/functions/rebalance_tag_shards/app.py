@@ -0,0 +1,99 @@
+import json
+import os
+from datetime import datetime
+import ddb_tracer
+import sharded_balance
+import tag_versions
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+
+dynamodb = ddb_tracer.resource()
+
+TAGS_TABLE = os.environ.get('TAGS_TABLE')
+TAG_SHARDS_TABLE = os.environ.get('TAG_SHARDS_TABLE')
+
+
+def sharded_tag_ids():
+    """
+    Lista los tags con shards (la tabla de shards solo contiene tags de flota).
+    Los marcadores de débito (shard negativo) no cuentan.
+    """
+    table = dynamodb.Table(TAG_SHARDS_TABLE)
+    kwargs = {
+        'ProjectionExpression': 'tag_id',
+        'FilterExpression': Attr('shard').gte(0)
+    }
+    tag_ids = set()
+    while True:
+        response = table.scan(**kwargs)
+        tag_ids.update(item['tag_id'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return sorted(tag_ids)
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def refresh_cached_total(tag_id, total):
+    """
+    Publica el total en el item de Tags para lectores que no suman shards.
+    Condicionado a la versión leída (reintenta si otro escritor se adelantó);
+    si el tag dejó el modo fragmentado no escribe.
+    """
+    tags_table = dynamodb.Table(TAGS_TABLE)
+    for _ in range(tag_versions.MAX_VERSION_ATTEMPTS):
+        tag = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item')
+        if not tag or not sharded_balance.is_sharded(tag):
+            return False
+        try:
+            tags_table.update_item(**tag_versions.versioned({
+                'Key': {'tag_id': tag_id},
+                'UpdateExpression': 'SET balance = :balance, balance_cached_at = :cached_at',
+                'ConditionExpression': 'attribute_exists(balance_shards)',
+                'ExpressionAttributeValues': {
+                    ':balance': total,
+                    ':cached_at': datetime.utcnow().isoformat() + 'Z'
+                }
+            }, expected=tag_versions.current(tag)))
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    raise tag_versions.VersionConflict(tag_id, tag_versions.current(tag))
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Rebalancea los shards de los tags de flota: reparte el total en partes
+    iguales para que ningún shard se quede seco y refresca el total cacheado
+    en Tags.balance.
+    
+    Triggers:
+    - EventBridge Schedule (cada 5 minutos)
+    - Invocación directa: {"tag_ids": ["TAG-BUS-01"]}
+    """
+    tag_ids = event.get('tag_ids') or sharded_tag_ids()
+    rebalanced = []
+    conflicts = []
+    
+    for tag_id in tag_ids:
+        total = sharded_balance.rebalance(dynamodb, tag_id)
+        if total is None:
+            # Un débito concurrente cambió algún shard: se reintenta en la próxima ejecución
+            conflicts.append(tag_id)
+            continue
+        try:
+            refresh_cached_total(tag_id, total)
+        except tag_versions.VersionConflict:
+            # Tag muy escrito: el total cacheado se publica en la próxima ejecución
+            conflicts.append(tag_id)
+            continue
+        rebalanced.append({'tag_id': tag_id, 'balance': float(total)})
+    
+    print(json.dumps({
+        'tags': len(tag_ids),
+        'rebalanced': len(rebalanced),
+        'conflicts': conflicts,
+        'status': 'rebalanced'
+    }))
+    
+    return {'rebalanced': rebalanced, 'conflicts': conflicts}
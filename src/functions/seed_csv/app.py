@@ -1,10 +1,14 @@
 import json
 import os
 import csv
+from datetime import datetime
 from decimal import Decimal
-import boto3
+import cache_versions
+import classification_cache
+import ddb_tracer
+import seed_sync
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = ddb_tracer.resource()
 
 USERS_TABLE = os.environ.get('USERS_TABLE')
 TAGS_TABLE = os.environ.get('TAGS_TABLE')
@@ -32,11 +36,45 @@ def to_bool(value):
     return False
 
 
+def user_item_from_row(row):
+    """Item de UsersVehicles a partir de una fila de clientes.csv."""
+    return {
+        'placa': row.get('placa', '').strip(),
+        'nombre': row.get('nombre', '').strip(),
+        'email': row.get('email', '').strip() or None,
+        'telefono': row.get('telefono', '').strip() or None,
+        'tipo_usuario': row.get('tipo_usuario', 'no_registrado').strip(),
+        'tiene_tag': to_bool(row.get('tiene_tag', 'false')),
+        'tag_id': row.get('tag_id', '').strip() or None,
+        'saldo_disponible': to_decimal(row.get('saldo_disponible', '0.00')),
+        'created_at': '2025-01-01T00:00:00Z'
+    }
+
+
+def tag_item_from_user(user_item):
+    """Item de Tags del usuario (saldo inicial = saldo_disponible)."""
+    return {
+        'tag_id': user_item['tag_id'],
+        'placa': user_item['placa'],
+        'status': 'active',
+        'balance': user_item['saldo_disponible'],
+        'debt': Decimal('0.00'),
+        'late_fee': Decimal('0.00'),
+        'created_at': '2025-01-01T00:00:00Z',
+        'last_updated': '2025-01-01T00:00:00Z'
+    }
+
+
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Función para poblar las tablas DynamoDB con datos iniciales desde CSV.
     Lee el archivo clientes.csv y carga los datos en UsersVehicles y Tags.
+    
+    Con {"mode": "sync"} (opcional "segments") solo escribe las filas nuevas o
+    cambiadas y conserva los campos vivos (balance, deuda, saldo_disponible).
     """
+    event = event or {}
     try:
         users_table = dynamodb.Table(USERS_TABLE)
         tags_table = dynamodb.Table(TAGS_TABLE)
@@ -60,8 +98,16 @@ def lambda_handler(event, context):
         # Si no se encuentra, usar datos de ejemplo
         if not csv_path:
             print("CSV file not found in any expected location, using sample data")
+            if event.get('mode') == 'sync':
+                return sync_data(SAMPLE_USERS, event.get('segments'))
             return seed_sample_data(users_table, tags_table, tolls_table)
         
+        # Modo sync: solo filas nuevas o cambiadas, sin pisar balances
+        if event.get('mode') == 'sync':
+            with open(csv_path, 'r', encoding='utf-8') as csvfile:
+                users = [user_item_from_row(row) for row in csv.DictReader(csvfile) if row.get('placa', '').strip()]
+            return sync_data(users, event.get('segments'))
+        
         users_count = 0
         tags_count = 0
         
@@ -75,17 +121,7 @@ def lambda_handler(event, context):
                     continue
                 
                 # Preparar datos del usuario
-                user_item = {
-                    'placa': placa,
-                    'nombre': row.get('nombre', '').strip(),
-                    'email': row.get('email', '').strip() or None,
-                    'telefono': row.get('telefono', '').strip() or None,
-                    'tipo_usuario': row.get('tipo_usuario', 'no_registrado').strip(),
-                    'tiene_tag': to_bool(row.get('tiene_tag', 'false')),
-                    'tag_id': row.get('tag_id', '').strip() or None,
-                    'saldo_disponible': to_decimal(row.get('saldo_disponible', '0.00')),
-                    'created_at': '2025-01-01T00:00:00Z'
-                }
+                user_item = user_item_from_row(row)
                 
                 # Guardar usuario
                 users_table.put_item(Item=user_item)
@@ -93,17 +129,7 @@ def lambda_handler(event, context):
                 
                 # Si tiene tag, crear/actualizar registro en tabla Tags
                 if user_item['tiene_tag'] and user_item['tag_id']:
-                    tag_item = {
-                        'tag_id': user_item['tag_id'],
-                        'placa': placa,
-                        'status': 'active',
-                        'balance': user_item['saldo_disponible'],
-                        'debt': Decimal('0.00'),
-                        'late_fee': Decimal('0.00'),
-                        'created_at': '2025-01-01T00:00:00Z',
-                        'last_updated': '2025-01-01T00:00:00Z'
-                    }
-                    tags_table.put_item(Item=tag_item)
+                    tags_table.put_item(Item=tag_item_from_user(user_item))
                     tags_count += 1
         
         # Cargar catálogo de peajes
@@ -134,31 +160,58 @@ def lambda_handler(event, context):
         }
 
 
+# Datos de ejemplo (sin clientes.csv) y catálogo de peajes del seed
+SAMPLE_TOLLS = [
+    {
+        'peaje_id': 'PEAJE_ZONA10',
+        'nombre': 'Peaje Zona 10',
+        'ubicacion': 'Ciudad de Guatemala',
+        'tarifa_base': to_decimal('5.00'),
+        'tarifa_tag': to_decimal('4.50'),
+        'tarifa_registrado': to_decimal('5.00'),
+        'tarifa_no_registrado': to_decimal('7.00')
+    },
+    {
+        'peaje_id': 'PEAJE_CA1',
+        'nombre': 'Peaje CA-1',
+        'ubicacion': 'Carretera CA-1',
+        'tarifa_base': to_decimal('8.00'),
+        'tarifa_tag': to_decimal('7.20'),
+        'tarifa_registrado': to_decimal('8.00'),
+        'tarifa_no_registrado': to_decimal('10.00')
+    }
+]
+
+SAMPLE_USERS = [
+    {
+        'placa': 'P-123ABC',
+        'nombre': 'Juan Pérez',
+        'email': 'juan.perez@example.com',
+        'telefono': '50212345678',
+        'tipo_usuario': 'registrado',
+        'tiene_tag': False,
+        'tag_id': None,
+        'saldo_disponible': to_decimal('100.00'),
+        'created_at': '2025-01-01T00:00:00Z'
+    },
+    {
+        'placa': 'P-456DEF',
+        'nombre': 'María González',
+        'email': 'maria.gonzalez@example.com',
+        'telefono': '50298765432',
+        'tipo_usuario': 'registrado',
+        'tiene_tag': True,
+        'tag_id': 'TAG-001',
+        'saldo_disponible': to_decimal('250.00'),
+        'created_at': '2025-01-01T00:00:00Z'
+    }
+]
+
+
 def seed_tolls_catalog(tolls_table):
     """Carga el catálogo de peajes."""
-    sample_tolls = [
-        {
-            'peaje_id': 'PEAJE_ZONA10',
-            'nombre': 'Peaje Zona 10',
-            'ubicacion': 'Ciudad de Guatemala',
-            'tarifa_base': to_decimal('5.00'),
-            'tarifa_tag': to_decimal('4.50'),
-            'tarifa_registrado': to_decimal('5.00'),
-            'tarifa_no_registrado': to_decimal('7.00')
-        },
-        {
-            'peaje_id': 'PEAJE_CA1',
-            'nombre': 'Peaje CA-1',
-            'ubicacion': 'Carretera CA-1',
-            'tarifa_base': to_decimal('8.00'),
-            'tarifa_tag': to_decimal('7.20'),
-            'tarifa_registrado': to_decimal('8.00'),
-            'tarifa_no_registrado': to_decimal('10.00')
-        }
-    ]
-    
     tolls_count = 0
-    for toll in sample_tolls:
+    for toll in SAMPLE_TOLLS:
         tolls_table.put_item(Item=toll)
         tolls_count += 1
     
@@ -167,31 +220,6 @@ def seed_tolls_catalog(tolls_table):
 
 def seed_sample_data(users_table, tags_table, tolls_table):
     """Carga datos de ejemplo si no se encuentra el CSV."""
-    sample_users = [
-        {
-            'placa': 'P-123ABC',
-            'nombre': 'Juan Pérez',
-            'email': 'juan.perez@example.com',
-            'telefono': '50212345678',
-            'tipo_usuario': 'registrado',
-            'tiene_tag': False,
-            'tag_id': None,
-            'saldo_disponible': to_decimal('100.00'),
-            'created_at': '2025-01-01T00:00:00Z'
-        },
-        {
-            'placa': 'P-456DEF',
-            'nombre': 'María González',
-            'email': 'maria.gonzalez@example.com',
-            'telefono': '50298765432',
-            'tipo_usuario': 'registrado',
-            'tiene_tag': True,
-            'tag_id': 'TAG-001',
-            'saldo_disponible': to_decimal('250.00'),
-            'created_at': '2025-01-01T00:00:00Z'
-        }
-    ]
-    
     sample_tags = [
         {
             'tag_id': 'TAG-001',
@@ -206,7 +234,7 @@ def seed_sample_data(users_table, tags_table, tolls_table):
     ]
     
     users_count = 0
-    for user in sample_users:
+    for user in SAMPLE_USERS:
         users_table.put_item(Item=user)
         users_count += 1
     
@@ -226,3 +254,48 @@ def seed_sample_data(users_table, tags_table, tolls_table):
             'tolls_inserted': tolls_count
         })
     }
+
+
+def sync_data(users, segments=None):
+    """
+    Modo sync: escribe solo los usuarios, tags y peajes nuevos o cambiados
+    respecto a la huella guardada en cada item (seed_sync). Los tags nuevos
+    inician con saldo_disponible; en los existentes nunca se tocan balance,
+    deuda ni status.
+    """
+    tags = [
+        {**tag_item_from_user(user), 'has_debt': False, 'version': 1}
+        for user in users if user['tiene_tag'] and user['tag_id']
+    ]
+    users_result = seed_sync.sync_items(dynamodb, USERS_TABLE, 'placa', users,
+                                        insert_only=seed_sync.USERS_INSERT_ONLY, segments=segments)
+    tags_result = seed_sync.sync_items(dynamodb, TAGS_TABLE, 'tag_id', tags,
+                                       insert_only=seed_sync.TAGS_INSERT_ONLY, touch='last_updated',
+                                       versioned=True, segments=segments)
+    tolls_result = seed_sync.sync_items(dynamodb, TOLLS_CATALOG_TABLE, 'peaje_id', SAMPLE_TOLLS,
+                                        insert_only=seed_sync.TOLLS_INSERT_ONLY, segments=segments)
+
+    # Invalida cachés solo de lo que cambió (en modo completo vencen por TTL)
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+    changed_tags = tags_result['inserted'] + tags_result['updated']
+    if changed_tags:
+        cache_versions.bump(dynamodb, cache_versions.TAGS_KEY, timestamp)
+    if tolls_result['inserted'] or tolls_result['updated']:
+        cache_versions.bump(dynamodb, cache_versions.TOLLS_KEY, timestamp)
+    tag_placas = {tag['tag_id']: tag['placa'] for tag in tags}
+    placas = set(users_result['inserted'] + users_result['updated'])
+    placas.update(tag_placas[tag_id] for tag_id in changed_tags)
+    for placa in sorted(placas):
+        classification_cache.bump(dynamodb, placa, timestamp)
+
+    summary = {}
+    for name, result in (('users', users_result), ('tags', tags_result), ('tolls', tolls_result)):
+        summary[f'{name}_inserted'] = len(result['inserted'])
+        summary[f'{name}_updated'] = len(result['updated'])
+        summary[f'{name}_unchanged'] = result['unchanged']
+    print(json.dumps({**summary, 'status': 'seed_synced'}))
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'message': 'Data synced successfully', **summary})
+    }
@@ -0,0 +1,158 @@
+import json
+import os
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+import ddb_tracer
+import sharded_balance
+import tag_ledger
+
+dynamodb = ddb_tracer.resource()
+deserializer = TypeDeserializer()
+
+USERS_TABLE = os.environ.get('USERS_TABLE')
+TAGS_TABLE = os.environ.get('TAGS_TABLE')
+
+# Atributos de Tags que cambian el balance visible para el usuario
+BALANCE_ATTRIBUTES = ('balance', 'placa', 'ledger_watermark', 'balance_shards')
+
+
+def image(record, name):
+    raw = record.get('dynamodb', {}).get(name)
+    if not raw:
+        return None
+    return {key: deserializer.deserialize(value) for key, value in raw.items()}
+
+
+def latest_by_placa(records):
+    """
+    Coalesce los cambios del batch: por placa solo queda la última imagen del
+    tag (los registros de un tag llegan en orden). Retorna
+    {placa: (tag, [sequence_numbers])}.
+    """
+    latest = {}
+    for record in records:
+        if record.get('eventName') not in ('INSERT', 'MODIFY'):
+            continue
+        new = image(record, 'NewImage')
+        if not new or not new.get('placa'):
+            continue
+        old = image(record, 'OldImage') or {}
+        sequence_number = record.get('dynamodb', {}).get('SequenceNumber')
+        if record['eventName'] == 'MODIFY' and all(old.get(a) == new.get(a) for a in BALANCE_ATTRIBUTES):
+            continue
+        _, sequence_numbers = latest.get(new['placa'], (None, []))
+        latest[new['placa']] = (new, sequence_numbers + [sequence_number])
+    return latest
+
+
+def changed_tags(records):
+    """
+    Tags con movimientos en TagLedger o TagBalanceShards (streams KEYS_ONLY):
+    en modo ledger y en tags fragmentados el item de Tags no cambia con cada
+    débito o recarga. Los marcadores de idempotencia (entry_id 'R#', shards
+    negativos) no mueven el balance. Retorna {tag_id: [sequence_numbers]}.
+    """
+    changed = {}
+    for record in records:
+        if record.get('eventName') not in ('INSERT', 'MODIFY'):
+            continue
+        keys = image(record, 'Keys') or {}
+        if not keys.get('tag_id'):
+            continue
+        entry_id = keys.get('entry_id')
+        if entry_id is not None and not entry_id.startswith(tag_ledger.ENTRY_PREFIX):
+            continue
+        shard = keys.get('shard')
+        if shard is not None and shard < 0:
+            continue
+        sequence_number = record.get('dynamodb', {}).get('SequenceNumber')
+        changed.setdefault(keys['tag_id'], []).append(sequence_number)
+    return changed
+
+
+def sync(placa, tag):
+    """
+    Refleja el balance del tag en UsersVehicles.saldo_disponible. Last-writer-wins
+    por last_updated del tag: una imagen más vieja que la ya reflejada se descarta.
+    Retorna False si fue descartada.
+    """
+    balance = tag_ledger.read_state(dynamodb, tag)['balance']
+    version = tag.get('last_updated') or ''
+    try:
+        dynamodb.Table(USERS_TABLE).update_item(
+            Key={'placa': placa},
+            UpdateExpression='SET saldo_disponible = :balance, saldo_synced_at = :version',
+            ConditionExpression='attribute_exists(placa) AND '
+                                '(attribute_not_exists(saldo_synced_at) OR saldo_synced_at <= :version)',
+            ExpressionAttributeValues={':balance': balance, ':version': version}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Mantiene UsersVehicles.saldo_disponible sincronizado con el balance de Tags
+    fuera del camino del cruce (update_tag_balance hace una sola escritura).
+    
+    Trigger: DynamoDB Streams de Tags (NEW_AND_OLD_IMAGES), TagLedger y
+    TagBalanceShards (KEYS_ONLY; en modo ledger y en tags fragmentados los
+    débitos no modifican el item de Tags).
+    Varios débitos del mismo tag en un batch producen una sola escritura a
+    UsersVehicles. Reporta batchItemFailures con los registros de las placas
+    que fallaron (la sincronización es idempotente).
+    """
+    records = event.get('Records', [])
+    tag_records, keyed_records = [], []
+    for record in records:
+        # Solo el stream de Tags trae imágenes
+        (tag_records if 'NewImage' in record.get('dynamodb', {}) else keyed_records).append(record)
+    latest = latest_by_placa(tag_records)
+    failures = []
+    synced = 0
+    stale = 0
+
+    # Entradas del ledger y shards: se relee el tag (su imagen no viene en el stream)
+    tags_table = dynamodb.Table(TAGS_TABLE)
+    for tag_id, sequence_numbers in changed_tags(keyed_records).items():
+        try:
+            tag = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item')
+        except ClientError as e:
+            print(json.dumps({'error': 'Balance sync failed', 'tag_id': tag_id, 'message': str(e)}))
+            failures.extend({'itemIdentifier': seq} for seq in sequence_numbers if seq)
+            continue
+        if not tag or not tag.get('placa'):
+            continue
+        # Suma de shards sin el total cacheado en el contenedor
+        sharded_balance.invalidate(tag_id)
+        _, previous = latest.get(tag['placa'], (None, []))
+        latest[tag['placa']] = (tag, previous + sequence_numbers)
+    
+    for placa, (tag, sequence_numbers) in latest.items():
+        try:
+            if sync(placa, tag):
+                synced += 1
+            else:
+                stale += 1
+        except Exception as e:
+            print(json.dumps({
+                'error': 'Balance sync failed',
+                'placa': placa,
+                'message': str(e)
+            }))
+            failures.extend({'itemIdentifier': seq} for seq in sequence_numbers if seq)
+    
+    print(json.dumps({
+        'records': len(records),
+        'placas': len(latest),
+        'synced': synced,
+        'stale': stale,
+        'failed': len(latest) - synced - stale,
+        'status': 'synced'
+    }))
+    
+    return {'batchItemFailures': failures}
@@ -0,0 +1,158 @@
+import json
+import os
+import boto3
+import ddb_tracer
+import http_encoding
+import notifications
+import tag_ledger
+import tag_topups
+from botocore.exceptions import ClientError
+
+dynamodb = ddb_tracer.resource()
+sns = boto3.client('sns')
+
+TAGS_TABLE = os.environ.get('TAGS_TABLE')
+USERS_TABLE = os.environ.get('USERS_TABLE')
+TRANSACTIONS_TABLE = os.environ.get('TRANSACTIONS_TABLE')
+SNS_TOPIC_ARN = os.environ.get('SNS_TOPIC_ARN')
+
+
+def build_response(status_code, payload):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        },
+        'body': json.dumps(payload, default=str)
+    }
+
+
+def publish_topup(record):
+    """Notificación de recarga (un fallo no revierte la recarga)."""
+    try:
+        message, subject, attributes = notifications.build_topup_message(record)
+        sns.publish(
+            TopicArn=SNS_TOPIC_ARN,
+            Message=json.dumps(message, default=str),
+            Subject=subject,
+            MessageAttributes=attributes
+        )
+    except Exception as e:
+        print(f'Warning: Failed to send top-up notification: {str(e)}')
+
+
+def topup_result(record, state, duplicate):
+    result = {
+        'reference': record['bank_reference'],
+        'tag_id': record['tag_id'],
+        'placa': record.get('placa'),
+        'amount': float(record['amount']),
+        'late_fee_paid': float(record['late_fee_paid']),
+        'debt_paid': float(record['debt_paid']),
+        'credited': float(record['credited']),
+        'settled_transactions': record.get('settled_transactions', []),
+        'applied_at': record['applied_at'],
+        'duplicate': duplicate
+    }
+    if state is not None:
+        result['balance'] = float(state['balance'])
+        result['debt'] = float(state['debt'])
+        result['late_fee'] = float(state['late_fee'])
+    return result
+
+
+@ddb_tracer.traced
+def lambda_handler(event, context):
+    """
+    Recarga el tag de una placa.
+    Endpoint: POST /users/{placa}/tag/topup
+
+    Input (body):
+    {
+        "amount": 150.00,
+        "reference": "BI-20251117-000123",
+        "payment_method": "bank_transfer"
+    }
+    La referencia (o el header Idempotency-Key) identifica el pago: repetir
+    la petición con la misma referencia retorna la recarga original.
+    """
+    try:
+        placa = (event.get('pathParameters') or {}).get('placa')
+        body = http_encoding.request_json(event)
+        reference = body.get('reference') or http_encoding.header(event, 'Idempotency-Key')
+
+        if not placa:
+            return build_response(400, {
+                'error': 'Missing placa parameter',
+                'message': 'Placa is required in the path'
+            })
+        if not reference:
+            return build_response(400, {
+                'error': 'Missing required field',
+                'message': 'reference (or Idempotency-Key header) is required'
+            })
+        amount = tag_topups.to_decimal(body.get('amount'))
+        if amount <= 0:
+            return build_response(400, {
+                'error': 'Invalid amount',
+                'message': 'amount must be greater than zero'
+            })
+
+        tag = tag_topups.resolve_tag(dynamodb, TAGS_TABLE, USERS_TABLE, placa=placa)
+        if tag is None:
+            return build_response(404, {
+                'error': 'Tag not found',
+                'message': f'La placa {placa} no tiene un tag activo'
+            })
+
+        record, duplicate = tag_topups.topup(
+            dynamodb, TAGS_TABLE, TRANSACTIONS_TABLE, tag, amount, str(reference),
+            source='api', payment_method=body.get('payment_method')
+        )
+        if duplicate and record.get('tag_id') != tag['tag_id']:
+            return build_response(409, {
+                'error': 'Reference already used',
+                'message': f'La referencia {reference} ya se aplicó a otro tag'
+            })
+        if not duplicate:
+            publish_topup(record)
+
+        refreshed = dynamodb.Table(TAGS_TABLE).get_item(Key={'tag_id': tag['tag_id']}, ConsistentRead=True).get('Item')
+        state = tag_ledger.read_state(dynamodb, refreshed) if refreshed else None
+
+        print(json.dumps({
+            'reference': record['bank_reference'],
+            'placa': placa,
+            'tag_id': tag['tag_id'],
+            'amount': float(amount),
+            'debt_paid': float(record['debt_paid']),
+            'late_fee_paid': float(record['late_fee_paid']),
+            'settled_transactions': len(record.get('settled_transactions', [])),
+            'duplicate': duplicate,
+            'status': 'topup_applied'
+        }))
+
+        return build_response(200, topup_result(record, state, duplicate))
+
+    except ClientError as e:
+        error_msg = f'DynamoDB error: {str(e)}'
+        print(json.dumps({
+            'error': 'Top-up failed',
+            'message': error_msg,
+            'event': event
+        }))
+        return build_response(500, {
+            'error': 'Internal server error',
+            'message': error_msg
+        })
+    except Exception as e:
+        print(json.dumps({
+            'error': 'Top-up failed',
+            'message': str(e),
+            'event': event
+        }))
+        return build_response(500, {
+            'error': 'Internal server error',
+            'message': str(e)
+        })
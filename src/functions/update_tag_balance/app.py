@@ -2,13 +2,15 @@ import json
 import os
 from datetime import datetime
 from decimal import Decimal
-import boto3
+import ddb_tracer
+import sharded_balance
+import tag_ledger
+import tag_versions
 from botocore.exceptions import ClientError
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = ddb_tracer.resource()
 
 TAGS_TABLE = os.environ.get('TAGS_TABLE')
-USERS_TABLE = os.environ.get('USERS_TABLE')
 
 # Configuración de mora
 LATE_FEE_PER_MINUTE = Decimal('1.00')  # 1 GTQ por cada minuto de atraso
@@ -53,6 +55,7 @@ def calculate_minutes_elapsed(created_at, current_time):
         return 0
 
 
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Actualiza el balance de un tag después de una transacción.
@@ -80,7 +83,9 @@ def lambda_handler(event, context):
         tag_id = event.get('tag_id')
         amount = to_decimal(event.get('amount', 0))
         transaction_id = event.get('transaction_id') or event.get('event_id')
-        timestamp = event.get('timestamp', datetime.utcnow().isoformat() + 'Z')
+        # last_updated es la hora de escritura (no la del cruce): sync_users_balance
+        # la usa para descartar imágenes viejas del stream de Tags
+        updated_at = datetime.utcnow().isoformat() + 'Z'
         
         if not tag_id:
             raise ValueError('Missing required field: tag_id')
@@ -97,77 +102,94 @@ def lambda_handler(event, context):
             raise ValueError(f'Tag {tag_id} not found')
         
         tag = response['Item']
-        current_balance = to_decimal(tag.get('balance', 0))
-        current_debt = to_decimal(tag.get('debt', 0))
-        current_late_fee = to_decimal(tag.get('late_fee', 0))
-        
-        # Calcular nuevo balance
-        new_balance = current_balance - amount
-        new_debt = current_debt
-        new_late_fee = current_late_fee
-        has_debt = False
-        
-        # Si el balance es insuficiente, crear deuda
-        if new_balance < 0:
-            # La deuda es el monto que falta
-            debt_amount = abs(new_balance)
-            new_debt = current_debt + debt_amount
-            new_balance = Decimal('0.00')
-            has_debt = True
+        duplicate = False
+        if sharded_balance.is_sharded(tag):
+            # Tag de flota fragmentado: el débito va a un shard de TagBalanceShards
+            # y solo escribe el item de Tags si faltan fondos (deuda)
+            outcome = sharded_balance.debit(dynamodb, TAGS_TABLE, tag, amount, transaction_id, updated_at)
+            current_balance = outcome['previous_balance']
+            current_debt = to_decimal(tag.get('debt', 0))
+            current_late_fee = to_decimal(tag.get('late_fee', 0))
+            new_balance = outcome['new_balance']
+            # Re-entrega: la deuda del débito original ya está en el item leído
+            duplicate = outcome.get('duplicate', False)
+            new_debt = current_debt if duplicate else current_debt + outcome['debt_added']
+            new_late_fee = current_late_fee
+            has_debt = outcome['debt_added'] > 0
+        else:
+            for _ in range(tag_versions.MAX_VERSION_ATTEMPTS):
+                # En modo ledger el balance actual es snapshot + cola de entradas
+                state = tag_ledger.read_state(dynamodb, tag)
+                current_balance = state['balance']
+                current_debt = state['debt']
+                current_late_fee = state['late_fee']
             
-            # Calcular mora por minutos transcurridos desde la creación de la transacción
-            # Si hay deuda, significa que la transacción se creó sin fondos
-            # La mora se calculará cuando se complete el pago, pero aquí marcamos que hay deuda
-            # Por ahora, no calculamos mora aquí, se calculará en complete_pending_transaction
-            # cuando se pague la deuda
-            new_late_fee = current_late_fee  # Se calculará al momento del pago
-        
-        # Actualizar tag usando transacción atómica
-        update_expression = "SET balance = :balance, debt = :debt, late_fee = :late_fee, last_updated = :last_updated"
-        expression_values = {
-            ':balance': new_balance,
-            ':debt': new_debt,
-            ':late_fee': new_late_fee,
-            ':last_updated': timestamp
-        }
-        
-        # Si hay deuda, agregar flag
-        if has_debt:
-            update_expression += ", has_debt = :has_debt"
-            expression_values[':has_debt'] = True
-        
-        tags_table.update_item(
-            Key={'tag_id': tag_id},
-            UpdateExpression=update_expression,
-            ExpressionAttributeValues=expression_values,
-            ReturnValues='ALL_NEW'
-        )
-        
-        # Actualizar saldo_disponible en UsersVehicles para mantener consistencia
-        placa = tag.get('placa')
-        if placa and USERS_TABLE:
-            try:
-                users_table = dynamodb.Table(USERS_TABLE)
-                users_table.update_item(
-                    Key={'placa': placa},
-                    UpdateExpression='SET saldo_disponible = :balance',
-                    ExpressionAttributeValues={
-                        ':balance': new_balance
-                    }
-                )
-                print(json.dumps({
-                    'message': 'Updated UsersVehicles saldo_disponible',
-                    'placa': placa,
-                    'new_balance': float(new_balance)
-                }))
-            except Exception as e:
-                # No fallar si no se puede actualizar UsersVehicles
-                # El tag ya fue actualizado correctamente
-                print(json.dumps({
-                    'warning': 'Could not update UsersVehicles saldo_disponible',
-                    'placa': placa,
-                    'error': str(e)
-                }))
+                # Calcular nuevo balance
+                new_balance = current_balance - amount
+                new_debt = current_debt
+                new_late_fee = current_late_fee
+                has_debt = False
+            
+                # Si el balance es insuficiente, crear deuda
+                if new_balance < 0:
+                    # La deuda es el monto que falta
+                    debt_amount = abs(new_balance)
+                    new_debt = current_debt + debt_amount
+                    new_balance = Decimal('0.00')
+                    has_debt = True
+                
+                    # Calcular mora por minutos transcurridos desde la creación de la transacción
+                    # Si hay deuda, significa que la transacción se creó sin fondos
+                    # La mora se calculará cuando se complete el pago, pero aquí marcamos que hay deuda
+                    # Por ahora, no calculamos mora aquí, se calculará en complete_pending_transaction
+                    # cuando se pague la deuda
+                    new_late_fee = current_late_fee  # Se calculará al momento del pago
+            
+                if tag_ledger.TAG_LEDGER_ENABLED:
+                    # Append ciego condicional al ledger: no se escribe el item de Tags,
+                    # el compactador pliega el débito en el snapshot más tarde
+                    try:
+                        tag_ledger.append(dynamodb, TAGS_TABLE, tag_id, 'debit', amount, reference=transaction_id)
+                    except tag_ledger.DuplicateEntry:
+                        # Reintento de Step Functions: el débito ya estaba registrado y
+                        # el estado leído ya lo incluye
+                        duplicate = True
+                        new_balance = current_balance
+                        new_debt = current_debt
+                        has_debt = current_debt > 0
+                    break
+                
+                # Actualizar tag condicionado a la versión leída: si otro escritor
+                # (manage_tags, otro cruce, un pago) se adelantó, se relee y se recalcula
+                update_expression = "SET balance = :balance, debt = :debt, late_fee = :late_fee, last_updated = :last_updated"
+                expression_values = {
+                    ':balance': new_balance,
+                    ':debt': new_debt,
+                    ':late_fee': new_late_fee,
+                    ':last_updated': updated_at
+                }
+            
+                # Si hay deuda, agregar flag
+                if has_debt:
+                    update_expression += ", has_debt = :has_debt"
+                    expression_values[':has_debt'] = True
+            
+                try:
+                    tags_table.update_item(**tag_versions.versioned({
+                        'Key': {'tag_id': tag_id},
+                        'UpdateExpression': update_expression,
+                        'ExpressionAttributeValues': expression_values,
+                        'ReturnValues': 'ALL_NEW'
+                    }, expected=tag_versions.current(tag)))
+                    break
+                except ClientError as e:
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+                    tag = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item')
+                    if tag is None:
+                        raise ValueError(f'Tag {tag_id} not found')
+            else:
+                raise tag_versions.VersionConflict(tag_id, tag_versions.current(tag))
         
         result = {
             'tag_id': tag_id,
@@ -180,6 +202,16 @@ def lambda_handler(event, context):
             'success': True,
             'transaction_id': transaction_id
         }
+        if duplicate:
+            result['duplicate'] = True
+        # Cómo se registró el débito: redrive_failed_crossings solo re-ejecuta
+        # cruces ya descontados si el débito fue un append idempotente al ledger
+        if sharded_balance.is_sharded(tag):
+            result['debit_mode'] = 'sharded'
+        elif tag_ledger.TAG_LEDGER_ENABLED:
+            result['debit_mode'] = 'ledger'
+        else:
+            result['debit_mode'] = 'in_place'
         
         print(json.dumps({
             'tag_id': tag_id,
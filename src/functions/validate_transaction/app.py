@@ -1,14 +1,65 @@
 import json
 import os
-import boto3
+import classification_cache
+import ddb_tracer
+import event_ids
+import plate_matcher
+import toll_catalog
+import warmup
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = ddb_tracer.resource()
 
 USERS_TABLE = os.environ.get('USERS_TABLE')
 TAGS_TABLE = os.environ.get('TAGS_TABLE')
-TOLLS_CATALOG_TABLE = os.environ.get('TOLLS_CATALOG_TABLE')
+PLATE_MATCHING_ENABLED = os.environ.get('PLATE_MATCHING_ENABLED', 'true').lower() == 'true'
 
+# Índice de placas registradas publicado por build_plate_index
+# (se carga en la fase de init y se recarga cuando cambia en S3)
+plate_index = plate_matcher.IndexLoader()
+# Usuario y tag por placa, validados contra la versión de la placa en CacheVersions
+classification = classification_cache.ClassificationCache(dynamodb)
+# Catálogo de peajes en memoria
+catalog = toll_catalog.TollCatalog(dynamodb)
 
+# Fase de init: catálogo (abre también la conexión con DynamoDB) e índice de placas
+warmup.prime('validate_transaction', {
+    'toll_catalog': catalog.load,
+    'plate_index': plate_index.get
+})
+
+
+def match_registered_plate(users_table, placa):
+    """
+    Resuelve una placa no encontrada por get_item exacto contra el índice de
+    placas registradas (confusiones letra/dígito del OCR por posición y guion
+    faltante). Solo se acepta un candidato único, y se confirma con get_item
+    en UsersVehicles antes de usarlo. Sin índice publicado no se corrige.
+    Retorna el item del usuario o None.
+    """
+    index = plate_index.get()
+    if index is None:
+        return None
+
+    candidates = index.candidates(placa)
+    candidates.discard(placa)
+    if len(candidates) != 1:
+        if candidates:
+            print(json.dumps({
+                'placa': placa,
+                'status': 'ambiguous_plate_match',
+                'candidates': sorted(candidates)
+            }))
+        return None
+
+    candidate = candidates.pop()
+    user_info = users_table.get_item(Key={'placa': candidate}).get('Item')
+    # La placa pudo borrarse o pasar a no_registrado después de publicar el índice
+    if user_info is None or user_info.get('tipo_usuario') == 'no_registrado':
+        return None
+    return user_info
+
+
+@ddb_tracer.traced
 def lambda_handler(event, context):
     """
     Valida la transacción de peaje:
@@ -16,6 +67,8 @@ def lambda_handler(event, context):
     - Determina el tipo de usuario (no registrado, registrado, tag)
     - Valida que el tag existe y está activo (si aplica)
     """
+    if warmup.is_warmup(event):
+        return warmup.respond(event, context)
     try:
         # El evento viene de Step Functions, que recibe el evento de EventBridge
         # EventBridge puede pasar el evento envuelto o directamente el detail
@@ -47,26 +100,32 @@ def lambda_handler(event, context):
             raise ValueError('Missing required field: debe proporcionarse placa o tag_id')
         
         # Validar que el peaje existe
-        tolls_table = dynamodb.Table(TOLLS_CATALOG_TABLE)
-        toll_response = tolls_table.get_item(Key={'peaje_id': peaje_id})
-        
-        if 'Item' not in toll_response:
+        toll_info = catalog.get(peaje_id)
+        if toll_info is None:
             raise ValueError(f'Peaje {peaje_id} no encontrado en el catálogo')
         
-        toll_info = toll_response['Item']
-        
         # Determinar tipo de usuario
         # Según el documento: UsersVehicles es OBLIGATORIO para determinar el tipo de usuario
         user_type = 'no_registrado'  # Por defecto
         user_info = None
         tag_info = None
         
-        # SIEMPRE consultar UsersVehicles (obligatorio según flujo_guatepass.md)
+        # UsersVehicles es la fuente autoritativa (obligatorio según flujo_guatepass.md)
         users_table = dynamodb.Table(USERS_TABLE)
-        user_response = users_table.get_item(Key={'placa': placa})
+        cached = classification.get(placa, tag_id)
+        if cached is not None:
+            user_info, tag_info = cached
+        else:
+            user_info = users_table.get_item(Key={'placa': placa}).get('Item')
+        placa_detectada = placa
+        
+        # Con tag_id la placa se corrige contra la del tag (más abajo)
+        if user_info is None and PLATE_MATCHING_ENABLED and not tag_id:
+            user_info = match_registered_plate(users_table, placa)
+            if user_info is not None:
+                placa = user_info['placa']
         
-        if 'Item' in user_response:
-            user_info = user_response['Item']
+        if user_info is not None:
             # Si tiene tipo_usuario en el registro, usarlo como base
             registered_type = user_info.get('tipo_usuario', 'registrado')
             if registered_type == 'no_registrado':
@@ -76,21 +135,40 @@ def lambda_handler(event, context):
         
         # Verificar si tiene tag (esto puede cambiar el tipo a 'tag')
         if tag_id:
-            tags_table = dynamodb.Table(TAGS_TABLE)
-            tag_response = tags_table.get_item(Key={'tag_id': tag_id})
+            if cached is None:
+                tags_table = dynamodb.Table(TAGS_TABLE)
+                tag_info = tags_table.get_item(Key={'tag_id': tag_id}).get('Item')
             
-            if 'Item' in tag_response:
-                tag_info = tag_response['Item']
+            if tag_info is not None:
+                tag_placa = tag_info.get('placa')
+                # El tag identifica al vehículo: si la cámara leyó una variante
+                # de la placa del tag (confusión de OCR), usar la del tag
+                if (tag_placa and tag_placa != placa and PLATE_MATCHING_ENABLED
+                        and plate_matcher.is_ocr_variant(placa_detectada, tag_placa)):
+                    placa = tag_placa
+                    user_info = users_table.get_item(Key={'placa': placa}).get('Item')
                 # Validar que el tag esté activo y corresponda a la placa
-                if tag_info.get('status') == 'active' and tag_info.get('placa') == placa:
+                if tag_info.get('status') == 'active' and tag_placa == placa:
                     # Si el tag es válido, el usuario es tipo 'tag' (sobrescribe el tipo anterior)
                     user_type = 'tag'
                 else:
                     raise ValueError(f'Tag {tag_id} no está activo o no corresponde a la placa {placa}')
         
+        if cached is None and placa == placa_detectada:
+            classification.put(placa, tag_id, user_info, tag_info)
+        
+        event_id = detail.get('event_id')
+        source_event_id = None
+        if placa != placa_detectada and event_ids.is_event_id(event_id):
+            # El event_id lleva la placa (ver event_ids): se regenera con la placa
+            # corregida para que complete_pending la encuentre. Determinístico
+            # respecto al original, así un reintento produce el mismo ID
+            source_event_id = event_id
+            event_id = event_ids.new_event_id(placa, detail.get('timestamp'), seed=source_event_id)
+        
         # Preparar resultado para Step Functions
         result = {
-            'event_id': detail.get('event_id'),
+            'event_id': event_id,
             'placa': placa,
             'peaje_id': peaje_id,
             'peaje_info': toll_info,
@@ -100,10 +178,14 @@ def lambda_handler(event, context):
             'timestamp': detail.get('timestamp'),
             'validated_at': detail.get('ingested_at')
         }
+        if placa != placa_detectada:
+            result['placa_detectada'] = placa_detectada
+            result['source_event_id'] = source_event_id
         
         print(json.dumps({
-            'event_id': detail.get('event_id'),
+            'event_id': event_id,
             'placa': placa,
+            'placa_detectada': placa_detectada,
             'user_type': user_type,
             'status': 'validated'
         }))
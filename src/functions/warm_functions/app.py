@@ -0,0 +1,80 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+WARM_TARGETS = [name for name in os.environ.get('WARM_TARGETS', '').split(',') if name]
+WARM_CONTAINERS = int(os.environ.get('WARM_CONTAINERS', '0'))
+WARMUP_DELAY_MS = int(os.environ.get('WARMUP_DELAY_MS', '200'))
+MAX_WARM_INVOCATIONS = 200
+
+# Pool de conexiones del tamaño de la concurrencia máxima de invocaciones
+lambda_client = boto3.client('lambda', config=Config(max_pool_connections=MAX_WARM_INVOCATIONS))
+
+
+def warm(function_name, index, delay_ms):
+    """Una invocación síncrona de calentamiento. Retorna la respuesta de warmup.respond o el error."""
+    try:
+        response = lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps({'warmup': True, 'index': index, 'delay_ms': delay_ms}).encode('utf-8')
+        )
+        payload = json.loads(response['Payload'].read() or b'null')
+        if response.get('FunctionError') or not isinstance(payload, dict) or not payload.get('warm'):
+            return {'error': response.get('FunctionError') or 'unexpected response'}
+        return payload
+    except ClientError as e:
+        return {'error': e.response['Error']['Code']}
+
+
+def lambda_handler(event, context):
+    """
+    Mantiene calientes las funciones del camino de cobro antes de las horas pico.
+    Trigger: EventBridge Schedule (WarmerSchedule) o invocación manual.
+
+    Input opcional (sobrescribe la configuración):
+    {"containers": 10, "targets": ["guatepass-ingest-webhook-prod"], "delay_ms": 200}
+
+    Invoca cada función `containers` veces en paralelo con {"warmup": true}.
+    Cada invocación mantiene ocupado su contenedor delay_ms, así Lambda
+    reparte las invocaciones concurrentes en contenedores distintos (los que
+    faltan se crean y pasan la fase de init con el catálogo precargado).
+    """
+    event = event if isinstance(event, dict) else {}
+    containers = int(event.get('containers', WARM_CONTAINERS))
+    targets = event.get('targets') or WARM_TARGETS
+    delay_ms = int(event.get('delay_ms', WARMUP_DELAY_MS))
+
+    if containers <= 0 or not targets:
+        print(json.dumps({'containers': containers, 'targets': targets, 'status': 'warmer_disabled'}))
+        return {'warmed': {}}
+
+    containers = min(containers, MAX_WARM_INVOCATIONS // len(targets))
+    jobs = [(target, index) for target in targets for index in range(containers)]
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        results = list(executor.map(lambda job: warm(job[0], job[1], delay_ms), jobs))
+
+    report = {}
+    for (target, _), result in zip(jobs, results):
+        entry = report.setdefault(target, {'invocations': 0, 'containers': set(), 'first_warmups': 0, 'errors': {}})
+        entry['invocations'] += 1
+        if 'error' in result:
+            entry['errors'][result['error']] = entry['errors'].get(result['error'], 0) + 1
+            continue
+        entry['containers'].add(result['container_id'])
+        if result.get('first_warmup'):
+            entry['first_warmups'] += 1
+
+    warmed = {}
+    for target, entry in report.items():
+        warmed[target] = {
+            'requested': containers,
+            'containers': len(entry['containers']),
+            'first_warmups': entry['first_warmups'],
+            'errors': entry['errors']
+        }
+    print(json.dumps({'warmed': warmed, 'delay_ms': delay_ms, 'status': 'containers_warmed'}))
+    return {'warmed': warmed}
@@ -0,0 +1,146 @@
+import json
+import math
+import os
+import time
+from decimal import Decimal
+from botocore.exceptions import ClientError
+
+# Control de admisión por plaza (peaje_id) con token bucket.
+# El bucket compartido vive en la tabla AdmissionBuckets (tokens disponibles y
+# último refill); cada contenedor toma lotes de tokens (leases) y admite
+# eventos localmente mientras le queden, así que DynamoDB se consulta una vez
+# por lote y no por evento. Cuando la plaza agota su presupuesto el contenedor
+# recuerda hasta cuándo está bloqueada y responde 429 sin consultar la tabla.
+ADMISSION_TABLE = os.environ.get('ADMISSION_TABLE')
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', 'true').lower() == 'true'
+# Presupuesto por defecto; TollsCatalog puede definir admission_rate / admission_burst por peaje
+DEFAULT_RATE = float(os.environ.get('ADMISSION_RATE_PER_SECOND', '50'))
+DEFAULT_BURST = float(os.environ.get('ADMISSION_BURST', '200'))
+# Tokens que un contenedor toma por lote y cuánto puede retenerlos sin usar
+LEASE_SIZE = int(os.environ.get('ADMISSION_LEASE_SIZE', '10'))
+LEASE_TTL_SECONDS = float(os.environ.get('ADMISSION_LEASE_TTL_SECONDS', '1'))
+MAX_CONFLICT_RETRIES = 3
+
+METRICS_NAMESPACE = os.environ.get('ADMISSION_METRICS_NAMESPACE', 'GuatePass/Ingest')
+
+
+def budget(peaje_info):
+    """(rate, burst) del peaje: valores del catálogo o los de por defecto."""
+    peaje_info = peaje_info or {}
+    rate = float(peaje_info.get('admission_rate') or DEFAULT_RATE)
+    burst = float(peaje_info.get('admission_burst') or DEFAULT_BURST)
+    return rate, max(burst, 1.0)
+
+
+class AdmissionController:
+
+    def __init__(self, dynamodb, table_name=None):
+        self.dynamodb = dynamodb
+        self.table_name = table_name or ADMISSION_TABLE
+        # peaje_id -> {'tokens': int, 'expires_at': float}
+        self.leases = {}
+        # peaje_id -> instante (time.time) hasta el que la plaza está bloqueada
+        self.blocked_until = {}
+        self.counters = {}
+
+    def admit(self, peaje_id, peaje_info=None, now=None):
+        """
+        Retorna (True, 0) si el evento se admite o (False, retry_after_seconds)
+        si la plaza excedió su presupuesto.
+        """
+        if not ADMISSION_ENABLED or not self.table_name:
+            return True, 0
+        now = now or time.time()
+
+        blocked_until = self.blocked_until.get(peaje_id, 0)
+        if now < blocked_until:
+            self._count(peaje_id, 'Shed')
+            return False, blocked_until - now
+
+        lease = self.leases.get(peaje_id)
+        if not lease or lease['tokens'] <= 0 or now >= lease['expires_at']:
+            granted, retry_after = self._lease(peaje_id, peaje_info, now)
+            if not granted:
+                self.blocked_until[peaje_id] = now + retry_after
+                self._count(peaje_id, 'Shed')
+                return False, retry_after
+            lease = {'tokens': granted, 'expires_at': now + LEASE_TTL_SECONDS}
+            self.leases[peaje_id] = lease
+
+        lease['tokens'] -= 1
+        self._count(peaje_id, 'Admitted')
+        return True, 0
+
+    def _lease(self, peaje_id, peaje_info, now):
+        """
+        Toma hasta LEASE_SIZE tokens del bucket compartido (refill perezoso y
+        escritura condicional sobre updated_ms). Retorna (tokens, retry_after).
+        """
+        rate, burst = budget(peaje_info)
+        table = self.dynamodb.Table(self.table_name)
+        now_ms = int(now * 1000)
+        for _ in range(MAX_CONFLICT_RETRIES):
+            item = table.get_item(Key={'peaje_id': peaje_id}, ConsistentRead=True).get('Item')
+            if item:
+                elapsed = max(now_ms - int(item['updated_ms']), 0) / 1000.0
+                tokens = min(burst, float(item['tokens']) + elapsed * rate)
+            else:
+                tokens = burst
+            take = int(min(LEASE_SIZE, math.floor(tokens)))
+            if take < 1:
+                return 0, (1 - tokens) / rate if rate > 0 else LEASE_TTL_SECONDS
+            try:
+                kwargs = {
+                    'Key': {'peaje_id': peaje_id},
+                    'UpdateExpression': 'SET tokens = :tokens, updated_ms = :now',
+                    'ExpressionAttributeValues': {
+                        ':tokens': Decimal(str(round(tokens - take, 6))),
+                        ':now': now_ms
+                    }
+                }
+                if item:
+                    kwargs['ConditionExpression'] = 'updated_ms = :previous'
+                    kwargs['ExpressionAttributeValues'][':previous'] = item['updated_ms']
+                else:
+                    kwargs['ConditionExpression'] = 'attribute_not_exists(peaje_id)'
+                table.update_item(**kwargs)
+                return take, 0
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        # Alta contención en la plaza: se trata como bucket agotado por un instante
+        return 0, 1 / rate if rate > 0 else LEASE_TTL_SECONDS
+
+    def _count(self, peaje_id, metric):
+        counters = self.counters.setdefault(peaje_id, {'Admitted': 0, 'Shed': 0})
+        counters[metric] += 1
+
+    def flush_metrics(self, now=None):
+        """
+        Emite Admitted/Shed por peaje en CloudWatch Embedded Metric Format.
+        Se llama al final de cada invocación que admitió o rechazó: un
+        contenedor puede congelarse o terminar después de cualquier
+        invocación, y lo que no se emitió se pierde.
+        """
+        if not self.counters:
+            return
+        now = now or time.time()
+        for peaje_id, counters in self.counters.items():
+            print(json.dumps({
+                'admission': 'metrics',
+                'peaje_id': peaje_id,
+                'Admitted': counters['Admitted'],
+                'Shed': counters['Shed'],
+                '_aws': {
+                    'Timestamp': int(now * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': METRICS_NAMESPACE,
+                        'Dimensions': [['peaje_id']],
+                        'Metrics': [
+                            {'Name': 'Admitted', 'Unit': 'Count'},
+                            {'Name': 'Shed', 'Unit': 'Count'}
+                        ]
+                    }]
+                }
+            }))
+        self.counters = {}
@@ -0,0 +1,69 @@
+import os
+import time
+from datetime import datetime
+from botocore.exceptions import ClientError
+
+# Versiones de caché compartidas entre contenedores (tabla CacheVersions).
+# Quien modifica los datos incrementa la versión de la llave; los contenedores
+# que tienen datos en caché comparan la versión para descartarlos.
+CACHE_VERSIONS_TABLE = os.environ.get('CACHE_VERSIONS_TABLE')
+
+# Llave que manage_tags incrementa en cada cambio de un tag
+TAGS_KEY = 'tags'
+# Llave que seed_csv y load_csv_data incrementan al cambiar TollsCatalog (toll_catalog)
+TOLLS_KEY = 'tolls'
+
+
+def read(dynamodb, cache_key):
+    """Versión actual de la llave (0 si nunca se incrementó)."""
+    response = dynamodb.Table(CACHE_VERSIONS_TABLE).get_item(Key={'cache_key': cache_key})
+    return int(response.get('Item', {}).get('version', 0))
+
+
+def bump(dynamodb, cache_key, timestamp=None):
+    """
+    Incrementa la versión de la llave. Un fallo no debe romper la operación
+    que ya se hizo: las entradas en caché igual vencen por TTL.
+    """
+    if not CACHE_VERSIONS_TABLE:
+        return
+    try:
+        dynamodb.Table(CACHE_VERSIONS_TABLE).update_item(
+            Key={'cache_key': cache_key},
+            UpdateExpression='ADD version :one SET updated_at = :now',
+            ExpressionAttributeValues={':one': 1, ':now': timestamp or datetime.utcnow().isoformat() + 'Z'}
+        )
+    except ClientError as e:
+        print(f'Warning: Could not bump cache version {cache_key}: {e}')
+
+
+class VersionWatcher:
+    """
+    Observa la versión de una llave con a lo sumo una lectura cada
+    interval_seconds. changed() es True si la versión cambió desde la última
+    consulta.
+    """
+
+    def __init__(self, dynamodb, cache_key, interval_seconds):
+        self.dynamodb = dynamodb
+        self.cache_key = cache_key
+        self.interval_seconds = interval_seconds
+        self.version = None
+        self.checked_at = 0
+
+    def changed(self, now=None):
+        now = now or time.monotonic()
+        if now - self.checked_at < self.interval_seconds:
+            return False
+        self.checked_at = now
+        if not CACHE_VERSIONS_TABLE:
+            # Sin tabla de versiones (entorno local): las entradas solo vencen por TTL
+            return False
+        try:
+            version = read(self.dynamodb, self.cache_key)
+        except ClientError as e:
+            print(f'Warning: Could not read cache version {self.cache_key}: {e}')
+            return True
+        changed = self.version is not None and version != self.version
+        self.version = version
+        return changed
@@ -0,0 +1,165 @@
+import os
+import time
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+import cache_versions
+
+# Caché read-through de los datos de clasificación de un cruce (usuario de
+# UsersVehicles y tag de Tags) por placa. La registración y el estado del tag
+# cambian muy pocas veces; validate_transaction los sirve desde memoria y
+# valida la entrada contra la versión de la placa en CacheVersions
+# ('placa:<placa>'), que manage_tags incrementa en cada cambio.
+#   - Con tag: la versión se lee en cada cruce (un item pequeño en lugar de
+#     UsersVehicles + Tags), así una desactivación aplica al siguiente cruce.
+#   - Sin tag: se revalida cada CLASSIFICATION_RECHECK_SECONDS.
+# Nivel compartido opcional: el item de versión guarda también la última
+# clasificación leída, y un contenedor nuevo la usa si la versión coincide.
+CLASSIFICATION_CACHE_ENABLED = os.environ.get('CLASSIFICATION_CACHE_ENABLED', 'true').lower() == 'true'
+CLASSIFICATION_SHARED_CACHE_ENABLED = os.environ.get('CLASSIFICATION_SHARED_CACHE_ENABLED', 'false').lower() == 'true'
+CLASSIFICATION_CACHE_TTL_SECONDS = int(os.environ.get('CLASSIFICATION_CACHE_TTL_SECONDS', '900'))
+CLASSIFICATION_RECHECK_SECONDS = int(os.environ.get('CLASSIFICATION_RECHECK_SECONDS', '30'))
+CLASSIFICATION_CACHE_MAX_ENTRIES = int(os.environ.get('CLASSIFICATION_CACHE_MAX_ENTRIES', '50000'))
+
+# Campos que cambian con cada cobro o recarga sin cambiar la clasificación:
+# no se guardan en caché (el balance autoritativo lo lee update_tag_balance)
+VOLATILE_FIELDS = frozenset({
+    'balance', 'debt', 'late_fee', 'has_debt', 'last_updated', 'ledger_watermark',
+    'balance_shards', 'saldo_disponible', 'saldo_synced_at'
+})
+
+
+def version_key(placa):
+    """Llave en CacheVersions de la clasificación de una placa."""
+    return f'placa:{placa}'
+
+
+def bump(dynamodb, placa, timestamp=None):
+    """Invalida la clasificación en caché de la placa en todos los contenedores."""
+    if placa:
+        cache_versions.bump(dynamodb, version_key(placa), timestamp)
+
+
+def classification_view(item):
+    """Item sin los campos volátiles (None si no hay item)."""
+    if item is None:
+        return None
+    return {key: value for key, value in item.items() if key not in VOLATILE_FIELDS}
+
+
+class ClassificationCache:
+    """
+    LRU por (placa, tag_id) con la clasificación y la versión con que se leyó.
+    get() retorna (user_info, tag_info) o None; put() guarda lo leído de
+    DynamoDB con la versión obtenida antes de la lectura.
+    """
+
+    def __init__(self, dynamodb, table_name=None, max_entries=None):
+        self.dynamodb = dynamodb
+        self.table_name = table_name or cache_versions.CACHE_VERSIONS_TABLE
+        self.max_entries = max_entries or CLASSIFICATION_CACHE_MAX_ENTRIES
+        self.entries = OrderedDict()
+        # (llave, versión) del último get() sin acierto, para el put() siguiente
+        self.pending = None
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return CLASSIFICATION_CACHE_ENABLED and bool(self.table_name)
+
+    def get(self, placa, tag_id=None, now=None):
+        self.pending = None
+        if not self.enabled():
+            return None
+        now = now or time.monotonic()
+        key = (placa, tag_id or '')
+        entry = self.entries.get(key)
+        if entry is not None and now >= entry['expires_at']:
+            del self.entries[key]
+            entry = None
+
+        if entry is not None and not tag_id and now - entry['checked_at'] < CLASSIFICATION_RECHECK_SECONDS:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['user'], entry['tag']
+
+        item = self._read_version(placa, full=entry is None and CLASSIFICATION_SHARED_CACHE_ENABLED)
+        if item is None:
+            # Sin tabla de versiones disponible: se lee DynamoDB sin cachear
+            self.misses += 1
+            return None
+        version = int(item.get('version', 0))
+
+        if entry is not None and entry['version'] == version:
+            entry['checked_at'] = now
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry['user'], entry['tag']
+
+        snapshot = item.get('snapshot')
+        if (snapshot and int(snapshot.get('version', -1)) == version
+                and snapshot.get('tag_id', '') == (tag_id or '')):
+            self._store(key, version, snapshot.get('user'), snapshot.get('tag'), now)
+            self.hits += 1
+            return snapshot.get('user'), snapshot.get('tag')
+
+        self.pending = (key, version)
+        self.misses += 1
+        return None
+
+    def put(self, placa, tag_id, user_info, tag_info, now=None):
+        """Guarda la clasificación leída tras un get() sin acierto."""
+        key = (placa, tag_id or '')
+        pending, self.pending = self.pending, None
+        if pending is None or pending[0] != key or user_info is None:
+            return
+        version = pending[1]
+        user, tag = classification_view(user_info), classification_view(tag_info)
+        self._store(key, version, user, tag, now or time.monotonic())
+        if CLASSIFICATION_SHARED_CACHE_ENABLED:
+            self._share(placa, tag_id, version, user, tag)
+
+    def _store(self, key, version, user, tag, now):
+        self.entries[key] = {
+            'version': version,
+            'user': user,
+            'tag': tag,
+            'checked_at': now,
+            'expires_at': now + CLASSIFICATION_CACHE_TTL_SECONDS
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _read_version(self, placa, full=False):
+        kwargs = {'Key': {'cache_key': version_key(placa)}}
+        if not full:
+            kwargs['ProjectionExpression'] = '#version'
+            kwargs['ExpressionAttributeNames'] = {'#version': 'version'}
+        try:
+            return self.dynamodb.Table(self.table_name).get_item(**kwargs).get('Item', {})
+        except ClientError as e:
+            print(f'Warning: Could not read classification version for {placa}: {e}')
+            return None
+
+    def _share(self, placa, tag_id, version, user, tag):
+        """Publica la clasificación en el item de versión si la versión no cambió."""
+        kwargs = {
+            'Key': {'cache_key': version_key(placa)},
+            'UpdateExpression': 'SET #snapshot = :snapshot',
+            'ExpressionAttributeNames': {'#snapshot': 'snapshot'},
+            'ExpressionAttributeValues': {
+                ':snapshot': {'version': version, 'tag_id': tag_id or '', 'user': user, 'tag': tag}
+            }
+        }
+        if version:
+            kwargs['ConditionExpression'] = '#version = :version'
+            kwargs['ExpressionAttributeValues'][':version'] = version
+        else:
+            kwargs['ConditionExpression'] = 'attribute_not_exists(#version)'
+        kwargs['ExpressionAttributeNames']['#version'] = 'version'
+        try:
+            self.dynamodb.Table(self.table_name).update_item(**kwargs)
+        except ClientError as e:
+            # Versión incrementada entre la lectura y la escritura: no se comparte
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                print(f'Warning: Could not share classification for {placa}: {e}')
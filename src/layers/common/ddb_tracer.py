@@ -0,0 +1,229 @@
+import json
+import os
+import time
+from functools import wraps
+import boto3
+
+# Instrumentación opcional (opt-in) del recurso DynamoDB usado por los handlers.
+# Con DDB_TRACE_ENABLED=true cada llamada pide ReturnConsumedCapacity=TOTAL y se
+# acumulan llamadas, RCU/WCU y latencia por operación y tabla durante la invocación.
+DDB_TRACE_ENABLED = os.environ.get('DDB_TRACE_ENABLED', 'false').lower() == 'true'
+DDB_TRACE_NAMESPACE = os.environ.get('DDB_TRACE_NAMESPACE', 'GuatePass/DynamoDB')
+
+# Operaciones que aceptan ReturnConsumedCapacity
+CAPACITY_OPERATIONS = {
+    'GetItem', 'PutItem', 'UpdateItem', 'DeleteItem', 'Query', 'Scan',
+    'BatchGetItem', 'BatchWriteItem', 'TransactGetItems', 'TransactWriteItems'
+}
+READ_OPERATIONS = {'GetItem', 'Query', 'Scan', 'BatchGetItem', 'TransactGetItems'}
+
+_stats = {}
+_last_summary = None
+
+
+def _table_name(params):
+    """Obtiene el nombre de tabla de los parámetros de la llamada (si aplica)."""
+    if params.get('TableName'):
+        return params['TableName']
+    for key in ('RequestItems', 'TransactItems'):
+        if key in params:
+            return 'multi'
+    return 'n/a'
+
+
+def _entry(operation, table):
+    key = (operation, table)
+    if key not in _stats:
+        _stats[key] = {'calls': 0, 'errors': 0, 'rcu': 0.0, 'wcu': 0.0, 'latency_ms': 0.0}
+    return _stats[key]
+
+
+def _on_provide_params(params, model, context, **kwargs):
+    """Inyecta ReturnConsumedCapacity y marca el inicio de la llamada."""
+    context['ddb_trace_start'] = time.perf_counter()
+    context['ddb_trace_table'] = _table_name(params)
+    if model.name in CAPACITY_OPERATIONS and 'ReturnConsumedCapacity' not in params:
+        params['ReturnConsumedCapacity'] = 'TOTAL'
+
+
+def _add_capacity(operation, capacity):
+    """Suma la capacidad consumida reportada por DynamoDB (dict o lista por tabla)."""
+    if not capacity:
+        return
+    entries = capacity if isinstance(capacity, list) else [capacity]
+    for item in entries:
+        stats = _entry(operation, item.get('TableName', 'n/a'))
+        read_units = item.get('ReadCapacityUnits')
+        write_units = item.get('WriteCapacityUnits')
+        if read_units is None and write_units is None:
+            # Sin desglose: se clasifica según el tipo de operación
+            units = float(item.get('CapacityUnits', 0))
+            if operation in READ_OPERATIONS:
+                read_units = units
+            else:
+                write_units = units
+        stats['rcu'] += float(read_units or 0)
+        stats['wcu'] += float(write_units or 0)
+
+
+def _elapsed_ms(context):
+    start = context.get('ddb_trace_start')
+    if start is None:
+        return 0.0
+    return (time.perf_counter() - start) * 1000
+
+
+def _on_after_call(http_response, parsed, model, context, **kwargs):
+    stats = _entry(model.name, context.get('ddb_trace_table', 'n/a'))
+    stats['calls'] += 1
+    if http_response is not None and http_response.status_code >= 300:
+        stats['errors'] += 1
+    stats['latency_ms'] += _elapsed_ms(context)
+    _add_capacity(model.name, parsed.get('ConsumedCapacity'))
+
+
+def _on_after_call_error(context, **kwargs):
+    operation = context.get('ddb_trace_operation', 'unknown')
+    stats = _entry(operation, context.get('ddb_trace_table', 'n/a'))
+    stats['calls'] += 1
+    stats['errors'] += 1
+    stats['latency_ms'] += _elapsed_ms(context)
+
+
+def _on_before_call(model, context, **kwargs):
+    context['ddb_trace_operation'] = model.name
+
+
+def instrument(resource):
+    """
+    Registra los hooks de instrumentación en el cliente subyacente de un
+    recurso (o cliente) DynamoDB de boto3. Es idempotente.
+    """
+    client = getattr(getattr(resource, 'meta', None), 'client', None) or resource
+    if getattr(client, '_ddb_tracer_instrumented', False):
+        return resource
+    events = client.meta.events
+    events.register('provide-client-params.dynamodb', _on_provide_params)
+    events.register('before-call.dynamodb', _on_before_call)
+    events.register('after-call.dynamodb', _on_after_call)
+    events.register('after-call-error.dynamodb', _on_after_call_error)
+    client._ddb_tracer_instrumented = True
+    return resource
+
+
+def resource(**kwargs):
+    """
+    Crea el recurso DynamoDB de boto3. Solo se instrumenta si
+    DDB_TRACE_ENABLED=true, de modo que el costo es nulo cuando está apagado.
+    """
+    ddb = boto3.resource('dynamodb', **kwargs)
+    if DDB_TRACE_ENABLED:
+        instrument(ddb)
+    return ddb
+
+
+def reset():
+    """Limpia las estadísticas acumuladas de la invocación actual."""
+    _stats.clear()
+
+
+def summary():
+    """Resume las estadísticas acumuladas por operación y tabla."""
+    operations = []
+    totals = {'calls': 0, 'errors': 0, 'rcu': 0.0, 'wcu': 0.0, 'latency_ms': 0.0}
+    for (operation, table), stats in sorted(_stats.items()):
+        operations.append({
+            'operation': operation,
+            'table': table,
+            'calls': stats['calls'],
+            'errors': stats['errors'],
+            'rcu': round(stats['rcu'], 2),
+            'wcu': round(stats['wcu'], 2),
+            'latency_ms': round(stats['latency_ms'], 2)
+        })
+        for key in totals:
+            totals[key] += stats[key]
+    return {
+        'calls': totals['calls'],
+        'errors': totals['errors'],
+        'rcu': round(totals['rcu'], 2),
+        'wcu': round(totals['wcu'], 2),
+        'latency_ms': round(totals['latency_ms'], 2),
+        'operations': operations
+    }
+
+
+def last_summary():
+    """Retorna el resumen emitido por la última invocación instrumentada."""
+    return _last_summary
+
+
+def _correlation(event, result):
+    """Extrae event_id y user_type del evento o del resultado del handler."""
+    fields = {}
+    for source in (result, event, (event or {}).get('detail') if isinstance(event, dict) else None):
+        if not isinstance(source, dict):
+            continue
+        for key in ('event_id', 'user_type'):
+            if key not in fields and source.get(key):
+                fields[key] = source[key]
+    return fields
+
+
+def emit(function_name, event=None, result=None):
+    """
+    Emite una línea JSON con el resumen de la invocación. La línea usa
+    CloudWatch Embedded Metric Format, así que también publica métricas
+    (llamadas, RCU, WCU y latencia) por FunctionName sin llamadas extra.
+    """
+    global _last_summary
+    totals = summary()
+    record = {
+        'ddb_trace': totals,
+        'FunctionName': function_name,
+        'DynamoDBCalls': totals['calls'],
+        'DynamoDBErrors': totals['errors'],
+        'ConsumedRCU': totals['rcu'],
+        'ConsumedWCU': totals['wcu'],
+        'DynamoDBLatency': totals['latency_ms'],
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': DDB_TRACE_NAMESPACE,
+                'Dimensions': [['FunctionName']],
+                'Metrics': [
+                    {'Name': 'DynamoDBCalls', 'Unit': 'Count'},
+                    {'Name': 'DynamoDBErrors', 'Unit': 'Count'},
+                    {'Name': 'ConsumedRCU', 'Unit': 'Count'},
+                    {'Name': 'ConsumedWCU', 'Unit': 'Count'},
+                    {'Name': 'DynamoDBLatency', 'Unit': 'Milliseconds'}
+                ]
+            }]
+        }
+    }
+    record.update(_correlation(event, result))
+    _last_summary = {**totals, **_correlation(event, result), 'function': function_name}
+    print(json.dumps(record, default=str))
+
+
+def traced(handler):
+    """
+    Decorador para lambda_handler: reinicia las estadísticas al inicio y emite
+    el resumen al final de la invocación (también si el handler falla).
+    Si la instrumentación está apagada retorna el handler sin cambios.
+    """
+    if not DDB_TRACE_ENABLED:
+        return handler
+
+    @wraps(handler)
+    def wrapper(event, context):
+        reset()
+        result = None
+        try:
+            result = handler(event, context)
+            return result
+        finally:
+            function_name = getattr(context, 'function_name', None) or handler.__module__
+            emit(function_name, event, result)
+
+    return wrapper
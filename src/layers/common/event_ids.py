@@ -0,0 +1,115 @@
+import hashlib
+import secrets
+import zlib
+from datetime import datetime, timezone
+
+# Identificadores de transacción ordenables por tiempo (estilo ULID).
+# Formato: <ULID de 26 caracteres>-<placa>
+#   - 10 caracteres: milisegundos del cruce (Crockford base32, orden lexicográfico = cronológico)
+#   - 4 caracteres: hash de la placa (detecta IDs alterados o mal copiados)
+#   - 12 caracteres: aleatorios (60 bits)
+# El mismo valor es event_id y ts (RANGE key) en Transactions, así que el
+# historial es una consulta por rango de la tabla base y la placa (HASH key)
+# se obtiene del propio ID para hacer get_item.
+CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+TIME_LENGTH = 10
+PLACA_HASH_LENGTH = 4
+RANDOM_LENGTH = 12
+ULID_LENGTH = TIME_LENGTH + PLACA_HASH_LENGTH + RANDOM_LENGTH
+SEPARATOR = '-'
+# Mayor que cualquier caracter Crockford o el separador: cierra rangos por prefijo
+RANGE_END = '~'
+
+_DECODE = {char: index for index, char in enumerate(CROCKFORD)}
+
+
+def _encode(value, length):
+    chars = []
+    for _ in range(length):
+        chars.append(CROCKFORD[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def _decode(text):
+    value = 0
+    for char in text:
+        value = (value << 5) | _DECODE[char]
+    return value
+
+
+def to_millis(timestamp=None):
+    """Convierte un timestamp ISO 8601 (o datetime) a milisegundos epoch. None = ahora."""
+    if timestamp is None:
+        moment = datetime.now(timezone.utc)
+    elif isinstance(timestamp, datetime):
+        moment = timestamp
+    else:
+        moment = datetime.fromisoformat(str(timestamp).replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp() * 1000)
+
+
+def placa_hash(placa):
+    """Hash de 4 caracteres (20 bits) de la placa."""
+    return _encode(zlib.crc32(placa.encode('utf-8')) & 0xFFFFF, PLACA_HASH_LENGTH)
+
+
+def new_event_id(placa, timestamp=None, seed=None):
+    """
+    Genera el event_id de un cruce. Usa el timestamp del cruce (no el de
+    ingesta) para que el orden de la tabla sea el de los cruces. Con seed la
+    parte aleatoria es determinística (migración idempotente).
+    """
+    try:
+        millis = to_millis(timestamp)
+    except ValueError:
+        millis = to_millis()
+    if seed is None:
+        randomness = secrets.randbits(RANDOM_LENGTH * 5)
+    else:
+        digest = hashlib.sha256(str(seed).encode('utf-8')).digest()
+        randomness = int.from_bytes(digest[:8], 'big') >> (64 - RANDOM_LENGTH * 5)
+    return (
+        _encode(millis, TIME_LENGTH)
+        + placa_hash(placa)
+        + _encode(randomness, RANDOM_LENGTH)
+        + SEPARATOR
+        + placa
+    )
+
+
+def parse(event_id):
+    """
+    Descompone un event_id. Retorna {'placa', 'millis', 'timestamp'} o None si
+    no tiene el formato (p. ej. UUID previo a la migración) o el hash no coincide.
+    """
+    if not isinstance(event_id, str) or len(event_id) <= ULID_LENGTH + 1:
+        return None
+    ulid, separator, placa = event_id[:ULID_LENGTH], event_id[ULID_LENGTH], event_id[ULID_LENGTH + 1:]
+    if separator != SEPARATOR or any(char not in _DECODE for char in ulid):
+        return None
+    if ulid[TIME_LENGTH:TIME_LENGTH + PLACA_HASH_LENGTH] != placa_hash(placa):
+        return None
+    millis = _decode(ulid[:TIME_LENGTH])
+    moment = datetime.fromtimestamp(millis / 1000, tz=timezone.utc)
+    return {
+        'placa': placa,
+        'millis': millis,
+        'timestamp': moment.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    }
+
+
+def is_event_id(value):
+    return parse(value) is not None
+
+
+def range_start(timestamp):
+    """Menor ts posible para cruces en o después de timestamp."""
+    return _encode(to_millis(timestamp), TIME_LENGTH)
+
+
+def range_end(timestamp):
+    """Mayor ts posible para cruces en o antes de timestamp (mismo milisegundo incluido)."""
+    return _encode(to_millis(timestamp), TIME_LENGTH) + RANGE_END
@@ -0,0 +1,197 @@
+import json
+import os
+from datetime import datetime
+from decimal import Decimal
+from botocore.exceptions import ClientError
+
+# Cruces cuya ejecución de ProcessToll terminó en HandleError. Cada fallo se
+# guarda por event_id con el detail original y una clasificación del error,
+# para re-procesarlos con scripts/redrive_failed_crossings.py.
+# Estados: pending (por re-procesar) -> redriving (reclamado por un redrive)
+# -> redriven (ejecución iniciada) -> resolved (la transacción quedó persistida).
+# Si la ejecución re-procesada vuelve a fallar, el cruce regresa a pending.
+# Los cruces rechazados por validación (peaje inexistente, tag que no
+# corresponde...) llevan rejected_peaje_id: el índice disperso
+# rejections-index es el flujo de rechazos que cada plaza consulta
+# (GET /tolls/{peaje_id}/rejections).
+FAILED_CROSSINGS_TABLE = os.environ.get('FAILED_CROSSINGS_TABLE')
+STATUS_INDEX = 'status-index'
+REJECTIONS_INDEX = 'rejections-index'
+
+PENDING = 'pending'
+REDRIVING = 'redriving'
+REDRIVEN = 'redriven'
+RESOLVED = 'resolved'
+NEEDS_REVIEW = 'needs_review'
+
+MAX_CAUSE_LENGTH = 2000
+# Tipos de error de las validaciones de validate_transaction y process_toll_batch
+REJECTION_ERRORS = ('ValueError', 'InvalidCrossing')
+
+# (clase, re-procesable, fragmentos del Error o Cause), en orden de prioridad
+ERROR_CLASSES = (
+    ('throttling', True, (
+        'ProvisionedThroughputExceeded', 'ThrottlingException', 'RequestLimitExceeded',
+        'TooManyRequests', 'Throttled'
+    )),
+    ('unavailable', True, (
+        'InternalServerError', 'ServiceUnavailable', 'Lambda.ServiceException',
+        'Lambda.AWSLambdaException', 'Lambda.SdkClientException', 'States.Timeout',
+        'EndpointConnectionError', 'ConnectTimeout', 'ReadTimeout', 'ConnectionClosed'
+    )),
+    ('conflict', True, (
+        'TransactionConflict', 'TransactionCanceled', 'ConditionalCheckFailed', 'VersionConflict'
+    )),
+    ('invalid_input', False, (
+        'ValidationException', 'ValueError', 'InvalidCrossing', 'KeyError', 'TypeError', 'InvalidOperation'
+    )),
+)
+UNKNOWN_CLASS = ('unknown', True)
+
+
+def classify(error, cause):
+    """Clase del error y si tiene sentido re-procesar el cruce: (clase, retryable)."""
+    text = f'{error or ""} {cause or ""}'
+    for error_class, retryable, fragments in ERROR_CLASSES:
+        if any(fragment in text for fragment in fragments):
+            return error_class, retryable
+    return UNKNOWN_CLASS
+
+
+def rejection_reason(error, cause):
+    """
+    Mensaje del rechazo si el fallo fue una validación del cruce, None si no.
+    La Cause de un error de Lambda es el JSON {errorMessage, errorType, ...}.
+    """
+    try:
+        details = json.loads(cause) if cause else {}
+    except ValueError:
+        details = {}
+    if not isinstance(details, dict):
+        details = {}
+    error_type = details.get('errorType') or error
+    if error_type not in REJECTION_ERRORS:
+        return None
+    return details.get('errorMessage') or cause or error_type
+
+
+def failed_state(state_input):
+    """
+    Estado que falló, deducido de lo que la ejecución ya había calculado:
+    (estado, tag_charged). tag_charged indica que UpdateTagBalance ya
+    descontó el cruce (el fallo fue después, en PersistTransaction).
+    """
+    state_input = state_input or {}
+    if state_input.get('tag_balance_update'):
+        return 'PersistTransaction', True
+    if state_input.get('charge'):
+        if state_input.get('user_type') == 'tag':
+            return 'UpdateTagBalance', False
+        return 'PersistTransaction', False
+    return 'ValidateTransaction', False
+
+
+def _to_dynamodb(value):
+    """Floats -> Decimal (los payloads de Step Functions traen floats)."""
+    return json.loads(json.dumps(value, default=str), parse_float=Decimal)
+
+
+def record_failure(dynamodb, failure):
+    """
+    Guarda (o actualiza) el fallo de un cruce a partir de la salida de
+    HandleError: {error, input, execution_input, error_timestamp, execution_arn}.
+    Idempotente por event_id: un fallo repetido incrementa failure_count y
+    devuelve el cruce a pending. Retorna el item guardado.
+    """
+    execution_input = failure.get('execution_input') or {}
+    if isinstance(execution_input, str):
+        execution_input = json.loads(execution_input)
+    state_input = failure.get('input') or {}
+    crossing = execution_input.get('detail') or execution_input
+    error = failure.get('error') or {}
+    error_name = error.get('Error') or failure.get('error_message')
+    cause = (error.get('Cause') or failure.get('error_cause') or '')[:MAX_CAUSE_LENGTH]
+    error_class, retryable = classify(error_name, cause)
+    reason = rejection_reason(error_name, cause)
+    state, tag_charged = failed_state(state_input)
+    event_id = crossing.get('event_id') or state_input.get('event_id') or failure.get('execution_arn')
+    now = datetime.utcnow().isoformat() + 'Z'
+
+    item = {
+        'event_id': event_id,
+        'placa': crossing.get('placa') or state_input.get('placa'),
+        'peaje_id': crossing.get('peaje_id') or state_input.get('peaje_id'),
+        'crossing': _to_dynamodb(crossing),
+        'status': NEEDS_REVIEW if tag_charged else PENDING,
+        'error_class': error_class,
+        'retryable': retryable,
+        'failed_state': state,
+        'tag_charged': tag_charged,
+        'error': error_name,
+        'cause': cause,
+        'execution_arn': failure.get('execution_arn'),
+        'failed_at': failure.get('error_timestamp') or now
+    }
+    if tag_charged:
+        item['tag_balance_update'] = _to_dynamodb(state_input['tag_balance_update'])
+    if reason and item['peaje_id']:
+        item['rejected_peaje_id'] = item['peaje_id']
+        item['rejection_reason'] = reason[:MAX_CAUSE_LENGTH]
+
+    names, values, sets = {}, {':one': 1, ':now': now}, []
+    for index, (field, value) in enumerate(item.items()):
+        if field == 'event_id' or value is None:
+            continue
+        names[f'#f{index}'] = field
+        values[f':f{index}'] = value
+        sets.append(f'#f{index} = :f{index}')
+    response = dynamodb.Table(FAILED_CROSSINGS_TABLE).update_item(
+        Key={'event_id': event_id},
+        UpdateExpression='SET ' + ', '.join(sets) + ', first_failed_at = if_not_exists(first_failed_at, :now), '
+                         'updated_at = :now ADD failure_count :one',
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+        ReturnValues='ALL_NEW'
+    )
+    return response['Attributes']
+
+
+def record_rejection(dynamodb, crossing, reason):
+    """
+    Registra un cruce descartado por validación fuera de Step Functions
+    (process_toll_batch) con la misma forma que record_failure.
+    """
+    return record_failure(dynamodb, {
+        'error': {
+            'Error': 'InvalidCrossing',
+            'Cause': json.dumps({'errorMessage': reason, 'errorType': 'InvalidCrossing'})
+        },
+        'execution_input': {'detail': crossing}
+    })
+
+
+def transition(dynamodb, event_id, expected_status, new_status, **fields):
+    """
+    Cambia el estado de un cruce solo si sigue en expected_status (dos redrives
+    concurrentes no re-procesan el mismo cruce). Retorna False si otro lo cambió.
+    """
+    names = {'#status': 'status'}
+    values = {':expected': expected_status, ':status': new_status, ':now': datetime.utcnow().isoformat() + 'Z'}
+    sets = ['#status = :status', 'updated_at = :now']
+    for index, (field, value) in enumerate(fields.items()):
+        names[f'#f{index}'] = field
+        values[f':f{index}'] = value
+        sets.append(f'#f{index} = :f{index}')
+    try:
+        dynamodb.Table(FAILED_CROSSINGS_TABLE).update_item(
+            Key={'event_id': event_id},
+            UpdateExpression='SET ' + ', '.join(sets),
+            ConditionExpression='#status = :expected',
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
@@ -0,0 +1,91 @@
+import base64
+import gzip
+import json
+import os
+
+try:
+    import brotli
+except ImportError:  # brotli es opcional: sin el paquete solo se ofrece gzip
+    brotli = None
+
+# Negociación de Content-Encoding para respuestas de API Gateway (proxy).
+# Los cuerpos por encima de COMPRESSION_MIN_BYTES se comprimen con brotli o
+# gzip según Accept-Encoding y se devuelven en base64 (isBase64Encoded);
+# API Gateway los entrega como binarios porque el API declara
+# BinaryMediaTypes '*/*'. Por esa misma configuración los cuerpos de las
+# peticiones llegan en base64: request_json() los decodifica.
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '1024'))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def header(event, name):
+    """Valor de un header de la petición sin distinguir mayúsculas (None si no está)."""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def request_json(event):
+    """Cuerpo JSON de la petición (decodifica base64 si API Gateway lo codificó)."""
+    body = event.get('body')
+    if body is None:
+        return {}
+    if not isinstance(body, str):
+        return body
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return json.loads(body or '{}')
+
+
+def accepted_encodings(accept_encoding):
+    """Codificaciones aceptadas con q > 0, en orden de preferencia del servidor."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        fields = part.strip().split(';')
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    wildcard = accepted.get('*', 0.0)
+    available = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return [coding for coding in available if accepted.get(coding, wildcard) > 0]
+
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def encode_response(response, event):
+    """
+    Comprime el body de una respuesta proxy si el cliente lo acepta y supera
+    el umbral. Siempre agrega Vary: Accept-Encoding.
+    """
+    headers = response.setdefault('headers', {})
+    headers['Vary'] = 'Accept-Encoding'
+    body = response.get('body')
+    if not body or response.get('isBase64Encoded'):
+        return response
+    raw = body.encode('utf-8')
+    if len(raw) < COMPRESSION_MIN_BYTES:
+        return response
+    encodings = accepted_encodings(header(event, 'Accept-Encoding'))
+    if not encodings:
+        return response
+    coding = encodings[0]
+    response['body'] = base64.b64encode(compress(raw, coding)).decode('ascii')
+    response['isBase64Encoded'] = True
+    headers['Content-Encoding'] = coding
+    return response
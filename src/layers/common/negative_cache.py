@@ -0,0 +1,54 @@
+import os
+import time
+from collections import OrderedDict
+
+# Caché negativa por contenedor: recuerda por un tiempo que una llave no
+# existe o no es válida (peaje inexistente, tag inexistente o inactivo) para
+# que una ráfaga de eventos inválidos no consuma lecturas de DynamoDB.
+# Acotada en tamaño (expulsa la entrada usada hace más tiempo) y con TTL.
+NEGATIVE_CACHE_TTL_SECONDS = int(os.environ.get('NEGATIVE_CACHE_TTL_SECONDS', '60'))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.environ.get('NEGATIVE_CACHE_MAX_ENTRIES', '10000'))
+
+
+class NegativeCache:
+
+    def __init__(self, max_entries=None, ttl_seconds=None):
+        self.max_entries = max_entries or NEGATIVE_CACHE_MAX_ENTRIES
+        self.ttl_seconds = ttl_seconds or NEGATIVE_CACHE_TTL_SECONDS
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now=None):
+        """Motivo guardado para la llave o None si no está o venció."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        reason, expires_at = entry
+        if (now or time.monotonic()) >= expires_at:
+            del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return reason
+
+    def put(self, key, reason, now=None):
+        self.entries[key] = (reason, (now or time.monotonic()) + self.ttl_seconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self, prefix=None):
+        if prefix is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key.startswith(prefix)]:
+            del self.entries[key]
@@ -0,0 +1,178 @@
+# Construcción de los mensajes de notificación de cobro, compartida por
+# send_notification (Step Functions) y process_toll_batch (lotes desde SQS),
+# y de recarga de tag (topup_tag y process_bank_settlement).
+
+
+def build_notification_message(event):
+    """
+    Construye el mensaje de notificación según el tipo de usuario y estado del pago.
+    """
+    event_id = event.get('event_id')
+    placa = event.get('placa')
+    charge = event.get('charge', {})
+    invoice_id = event.get('invoice_id')
+    user_type = event.get('user_type')
+    requires_payment = event.get('requires_payment', False)
+    tag_balance_update = event.get('tag_balance_update', {})
+    peaje_id = event.get('peaje_id')
+    timestamp = event.get('timestamp')
+    
+    # Información base
+    base_message = {
+        'event_id': event_id,
+        'placa': placa,
+        'peaje_id': peaje_id,
+        'user_type': user_type,
+        'timestamp': timestamp,
+        'amount': charge.get('total', 0),
+        'currency': charge.get('currency', 'GTQ'),
+        'subtotal': charge.get('subtotal', 0),
+        'tax': charge.get('tax', 0)
+    }
+    
+    # Determinar tipo de notificación
+    if requires_payment:
+        # Cobro pendiente - sin fondos suficientes
+        notification_type = 'payment_required'
+        status = 'pending_payment'
+        subject = f'GuatePass - Cobro Pendiente: {placa}'
+        
+        # Construir mensaje para cobro pendiente
+        message = {
+            **base_message,
+            'notification_type': notification_type,
+            'status': status,
+            'requires_payment': True,
+            'message': f'Se registró un cobro de peaje para la placa {placa} que requiere pago.'
+        }
+        
+        # Agregar información de tag si aplica
+        if user_type == 'tag' and tag_balance_update:
+            has_debt = tag_balance_update.get('has_debt', False)
+            debt = tag_balance_update.get('debt', 0)
+            balance = tag_balance_update.get('new_balance', 0)
+            tag_id = tag_balance_update.get('tag_id')
+            
+            message['tag_info'] = {
+                'tag_id': tag_id,
+                'current_balance': balance,
+                'debt': debt,
+                'has_debt': has_debt
+            }
+            
+            if has_debt:
+                message['message'] = f'Se registró un cobro de peaje para la placa {placa}. Tu tag {tag_id} no tiene fondos suficientes. Deuda actual: Q{debt:.2f}. Balance: Q{balance:.2f}.'
+                message['action_required'] = 'Recarga tu tag para evitar mora adicional. La mora se calcula a Q1.00 por cada minuto transcurrido.'
+            else:
+                message['message'] = f'Se registró un cobro de peaje para la placa {placa}. Tu tag {tag_id} tiene balance insuficiente. Balance actual: Q{balance:.2f}.'
+        elif user_type == 'registrado':
+            # Usuario registrado sin tag y sin fondos
+            message['message'] = f'Se registró un cobro de peaje para la placa {placa}. Tu cuenta no tiene fondos suficientes. Por favor realiza el pago para completar la transacción.'
+            message['action_required'] = 'Realiza el pago para completar la transacción. La mora se calcula a Q1.00 por cada minuto transcurrido desde la creación de la transacción.'
+        
+        message['payment_info'] = {
+            'amount_due': charge.get('total', 0),
+            'payment_deadline': 'Inmediato',
+            'late_fee_rate': 'Q1.00 por minuto',
+            'how_to_pay': 'Completa el pago usando el endpoint /transactions/{event_id}/complete'
+        }
+        
+    else:
+        # Cobro exitoso - con fondos suficientes
+        notification_type = 'payment_successful'
+        status = 'completed'
+        subject = f'GuatePass - Cobro Exitoso: {placa}'
+        
+        # Construir mensaje para cobro exitoso
+        message = {
+            **base_message,
+            'notification_type': notification_type,
+            'status': status,
+            'requires_payment': False,
+            'invoice_id': invoice_id,
+            'message': f'Cobro de peaje exitoso para la placa {placa}.'
+        }
+        
+        # Agregar información de tag si aplica
+        if user_type == 'tag' and tag_balance_update:
+            balance = tag_balance_update.get('new_balance', 0)
+            previous_balance = tag_balance_update.get('previous_balance', 0)
+            tag_id = tag_balance_update.get('tag_id')
+            
+            message['tag_info'] = {
+                'tag_id': tag_id,
+                'previous_balance': previous_balance,
+                'current_balance': balance,
+                'amount_charged': charge.get('total', 0)
+            }
+            
+            message['message'] = f'Cobro de peaje exitoso para la placa {placa}. Se descontó Q{charge.get("total", 0):.2f} de tu tag {tag_id}. Balance anterior: Q{previous_balance:.2f}, Balance actual: Q{balance:.2f}.'
+        elif user_type == 'registrado':
+            message['message'] = f'Cobro de peaje exitoso para la placa {placa}. Se descontó Q{charge.get("total", 0):.2f} de tu cuenta.'
+        
+        message['transaction_info'] = {
+            'invoice_id': invoice_id,
+            'amount_charged': charge.get('total', 0),
+            'payment_status': 'completed'
+        }
+    
+    return message, subject
+
+
+def message_attributes(event, message):
+    """Atributos SNS para filtrar suscripciones por placa, tipo de notificación y usuario."""
+    user_type = event.get('user_type')
+    return {
+        'event_id': {
+            'DataType': 'String',
+            'StringValue': str(event.get('event_id'))
+        },
+        'placa': {
+            'DataType': 'String',
+            'StringValue': event.get('placa')
+        },
+        'notification_type': {
+            'DataType': 'String',
+            'StringValue': message.get('notification_type', 'unknown')
+        },
+        'user_type': {
+            'DataType': 'String',
+            'StringValue': str(user_type) if user_type else 'unknown'
+        }
+    }
+
+
+def build_topup_message(record):
+    """
+    Mensaje de recarga aplicada: monto, mora y deuda pagadas, crédito al
+    balance y transacciones pendientes que quedaron pagadas.
+    Retorna (message, subject, message_attributes).
+    """
+    placa = record.get('placa')
+    settled = record.get('settled_transactions', [])
+    message = {
+        'reference': record['bank_reference'],
+        'placa': placa,
+        'tag_id': record['tag_id'],
+        'notification_type': 'tag_topup',
+        'amount': float(record['amount']),
+        'late_fee_paid': float(record['late_fee_paid']),
+        'debt_paid': float(record['debt_paid']),
+        'credited': float(record['credited']),
+        'remaining_debt': float(record.get('remaining_debt', 0)),
+        'settled_transactions': settled,
+        'timestamp': record['applied_at'],
+        'message': f'Recarga de Q{float(record["amount"]):.2f} aplicada al tag {record["tag_id"]} de la placa {placa}.'
+    }
+    if record['debt_paid'] > 0 or record['late_fee_paid'] > 0:
+        message['message'] += (f' Se pagó Q{float(record["late_fee_paid"]):.2f} de mora y '
+                               f'Q{float(record["debt_paid"]):.2f} de deuda; se acreditó Q{float(record["credited"]):.2f}.')
+    if settled:
+        message['message'] += f' {len(settled)} transacción(es) pendiente(s) quedaron pagadas.'
+    attributes = {
+        'reference': {'DataType': 'String', 'StringValue': record['bank_reference']},
+        'placa': {'DataType': 'String', 'StringValue': placa or 'unknown'},
+        'notification_type': {'DataType': 'String', 'StringValue': 'tag_topup'},
+        'user_type': {'DataType': 'String', 'StringValue': 'tag'}
+    }
+    return message, f'GuatePass - Recarga de tag: {placa}', attributes
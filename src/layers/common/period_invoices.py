@@ -0,0 +1,186 @@
+import os
+from datetime import datetime, timedelta
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+# Facturación consolidada por periodo.
+# Con INVOICE_PERIOD = daily | monthly cada cruce cobrado se agrega a un
+# invoice abierto por placa y periodo (INV-<periodo>-<placa>) en lugar de crear
+# un item por cruce. El invoice guarda totales acumulados y una línea compacta
+# por cruce; close_invoice_periods lo finaliza cuando el periodo termina.
+# Con INVOICE_PERIOD = crossing (default) se conserva un invoice por cruce.
+INVOICE_PERIOD = os.environ.get('INVOICE_PERIOD', 'crossing').lower()
+PERIODS = ('crossing', 'daily', 'monthly')
+
+OPEN_STATUS = 'open'
+CLOSED_STATUS = 'paid'
+# Índice disperso: solo los invoices abiertos tienen open_period
+OPEN_PERIOD_INDEX = 'open-period-index'
+
+# Un item de DynamoDB no puede superar 400 KB: al llegar al máximo de líneas
+# el periodo continúa en otra parte (INV-<periodo>-<placa>-2, -3, ...)
+MAX_LINES_PER_INVOICE = 500
+MAX_PARTS = 20
+ZERO = Decimal('0.00')
+
+
+def is_enabled(period=None):
+    return (period or INVOICE_PERIOD) in ('daily', 'monthly')
+
+
+def to_decimal(value):
+    """Convierte a Decimal."""
+    if value is None:
+        return ZERO
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def period_key(moment=None, period=None):
+    """Clave del periodo (UTC): '2025-11-12' (daily) o '2025-11' (monthly)."""
+    moment = moment or datetime.utcnow()
+    if (period or INVOICE_PERIOD) == 'monthly':
+        return moment.strftime('%Y-%m')
+    return moment.strftime('%Y-%m-%d')
+
+
+def previous_periods(count, now=None, period=None):
+    """Claves de los últimos `count` periodos ya terminados (más reciente primero)."""
+    now = now or datetime.utcnow()
+    period = period or INVOICE_PERIOD
+    keys = []
+    cursor = now
+    for _ in range(count):
+        if period == 'monthly':
+            cursor = cursor.replace(day=1) - timedelta(days=1)
+        else:
+            cursor = cursor - timedelta(days=1)
+        keys.append(period_key(cursor, period))
+    return keys
+
+
+def invoice_id_for(placa, key, part=1):
+    if part == 1:
+        return f"INV-{key}-{placa}"
+    return f"INV-{key}-{placa}-{part}"
+
+
+def _line(event_id, peaje_id, amount, late_fee, timestamp):
+    line = {
+        'event_id': event_id,
+        'peaje_id': peaje_id,
+        'amount': to_decimal(amount),
+        'timestamp': timestamp
+    }
+    if to_decimal(late_fee) > 0:
+        line['late_fee'] = to_decimal(late_fee)
+    return line
+
+
+def append(dynamodb, invoices_table_name, placa, event_id, charge, peaje_id=None,
+           late_fee=0, timestamp=None, now=None):
+    """
+    Agrega un cruce cobrado al invoice abierto del periodo actual de la placa
+    (lo crea si no existe). Idempotente por event_id.
+    charge: {'total', 'subtotal', 'tax', 'currency'}; total incluye la mora.
+    Retorna el invoice_id o None si el periodo ya fue cerrado (el llamador
+    crea un invoice individual).
+    """
+    now = now or datetime.utcnow()
+    key = period_key(now)
+    updated_at = now.isoformat() + 'Z'
+    table = dynamodb.Table(invoices_table_name)
+
+    for part in range(1, MAX_PARTS + 1):
+        invoice_id = invoice_id_for(placa, key, part)
+        try:
+            table.update_item(
+                Key={'placa': placa, 'invoice_id': invoice_id},
+                UpdateExpression=(
+                    'SET #status = :open, open_period = :period, period = :period, '
+                    'period_type = :period_type, currency = if_not_exists(currency, :currency), '
+                    'created_at = if_not_exists(created_at, :now), updated_at = :now, '
+                    'transactions = list_append(if_not_exists(transactions, :empty), :line) '
+                    'ADD amount :amount, subtotal :subtotal, tax :tax, late_fee :late_fee, '
+                    'crossings :one, event_ids :event_ids'
+                ),
+                ConditionExpression=(
+                    '(attribute_not_exists(invoice_id) OR #status = :open) '
+                    'AND (attribute_not_exists(crossings) OR crossings < :max_lines) '
+                    'AND NOT contains(event_ids, :event_id)'
+                ),
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':open': OPEN_STATUS,
+                    ':period': key,
+                    ':period_type': INVOICE_PERIOD,
+                    ':currency': charge.get('currency', 'GTQ'),
+                    ':now': updated_at,
+                    ':empty': [],
+                    ':line': [_line(event_id, peaje_id, charge.get('total', 0), late_fee, timestamp or updated_at)],
+                    ':amount': to_decimal(charge.get('total', 0)),
+                    ':subtotal': to_decimal(charge.get('subtotal', 0)),
+                    ':tax': to_decimal(charge.get('tax', 0)),
+                    ':late_fee': to_decimal(late_fee),
+                    ':one': 1,
+                    ':event_ids': {event_id},
+                    ':event_id': event_id,
+                    ':max_lines': MAX_LINES_PER_INVOICE
+                }
+            )
+            return invoice_id
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+        # Distinguir entre reintento, periodo cerrado y parte llena
+        current = table.get_item(Key={'placa': placa, 'invoice_id': invoice_id}, ConsistentRead=True).get('Item', {})
+        if event_id in current.get('event_ids', set()):
+            return invoice_id
+        if current.get('status') != OPEN_STATUS:
+            return None
+    raise ValueError(f'Invoice period {key} for {placa} exceeded {MAX_PARTS} parts')
+
+
+def open_invoices(dynamodb, invoices_table_name, key):
+    """Claves (placa, invoice_id) de los invoices abiertos de un periodo."""
+    table = dynamodb.Table(invoices_table_name)
+    kwargs = {
+        'IndexName': OPEN_PERIOD_INDEX,
+        'KeyConditionExpression': Key('open_period').eq(key)
+    }
+    while True:
+        response = table.query(**kwargs)
+        for item in response.get('Items', []):
+            yield {'placa': item['placa'], 'invoice_id': item['invoice_id']}
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def close(dynamodb, invoices_table_name, invoice_key, now=None):
+    """
+    Finaliza un invoice de periodo: lo marca pagado y lo saca del índice de
+    abiertos. Retorna el item cerrado o None si ya estaba cerrado.
+    """
+    closed_at = (now or datetime.utcnow()).isoformat() + 'Z'
+    try:
+        response = dynamodb.Table(invoices_table_name).update_item(
+            Key=invoice_key,
+            UpdateExpression='SET #status = :closed, closed_at = :closed_at REMOVE open_period',
+            ConditionExpression='#status = :open',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':closed': CLOSED_STATUS,
+                ':open': OPEN_STATUS,
+                ':closed_at': closed_at
+            },
+            ReturnValues='ALL_NEW'
+        )
+        return response['Attributes']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return None
+        raise
@@ -0,0 +1,170 @@
+import itertools
+import json
+import os
+import re
+import time
+import boto3
+from botocore.exceptions import ClientError
+
+# Coincidencia tolerante a errores de OCR de las cámaras de los peajes.
+# Formato de placa: prefijo de tipo (P, A, C, M, O, TC, CD...), bloque de 3
+# dígitos y bloque de 3 letras (P-123ABC). El OCR confunde letras con dígitos
+# (O/Q/D-0, I/L-1, Z-2, S-5, G-6, B-8). Esas confusiones se corrigen solo por
+# posición: una letra leída en el bloque de dígitos, o un dígito leído en el
+# prefijo o en el bloque de letras. Nunca se cambia una letra por otra ni un
+# dígito por otro, y una lectura que ya tiene el formato no se corrige:
+# "P-123ABD" y "P-123ABQ" son placas distintas.
+# El índice de placas registradas lo publica build_plate_index en S3
+# (reconstrucción programada + altas del stream de UsersVehicles); las
+# funciones lo cargan en la fase de init y nunca leen UsersVehicles completo.
+PLATE_FORMAT = re.compile(r'^([A-Z]{1,3})([0-9]{3})([A-Z]{3})$')
+OCR_CONFUSIONS = (
+    ('O', '0'), ('Q', '0'), ('D', '0'),
+    ('I', '1'), ('L', '1'),
+    ('Z', '2'),
+    ('S', '5'),
+    ('G', '6'),
+    ('B', '8')
+)
+DIGITS_FOR_LETTER = {}
+LETTERS_FOR_DIGIT = {}
+for _letter, _digit in OCR_CONFUSIONS:
+    DIGITS_FOR_LETTER.setdefault(_letter, []).append(_digit)
+    LETTERS_FOR_DIGIT.setdefault(_digit, []).append(_letter)
+NON_ALNUM = re.compile(r'[^0-9A-Z]')
+# Lecturas con demasiadas posiciones ambiguas no son confiables
+MAX_REPAIRS = 64
+
+INDEXES_BUCKET = os.environ.get('INDEXES_BUCKET')
+PLATE_INDEX_KEY = 'indexes/placas.json'
+PLATE_MATCHING_ENABLED = os.environ.get('PLATE_MATCHING_ENABLED', 'true').lower() == 'true'
+# Cada cuánto se consulta si el índice publicado cambió (get_object con If-None-Match)
+PLATE_INDEX_REFRESH_SECONDS = int(os.environ.get('PLATE_INDEX_REFRESH_SECONDS', '60'))
+
+
+def normalize(placa):
+    """Mayúsculas, sin guiones, espacios ni otros separadores."""
+    return NON_ALNUM.sub('', str(placa or '').upper())
+
+
+def is_well_formed(placa):
+    return PLATE_FORMAT.match(normalize(placa)) is not None
+
+
+def repairs(observed):
+    """
+    Placas con formato válido (normalizadas) que la cámara pudo haber leído
+    como observed, corrigiendo solo confusiones letra/dígito en su bloque.
+    Una lectura con formato válido solo se repara a sí misma.
+    """
+    text = normalize(observed)
+    if PLATE_FORMAT.match(text):
+        return {text}
+    if not 7 <= len(text) <= 9:
+        return set()
+    digit_block = range(len(text) - 6, len(text) - 3)
+    options = []
+    for position, char in enumerate(text):
+        if position in digit_block:
+            choices = (char,) if char.isdigit() else DIGITS_FOR_LETTER.get(char, ())
+        else:
+            choices = (char,) if char.isalpha() else LETTERS_FOR_DIGIT.get(char, ())
+        if not choices:
+            return set()
+        options.append(choices)
+    if _product_size(options) > MAX_REPAIRS:
+        return set()
+    return {''.join(chars) for chars in itertools.product(*options)}
+
+
+def _product_size(options):
+    size = 1
+    for choices in options:
+        size *= len(choices)
+    return size
+
+
+def is_ocr_variant(observed, placa):
+    """True si la lectura observed puede ser la placa placa mal leída por el OCR."""
+    if normalize(observed) == normalize(placa):
+        return True
+    return normalize(placa) in repairs(observed)
+
+
+class PlateIndex:
+    """
+    Placas registradas por forma normalizada ({'P123ABC': 'P-123ABC'}). Solo
+    se indexan placas con formato válido y que pueden reclamar un cruce
+    (registradas o con tag): corregir una lectura hacia una no_registrado no
+    cambia la tarifa y atribuiría el cruce a otro vehículo.
+    """
+
+    def __init__(self, by_key=None):
+        self.by_key = dict(by_key or {})
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def add(self, placa):
+        key = normalize(placa)
+        if PLATE_FORMAT.match(key):
+            self.by_key[key] = placa
+
+    def candidates(self, observed):
+        """Placas registradas compatibles con la lectura. Retorna un set (vacío si no hay)."""
+        return {self.by_key[key] for key in repairs(observed) if key in self.by_key}
+
+    def to_bytes(self):
+        return json.dumps(self.by_key, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, data):
+        by_key = json.loads(data)
+        if not isinstance(by_key, dict):
+            raise ValueError('Invalid plate index artifact')
+        return cls(by_key)
+
+
+class IndexLoader:
+    """
+    Mantiene en el contenedor la última versión del índice publicado en S3.
+    get() retorna el PlateIndex o None (sin índice no se corrige ninguna placa).
+    """
+
+    def __init__(self, bucket=None, key=PLATE_INDEX_KEY, enabled=None):
+        self.bucket = bucket or INDEXES_BUCKET
+        self.key = key
+        self.enabled = PLATE_MATCHING_ENABLED if enabled is None else enabled
+        self.etag = None
+        self.checked_at = 0
+        self.index = None
+        self._s3 = None
+
+    def get(self):
+        if not self.enabled or not self.bucket:
+            return None
+        now = time.time()
+        if now - self.checked_at >= PLATE_INDEX_REFRESH_SECONDS:
+            self.checked_at = now
+            try:
+                self._refresh()
+            except (ClientError, ValueError) as e:
+                print(f'Warning: plate index {self.key} unavailable: {e}')
+                self.index = None
+                self.etag = None
+        return self.index
+
+    def _refresh(self):
+        if self._s3 is None:
+            self._s3 = boto3.client('s3')
+        kwargs = {'Bucket': self.bucket, 'Key': self.key}
+        if self.etag and self.index is not None:
+            kwargs['IfNoneMatch'] = self.etag
+        try:
+            response = self._s3.get_object(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return
+            raise
+        self.index = PlateIndex.from_bytes(response['Body'].read())
+        self.etag = response['ETag']
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from botocore.exceptions import ClientError
+import tag_versions
+
+# Sincronización incremental de datos semilla (seed_csv y scripts/load_csv_data.py).
+# Cada item guarda la huella (source_hash) de la fila de origen con que se
+# escribió. Un scan paralelo lee las huellas actuales y solo se escriben las
+# filas nuevas o cambiadas. Los campos vivos (balance, deuda, saldo...) se
+# escriben solo al insertar: un re-seed nunca pisa lo que cambió en operación.
+HASH_FIELD = 'source_hash'
+SEED_SYNC_SEGMENTS = int(os.environ.get('SEED_SYNC_SEGMENTS', '4'))
+
+# Campos que solo se escriben al crear el item, por tabla
+USERS_INSERT_ONLY = ('saldo_disponible', 'created_at')
+TAGS_INSERT_ONLY = ('status', 'balance', 'debt', 'late_fee', 'has_debt', 'created_at', 'version')
+TOLLS_INSERT_ONLY = ('created_at',)
+
+
+def fingerprint(item, insert_only=(), touch=None):
+    """Huella de los campos de origen de un item (excluye campos vivos y timestamps)."""
+    source = {
+        key: value for key, value in item.items()
+        if key not in insert_only and key != touch and key != HASH_FIELD
+    }
+    canonical = json.dumps(source, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+
+def _scan_segment(client, table_name, key_name, segment, total_segments):
+    kwargs = {
+        'TableName': table_name,
+        'ProjectionExpression': '#key, #hash',
+        'ExpressionAttributeNames': {'#key': key_name, '#hash': HASH_FIELD},
+        'Segment': segment,
+        'TotalSegments': total_segments
+    }
+    found = {}
+    while True:
+        response = client.scan(**kwargs)
+        for item in response.get('Items', []):
+            found[item[key_name]] = item.get(HASH_FIELD)
+        if 'LastEvaluatedKey' not in response:
+            return found
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def scan_fingerprints(dynamodb, table_name, key_name, segments=None):
+    """
+    Huellas actuales de la tabla: {llave: source_hash o None}. Scan paralelo
+    por segmentos con el cliente (thread-safe), proyectando solo la llave y la huella.
+    """
+    segments = segments or SEED_SYNC_SEGMENTS
+    client = dynamodb.meta.client
+    found = {}
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [
+            executor.submit(_scan_segment, client, table_name, key_name, segment, segments)
+            for segment in range(segments)
+        ]
+        for future in futures:
+            found.update(future.result())
+    return found
+
+
+def _update_kwargs(item, key_name, digest, insert_only, touch, timestamp, versioned):
+    sets, removes = [f'#{HASH_FIELD} = :{HASH_FIELD}'], []
+    names = {f'#{HASH_FIELD}': HASH_FIELD}
+    values = {f':{HASH_FIELD}': digest}
+    for index, (field, value) in enumerate(sorted(item.items())):
+        if field in (key_name, touch, HASH_FIELD) or (versioned and field == 'version'):
+            continue
+        name, placeholder = f'#f{index}', f':f{index}'
+        if value is None:
+            if field not in insert_only:
+                names[name] = field
+                removes.append(name)
+            continue
+        names[name] = field
+        values[placeholder] = value
+        if field in insert_only:
+            sets.append(f'{name} = if_not_exists({name}, {placeholder})')
+        else:
+            sets.append(f'{name} = {placeholder}')
+    if touch:
+        names['#touch'] = touch
+        values[':touch'] = timestamp
+        sets.append('#touch = :touch')
+    expression = 'SET ' + ', '.join(sets)
+    if removes:
+        expression += ' REMOVE ' + ', '.join(removes)
+    kwargs = {
+        'Key': {key_name: item[key_name]},
+        'UpdateExpression': expression,
+        'ExpressionAttributeNames': names,
+        'ExpressionAttributeValues': values
+    }
+    return tag_versions.versioned(kwargs) if versioned else kwargs
+
+
+def sync_items(dynamodb, table_name, key_name, items, insert_only=(), touch=None,
+               versioned=False, segments=None, existing=None):
+    """
+    Escribe solo los items nuevos o cuya huella cambió.
+    - Nuevo: put condicionado a que la llave no exista (si otro escritor lo
+      creó entre el scan y el put, se trata como cambiado).
+    - Cambiado: update de los campos de origen; los campos insert_only solo
+      se completan si faltan (if_not_exists) y los de origen en None se borran.
+    touch: campo de timestamp que se escribe en cada cambio (fuera de la huella).
+    versioned: incrementa la versión de tag_versions (items de Tags).
+    existing: huellas ya leídas ({llave: huella}); si es None se hace el scan.
+    Retorna {'inserted': [llaves], 'updated': [llaves], 'unchanged': n}.
+    """
+    table = dynamodb.Table(table_name)
+    if existing is None:
+        existing = scan_fingerprints(dynamodb, table_name, key_name, segments)
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+    result = {'inserted': [], 'updated': [], 'unchanged': 0}
+
+    for item in items:
+        key = item[key_name]
+        digest = fingerprint(item, insert_only, touch)
+        if key in existing and existing[key] == digest:
+            result['unchanged'] += 1
+            continue
+        if key not in existing:
+            new_item = {field: value for field, value in item.items() if value is not None}
+            new_item[HASH_FIELD] = digest
+            if touch:
+                new_item[touch] = timestamp
+            try:
+                table.put_item(Item=new_item, ConditionExpression='attribute_not_exists(#key)',
+                               ExpressionAttributeNames={'#key': key_name})
+                result['inserted'].append(key)
+                existing[key] = digest
+                continue
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        table.update_item(**_update_kwargs(item, key_name, digest, insert_only, touch, timestamp, versioned))
+        result['updated'].append(key)
+        existing[key] = digest
+    return result
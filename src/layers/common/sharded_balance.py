@@ -0,0 +1,369 @@
+import hashlib
+import os
+import time
+import zlib
+from datetime import datetime
+from decimal import Decimal, ROUND_DOWN
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+import tag_versions
+
+# Balance fragmentado (write sharding) para tags de flotas con muchos cruces.
+# Un tag designado tiene balance_shards = N en su item de Tags y su balance vive
+# repartido en N items de TagBalanceShards (tag_id, shard). Los débitos se
+# enrutan por hash, así que ningún item recibe todas las escrituras.
+# La deuda y la mora siguen en el item de Tags (se escriben solo sin fondos).
+# Cada débito escribe en la misma transacción un marcador por referencia
+# (shard negativo, ver marker_shard) con su resultado: una re-entrega con la
+# misma referencia no vuelve a descontar y recibe el resultado original.
+TAG_SHARDS_TABLE = os.environ.get('TAG_SHARDS_TABLE')
+MAX_SHARDS = 25
+SHARD_TOTAL_CACHE_SECONDS = float(os.environ.get('SHARD_TOTAL_CACHE_SECONDS', '5'))
+
+# Shards probados antes de recurrir a un débito con rebalanceo
+DEBIT_PROBES = 2
+MAX_DEBIT_ATTEMPTS = 3
+ZERO = Decimal('0.00')
+CENT = Decimal('0.01')
+
+# Cache por contenedor: tag_id -> (total, cargado_en)
+_total_cache = {}
+
+
+def to_decimal(value):
+    """Convierte a Decimal."""
+    if value is None:
+        return ZERO
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def is_sharded(tag):
+    """Indica si el tag está en modo de balance fragmentado."""
+    return int(tag.get('balance_shards') or 0) > 0
+
+
+def shard_count(tag):
+    return int(tag.get('balance_shards') or 0)
+
+
+def shard_for(reference, shards):
+    """Shard asignado a un débito: hash estable de la referencia (event_id)."""
+    return zlib.crc32(str(reference).encode('utf-8')) % shards
+
+
+def marker_shard(reference):
+    """
+    Llave del marcador de idempotencia de un débito: hash de 120 bits de la
+    referencia, negativo para no chocar con los shards (0..N-1).
+    """
+    digest = hashlib.blake2b(str(reference).encode('utf-8'), digest_size=15).digest()
+    return -1 - int.from_bytes(digest, 'big')
+
+
+def split(total, shards):
+    """Reparte un total en N partes de centavos enteros (el residuo va al shard 0)."""
+    total = to_decimal(total)
+    part = (total / shards).quantize(CENT, rounding=ROUND_DOWN)
+    parts = [part] * shards
+    parts[0] += total - part * shards
+    return parts
+
+
+def read_shards(dynamodb, tag_id, consistent=True):
+    """Lee los shards de un tag: {shard: balance}. Los marcadores de débito no se leen."""
+    table = dynamodb.Table(TAG_SHARDS_TABLE)
+    kwargs = {
+        'KeyConditionExpression': Key('tag_id').eq(tag_id) & Key('shard').gte(0),
+        'ConsistentRead': consistent
+    }
+    shards = {}
+    while True:
+        response = table.query(**kwargs)
+        for item in response.get('Items', []):
+            shards[int(item['shard'])] = to_decimal(item.get('balance', 0))
+        if 'LastEvaluatedKey' not in response:
+            return shards
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def read_total(dynamodb, tag_id, max_age=None):
+    """
+    Balance total del tag (suma de shards). Usa el total cacheado en el
+    contenedor si tiene menos de max_age segundos (default SHARD_TOTAL_CACHE_SECONDS).
+    """
+    max_age = SHARD_TOTAL_CACHE_SECONDS if max_age is None else max_age
+    cached = _total_cache.get(tag_id)
+    if cached and time.monotonic() - cached[1] <= max_age:
+        return cached[0]
+    total = sum(read_shards(dynamodb, tag_id).values(), ZERO)
+    _total_cache[tag_id] = (total, time.monotonic())
+    return total
+
+
+def _adjust_cached_total(tag_id, delta):
+    cached = _total_cache.get(tag_id)
+    if cached:
+        _total_cache[tag_id] = (max(ZERO, cached[0] + delta), cached[1])
+
+
+def invalidate(tag_id):
+    _total_cache.pop(tag_id, None)
+
+
+def _shard_update(tag_id, shard, delta, minimum=None, observed=None):
+    """Update de un shard dentro de TransactWriteItems."""
+    update = {
+        'TableName': TAG_SHARDS_TABLE,
+        'Key': {'tag_id': tag_id, 'shard': shard},
+        'UpdateExpression': 'SET balance = balance + :delta, updated_at = :updated_at',
+        'ExpressionAttributeValues': {':delta': delta, ':updated_at': datetime.utcnow().isoformat() + 'Z'}
+    }
+    if observed is not None:
+        update['ConditionExpression'] = 'balance = :observed'
+        update['ExpressionAttributeValues'][':observed'] = observed
+    elif minimum is not None:
+        update['ConditionExpression'] = 'balance >= :minimum'
+        update['ExpressionAttributeValues'][':minimum'] = minimum
+    return {'Update': update}
+
+
+def credit_update(tag, amount, reference, timestamp):
+    """Crédito a un shard del tag (por hash de la referencia) dentro de TransactWriteItems."""
+    update = _shard_update(tag['tag_id'], shard_for(reference, shard_count(tag)), to_decimal(amount))
+    update['Update']['ExpressionAttributeValues'][':updated_at'] = timestamp
+    return update
+
+
+def _outcome(previous_balance, new_balance, debt_added, shard):
+    return {
+        'previous_balance': previous_balance,
+        'new_balance': new_balance,
+        'debt_added': debt_added,
+        'shard': shard
+    }
+
+
+def _marker_put(tag_id, reference, outcome, timestamp):
+    """
+    Put condicional del marcador de un débito dentro de TransactWriteItems.
+    Guarda el resultado para devolverlo igual ante una re-entrega.
+    """
+    return {
+        'Put': {
+            'TableName': TAG_SHARDS_TABLE,
+            'Item': {
+                'tag_id': tag_id,
+                'shard': marker_shard(reference),
+                'reference': str(reference),
+                'previous_balance': outcome['previous_balance'],
+                'new_balance': outcome['new_balance'],
+                'debt_added': outcome['debt_added'],
+                'shard_debited': outcome['shard'],
+                'created_at': timestamp
+            },
+            'ConditionExpression': 'attribute_not_exists(tag_id)'
+        }
+    }
+
+
+def _fetch_outcome(dynamodb, tag_id, reference):
+    """Resultado original de un débito ya registrado con la referencia."""
+    marker = dynamodb.Table(TAG_SHARDS_TABLE).get_item(
+        Key={'tag_id': tag_id, 'shard': marker_shard(reference)},
+        ConsistentRead=True
+    ).get('Item')
+    if not marker or marker.get('reference') != str(reference):
+        raise ValueError(f'Debit marker for {reference} not found on tag {tag_id}')
+    return {
+        'previous_balance': to_decimal(marker['previous_balance']),
+        'new_balance': to_decimal(marker['new_balance']),
+        'debt_added': to_decimal(marker['debt_added']),
+        'shard': int(marker['shard_debited']),
+        'duplicate': True
+    }
+
+
+def _transact_debit(dynamodb, items, marker):
+    """
+    Ejecuta un débito (items) junto con su marcador, que va al final.
+    Retorna 'debited', 'duplicate' si la referencia ya estaba registrada o
+    'cancelled' si falló otra condición o hubo conflicto.
+    """
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=[*items, marker])
+        return 'debited'
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'TransactionCanceledException':
+            raise
+        reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+        if len(reasons) == len(items) + 1 and reasons[-1] == 'ConditionalCheckFailed':
+            return 'duplicate'
+        return 'cancelled'
+
+
+def _debit_with_rebalance(dynamodb, tags_table_name, tag_id, target, amount, reference, timestamp):
+    """
+    Débito lento cuando los shards probados están secos. En una sola
+    transacción mueve fondos de otros shards al shard destino y descuenta el
+    monto. Si la suma de todos los shards no alcanza, los vacía y registra el
+    faltante como deuda en Tags (misma semántica que update_tag_balance).
+    Retorna el resultado del débito, el original si la referencia ya estaba
+    registrada, o None si hubo conflicto (reintentar).
+    """
+    shards = read_shards(dynamodb, tag_id)
+    total = sum(shards.values(), ZERO)
+    items = []
+
+    if total >= amount:
+        needed = amount - shards.get(target, ZERO)
+        for shard, balance in sorted(shards.items(), key=lambda kv: kv[1], reverse=True):
+            if shard == target or needed <= 0 or balance <= 0:
+                continue
+            take = min(balance, needed)
+            items.append(_shard_update(tag_id, shard, -take, minimum=take))
+            needed -= take
+        moved = sum((-item['Update']['ExpressionAttributeValues'][':delta'] for item in items), ZERO)
+        items.append(_shard_update(tag_id, target, moved - amount, minimum=amount - moved))
+        shortfall = ZERO
+    else:
+        for shard, balance in shards.items():
+            if balance != 0:
+                items.append(_shard_update(tag_id, shard, -balance, observed=balance))
+        shortfall = amount - total
+        items.append({
+            'Update': tag_versions.versioned({
+                'TableName': tags_table_name,
+                'Key': {'tag_id': tag_id},
+                'UpdateExpression': 'SET debt = if_not_exists(debt, :zero) + :shortfall, '
+                                    'has_debt = :has_debt, last_updated = :last_updated',
+                'ExpressionAttributeValues': {
+                    ':zero': ZERO,
+                    ':shortfall': shortfall,
+                    ':has_debt': True,
+                    ':last_updated': timestamp
+                }
+            })
+        })
+
+    outcome = _outcome(total, max(ZERO, total - amount), shortfall, target)
+    status = _transact_debit(dynamodb, items, _marker_put(tag_id, reference, outcome, timestamp))
+    if status == 'duplicate':
+        return _fetch_outcome(dynamodb, tag_id, reference)
+    if status == 'cancelled':
+        return None
+    _total_cache[tag_id] = (outcome['new_balance'], time.monotonic())
+    return outcome
+
+
+def debit(dynamodb, tags_table_name, tag, amount, reference, timestamp):
+    """
+    Descuenta un monto de un tag fragmentado, una sola vez por referencia.
+    Camino rápido: débito condicional en el shard asignado por hash (o el
+    siguiente). Camino lento: débito con rebalanceo o deuda si no hay fondos.
+    Retorna {'previous_balance', 'new_balance', 'debt_added', 'shard'}; si la
+    referencia ya estaba registrada retorna el resultado original con
+    'duplicate': True sin volver a descontar.
+    """
+    tag_id = tag['tag_id']
+    amount = to_decimal(amount)
+    shards = shard_count(tag)
+    target = shard_for(reference, shards)
+    previous_total = read_total(dynamodb, tag_id)
+
+    for offset in range(min(DEBIT_PROBES, shards)):
+        shard = (target + offset) % shards
+        outcome = _outcome(previous_total, max(ZERO, previous_total - amount), ZERO, shard)
+        status = _transact_debit(
+            dynamodb,
+            [_shard_update(tag_id, shard, -amount, minimum=amount)],
+            _marker_put(tag_id, reference, outcome, timestamp)
+        )
+        if status == 'duplicate':
+            return _fetch_outcome(dynamodb, tag_id, reference)
+        if status == 'debited':
+            _adjust_cached_total(tag_id, -amount)
+            return outcome
+
+    for _ in range(MAX_DEBIT_ATTEMPTS):
+        outcome = _debit_with_rebalance(dynamodb, tags_table_name, tag_id, target, amount, reference, timestamp)
+        if outcome is not None:
+            return outcome
+    raise ValueError(f'Could not debit sharded tag {tag_id} after {MAX_DEBIT_ATTEMPTS} attempts')
+
+
+def set_total(dynamodb, tag_id, total, shards, previous_shards=0):
+    """
+    Reemplaza el balance de un tag por un total repartido en N shards
+    (habilitar, re-fragmentar o PUT con balance absoluto). Escritura ciega,
+    igual que el PUT original de manage_tags.
+    """
+    table = dynamodb.Table(TAG_SHARDS_TABLE)
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+    with table.batch_writer() as batch:
+        for shard, balance in enumerate(split(total, shards) if shards else []):
+            batch.put_item(Item={'tag_id': tag_id, 'shard': shard, 'balance': balance, 'updated_at': timestamp})
+        for shard in range(shards, previous_shards):
+            batch.delete_item(Key={'tag_id': tag_id, 'shard': shard})
+    invalidate(tag_id)
+
+
+def enable(dynamodb, tags_table_name, tag, shards):
+    """
+    Activa (o cambia) el modo fragmentado de un tag moviendo su balance a N
+    shards. Con shards = 0 lo desactiva y devuelve el total al item de Tags.
+    Retorna el balance total.
+    """
+    if shards < 0 or shards > MAX_SHARDS:
+        raise ValueError(f'balance_shards must be between 0 and {MAX_SHARDS}')
+    tag_id = tag['tag_id']
+    previous = shard_count(tag)
+    total = read_total(dynamodb, tag_id, max_age=0) if previous else to_decimal(tag.get('balance', 0))
+    tags_table = dynamodb.Table(tags_table_name)
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+
+    if shards == 0:
+        tags_table.update_item(**tag_versions.versioned({
+            'Key': {'tag_id': tag_id},
+            'UpdateExpression': 'SET balance = :balance, last_updated = :last_updated REMOVE balance_shards',
+            'ExpressionAttributeValues': {':balance': total, ':last_updated': timestamp}
+        }))
+        set_total(dynamodb, tag_id, ZERO, 0, previous_shards=previous)
+        return total
+
+    set_total(dynamodb, tag_id, total, shards, previous_shards=previous)
+    tags_table.update_item(**tag_versions.versioned({
+        'Key': {'tag_id': tag_id},
+        'UpdateExpression': 'SET balance_shards = :shards, balance = :balance, last_updated = :last_updated',
+        'ExpressionAttributeValues': {':shards': shards, ':balance': total, ':last_updated': timestamp}
+    }))
+    return total
+
+
+def rebalance(dynamodb, tag_id, shards=None):
+    """
+    Empareja los shards de un tag (transferencias condicionadas al balance
+    observado). Retorna el total o None si hubo conflicto con un débito.
+    """
+    current = read_shards(dynamodb, tag_id)
+    if not current:
+        return ZERO
+    shards = shards or len(current)
+    total = sum(current.values(), ZERO)
+    target = split(total, shards)
+    items = []
+    for shard in range(shards):
+        delta = target[shard] - current.get(shard, ZERO)
+        if delta != 0:
+            items.append(_shard_update(tag_id, shard, delta, observed=current.get(shard, ZERO)))
+    if not items:
+        return total
+    try:
+        dynamodb.meta.client.transact_write_items(TransactItems=items)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'TransactionCanceledException':
+            return None
+        raise
+    invalidate(tag_id)
+    return total
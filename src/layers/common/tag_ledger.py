@@ -0,0 +1,338 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+import sharded_balance
+import tag_versions
+
+# Ledger append-only de balances de Tags.
+# El item de Tags guarda un snapshot (balance, debt, late_fee) y un
+# ledger_watermark: el entry_id de la última entrada plegada en el snapshot.
+# El estado actual es snapshot + entradas posteriores al watermark (la "cola").
+TAG_LEDGER_TABLE = os.environ.get('TAG_LEDGER_TABLE')
+TAG_LEDGER_ENABLED = os.environ.get('TAG_LEDGER_ENABLED', 'false').lower() == 'true'
+
+# El compactador solo pliega entradas con más antigüedad que este margen, para que
+# un append en curso nunca quede por debajo del watermark (Lambda timeout = 30s).
+COMPACTION_GRACE_SECONDS = int(os.environ.get('LEDGER_COMPACTION_GRACE_SECONDS', '45'))
+
+ENTRY_TYPES = ('debit', 'credit', 'late_fee', 'settlement', 'adjustment')
+
+# Prefijos de la RANGE key: entradas ordenadas por tiempo y marcadores de idempotencia
+ENTRY_PREFIX = 'E#'
+MARKER_PREFIX = 'R#'
+ENTRY_UPPER_BOUND = ENTRY_PREFIX + '~'
+
+MAX_APPEND_ATTEMPTS = 3
+ZERO = Decimal('0.00')
+
+
+class DuplicateEntry(Exception):
+    """La referencia ya fue registrada en el ledger (reintento idempotente)."""
+
+    def __init__(self, entry):
+        super().__init__(f"Entry {entry.get('entry_id')} already recorded")
+        self.entry = entry
+
+
+def to_decimal(value):
+    """Convierte a Decimal."""
+    if value is None:
+        return ZERO
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def now_iso(now=None):
+    """Timestamp ISO 8601 de ancho fijo (microsegundos) para ordenar entradas."""
+    return (now or datetime.utcnow()).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def snapshot_of(tag):
+    """Extrae el snapshot de balance del item de Tags."""
+    return {
+        'balance': to_decimal(tag.get('balance', 0)),
+        'debt': to_decimal(tag.get('debt', 0)),
+        'late_fee': to_decimal(tag.get('late_fee', 0))
+    }
+
+
+def apply_entry(state, entry):
+    """
+    Aplica una entrada del ledger al estado (balance, debt, late_fee).
+    Mantiene la semántica de update_tag_balance: un débito sin fondos deja el
+    balance en 0 y el faltante pasa a deuda.
+    """
+    balance = state['balance']
+    debt = state['debt']
+    late_fee = state['late_fee']
+    entry_type = entry['entry_type']
+    amount = to_decimal(entry.get('amount', 0))
+
+    if entry_type == 'debit':
+        balance -= amount
+        if balance < 0:
+            debt += -balance
+            balance = ZERO
+    elif entry_type == 'credit':
+        balance += amount
+    elif entry_type == 'late_fee':
+        late_fee += amount
+    elif entry_type == 'settlement':
+        debt = max(ZERO, debt - amount)
+    elif entry_type == 'adjustment':
+        balance += to_decimal(entry.get('balance_delta', 0))
+        debt += to_decimal(entry.get('debt_delta', 0))
+        late_fee += to_decimal(entry.get('late_fee_delta', 0))
+    else:
+        raise ValueError(f'Unknown ledger entry type: {entry_type}')
+
+    return {'balance': balance, 'debt': debt, 'late_fee': late_fee}
+
+
+def fold(snapshot, entries):
+    """Pliega las entradas (ya ordenadas) sobre el snapshot."""
+    state = dict(snapshot)
+    for entry in entries:
+        state = apply_entry(state, entry)
+    return state
+
+
+def query_entries(ledger_table, tag_id, after=None, until=None):
+    """
+    Lee las entradas de un tag con entry_id en (after, until], en orden.
+    Usa lectura consistente para que un append recién hecho sea visible.
+    """
+    lower = after or ENTRY_PREFIX
+    upper = until or ENTRY_UPPER_BOUND
+    if lower >= upper:
+        return []
+    kwargs = {
+        'KeyConditionExpression': Key('tag_id').eq(tag_id) & Key('entry_id').between(lower, upper),
+        'ConsistentRead': True
+    }
+    entries = []
+    while True:
+        response = ledger_table.query(**kwargs)
+        entries.extend(item for item in response.get('Items', []) if item['entry_id'] != after)
+        if 'LastEvaluatedKey' not in response:
+            return entries
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def current_state(dynamodb, tag):
+    """Balance actual del tag: snapshot + cola de entradas no compactadas."""
+    ledger_table = dynamodb.Table(TAG_LEDGER_TABLE)
+    tail = query_entries(ledger_table, tag['tag_id'], after=tag.get('ledger_watermark'))
+    state = fold(snapshot_of(tag), tail)
+    state['tail_length'] = len(tail)
+    return state
+
+
+def state_before(dynamodb, tag, entry):
+    """
+    Estado del tag justo antes de una entrada ya registrada: snapshot + las
+    entradas anteriores de la cola. None si la entrada ya se compactó (el
+    snapshot la incluye y no se puede separar).
+    """
+    watermark = tag.get('ledger_watermark')
+    if 'entry_type' not in entry or (watermark and entry['entry_id'] <= watermark):
+        return None
+    ledger_table = dynamodb.Table(TAG_LEDGER_TABLE)
+    earlier = query_entries(ledger_table, tag['tag_id'], after=watermark, until=entry['entry_id'])
+    return fold(snapshot_of(tag), [item for item in earlier if item['entry_id'] != entry['entry_id']])
+
+
+def read_state(dynamodb, tag):
+    """
+    Estado de balance del tag según el modo: snapshot + cola o solo el item.
+    En tags fragmentados el balance es la suma de sus shards.
+    """
+    state = current_state(dynamodb, tag) if TAG_LEDGER_ENABLED else snapshot_of(tag)
+    if sharded_balance.is_sharded(tag):
+        state['balance'] = sharded_balance.read_total(dynamodb, tag['tag_id'])
+    return state
+
+
+def _entry_item(tag_id, entry_type, amount, reference, created_at, **attributes):
+    item = {
+        'tag_id': tag_id,
+        'entry_id': f'{ENTRY_PREFIX}{created_at}#{reference}',
+        'entry_type': entry_type,
+        'amount': to_decimal(amount),
+        'reference': reference,
+        'created_at': created_at
+    }
+    for key, value in attributes.items():
+        if value is not None:
+            item[key] = to_decimal(value) if key.endswith('_delta') else value
+    return item
+
+
+def _fetch_marker_entry(ledger_table, tag_id, marker_id):
+    marker = ledger_table.get_item(
+        Key={'tag_id': tag_id, 'entry_id': marker_id},
+        ConsistentRead=True
+    ).get('Item', {})
+    if not marker.get('target'):
+        return marker
+    return ledger_table.get_item(
+        Key={'tag_id': tag_id, 'entry_id': marker['target']},
+        ConsistentRead=True
+    ).get('Item', marker)
+
+
+def fetch_entry(dynamodb, tag_id, entry_type, reference):
+    """Entrada registrada con la referencia (vía su marcador) o {} si no existe."""
+    return _fetch_marker_entry(
+        dynamodb.Table(TAG_LEDGER_TABLE), tag_id, f'{MARKER_PREFIX}{entry_type}#{reference}'
+    )
+
+
+def entry_puts(tag_id, entry_type, amount, reference, created_at, **attributes):
+    """
+    Puts de TransactWriteItems de una entrada y su marcador de idempotencia.
+    Retorna (entrada, [put_entrada, put_marcador]). Lo usan append y el alta
+    masiva de tags (saldo inicial en la misma transacción que crea el tag).
+    """
+    item = _entry_item(tag_id, entry_type, amount, reference, created_at, **attributes)
+    marker = {
+        'tag_id': tag_id,
+        'entry_id': f'{MARKER_PREFIX}{entry_type}#{reference}',
+        'target': item['entry_id'],
+        'created_at': created_at
+    }
+    return item, [
+        {'Put': {'TableName': TAG_LEDGER_TABLE, 'Item': item, 'ConditionExpression': 'attribute_not_exists(entry_id)'}},
+        {'Put': {'TableName': TAG_LEDGER_TABLE, 'Item': marker, 'ConditionExpression': 'attribute_not_exists(entry_id)'}}
+    ]
+
+
+def append(dynamodb, tags_table_name, tag_id, entry_type, amount=0, reference=None, **attributes):
+    """
+    Agrega una entrada al ledger con una escritura ciega condicional:
+    - ConditionCheck sobre Tags: el entry_id debe quedar por encima del watermark
+      (nunca se escribe "debajo" de un snapshot ya compactado).
+    - Put de la entrada y de un marcador R#<tipo>#<referencia> que hace el append
+      idempotente ante reintentos de Step Functions.
+    No escribe el item de Tags, así que los débitos no compiten entre sí.
+    Lanza DuplicateEntry si la referencia ya estaba registrada.
+    """
+    if entry_type not in ENTRY_TYPES:
+        raise ValueError(f'Unknown ledger entry type: {entry_type}')
+    reference = reference or str(uuid.uuid4())
+    marker_id = f'{MARKER_PREFIX}{entry_type}#{reference}'
+    client = dynamodb.meta.client
+
+    for _ in range(MAX_APPEND_ATTEMPTS):
+        item, puts = entry_puts(tag_id, entry_type, amount, reference, now_iso(), **attributes)
+        try:
+            client.transact_write_items(TransactItems=[
+                {
+                    'ConditionCheck': {
+                        'TableName': tags_table_name,
+                        'Key': {'tag_id': tag_id},
+                        'ConditionExpression': 'attribute_exists(tag_id) AND '
+                                               '(attribute_not_exists(ledger_watermark) OR ledger_watermark < :entry_id)',
+                        'ExpressionAttributeValues': {':entry_id': item['entry_id']}
+                    }
+                },
+                *puts
+            ])
+            return item
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+            if len(reasons) > 2 and reasons[2] == 'ConditionalCheckFailed':
+                ledger_table = dynamodb.Table(TAG_LEDGER_TABLE)
+                raise DuplicateEntry(_fetch_marker_entry(ledger_table, tag_id, marker_id))
+            if reasons and reasons[0] == 'ConditionalCheckFailed':
+                # Tag inexistente o watermark adelantado: si el tag no existe no tiene sentido reintentar
+                tag = dynamodb.Table(tags_table_name).get_item(Key={'tag_id': tag_id}).get('Item')
+                if not tag:
+                    raise ValueError(f'Tag {tag_id} not found')
+                continue
+            if 'TransactionConflict' in reasons:
+                continue
+            raise
+    raise ValueError(f'Could not append ledger entry for tag {tag_id} after {MAX_APPEND_ATTEMPTS} attempts')
+
+
+def compact(dynamodb, tags_table_name, tag_id, now=None):
+    """
+    Pliega en el snapshot de Tags las entradas con más de
+    COMPACTION_GRACE_SECONDS de antigüedad y avanza el watermark.
+    Las entradas no se borran: el ledger sigue siendo el registro de auditoría.
+    El update se condiciona a la versión leída del tag (deuda y mora también
+    las escriben otros) y se reintenta con el tag releído.
+    Retorna el número de entradas plegadas.
+    """
+    tags_table = dynamodb.Table(tags_table_name)
+    ledger_table = dynamodb.Table(TAG_LEDGER_TABLE)
+    now = now or datetime.utcnow()
+    cutoff = f'{ENTRY_PREFIX}{now_iso(now - timedelta(seconds=COMPACTION_GRACE_SECONDS))}'
+
+    for _ in range(tag_versions.MAX_VERSION_ATTEMPTS):
+        tag = tags_table.get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item')
+        if not tag:
+            return 0
+
+        watermark = tag.get('ledger_watermark')
+        entries = query_entries(ledger_table, tag_id, after=watermark, until=cutoff)
+        if not entries:
+            # Incluye el caso de otro compactador que avanzó el watermark primero
+            return 0
+
+        state = fold(snapshot_of(tag), entries)
+        update_kwargs = {
+            'Key': {'tag_id': tag_id},
+            'UpdateExpression': 'SET balance = :balance, debt = :debt, late_fee = :late_fee, has_debt = :has_debt, '
+                                'ledger_watermark = :watermark, ledger_compacted_at = :compacted_at, last_updated = :compacted_at',
+            'ExpressionAttributeValues': {
+                ':balance': state['balance'],
+                ':debt': state['debt'],
+                ':late_fee': state['late_fee'],
+                ':has_debt': state['debt'] > 0,
+                ':watermark': entries[-1]['entry_id'],
+                ':compacted_at': now_iso(now)
+            }
+        }
+        if watermark:
+            update_kwargs['ConditionExpression'] = 'ledger_watermark = :previous_watermark'
+            update_kwargs['ExpressionAttributeValues'][':previous_watermark'] = watermark
+        else:
+            update_kwargs['ConditionExpression'] = 'attribute_not_exists(ledger_watermark)'
+
+        try:
+            tags_table.update_item(**tag_versions.versioned(update_kwargs, expected=tag_versions.current(tag)))
+            return len(entries)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    raise tag_versions.VersionConflict(tag_id, tag_versions.current(tag))
+
+
+def reconcile(dynamodb, tags_table_name, tag_id):
+    """
+    Reconstruye el balance desde cero con todas las entradas del ledger y lo
+    compara con snapshot + cola. Requiere que el saldo inicial del tag se haya
+    registrado como entrada (credit con referencia 'opening').
+    """
+    tag = dynamodb.Table(tags_table_name).get_item(Key={'tag_id': tag_id}, ConsistentRead=True).get('Item')
+    if not tag:
+        raise ValueError(f'Tag {tag_id} not found')
+    entries = query_entries(dynamodb.Table(TAG_LEDGER_TABLE), tag_id)
+    replayed = fold({'balance': ZERO, 'debt': ZERO, 'late_fee': ZERO}, entries)
+    current = current_state(dynamodb, tag)
+    consistent = all(replayed[key] == current[key] for key in ('balance', 'debt', 'late_fee'))
+    return {
+        'tag_id': tag_id,
+        'entries': len(entries),
+        'replayed': {key: float(value) for key, value in replayed.items()},
+        'current': {key: float(current[key]) for key in ('balance', 'debt', 'late_fee')},
+        'consistent': consistent
+    }
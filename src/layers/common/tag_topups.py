@@ -0,0 +1,362 @@
+import os
+from datetime import datetime
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+import sharded_balance
+import tag_ledger
+import tag_versions
+
+# Recargas de tags (POST /users/{placa}/tag/topup y archivos de liquidación
+# bancaria). Una recarga paga primero la mora, luego la deuda, y el resto se
+# acredita al balance. Cada recarga queda registrada en TagTopups con la
+# referencia bancaria como llave: el registro es el comprobante y la marca de
+# idempotencia (la misma referencia nunca se aplica dos veces).
+TAG_TOPUPS_TABLE = os.environ.get('TAG_TOPUPS_TABLE')
+
+# Reintentos si la deuda o la mora del tag cambian entre la lectura y la escritura
+MAX_TOPUP_ATTEMPTS = 3
+ZERO = Decimal('0.00')
+
+
+class DuplicateTopup(Exception):
+    """La referencia bancaria ya fue aplicada (reintento idempotente)."""
+
+    def __init__(self, record):
+        super().__init__(f"Top-up {record.get('bank_reference')} already applied")
+        self.record = record
+
+
+def to_decimal(value):
+    """Convierte a Decimal."""
+    if value is None or value == '':
+        return ZERO
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+
+def split_payment(amount, debt, late_fee):
+    """Reparte el monto: (mora pagada, deuda pagada, crédito al balance)."""
+    amount = to_decimal(amount)
+    late_fee_paid = min(amount, max(ZERO, to_decimal(late_fee)))
+    debt_paid = min(amount - late_fee_paid, max(ZERO, to_decimal(debt)))
+    return late_fee_paid, debt_paid, amount - late_fee_paid - debt_paid
+
+
+def get_record(dynamodb, reference):
+    """Registro de una recarga por referencia (None si no existe)."""
+    return dynamodb.Table(TAG_TOPUPS_TABLE).get_item(
+        Key={'bank_reference': reference}, ConsistentRead=True
+    ).get('Item')
+
+
+def _observed(name, value):
+    """Condición: el atributo conserva el valor leído (ausente cuenta como 0)."""
+    if value > 0:
+        return f'{name} = :observed_{name}'
+    return f'(attribute_not_exists({name}) OR {name} = :observed_{name})'
+
+
+def _tag_update(tags_table_name, tag, debt, late_fee, late_fee_paid, debt_paid, credit, timestamp):
+    """
+    Update de Tags dentro de la transacción: ADD del crédito al balance y
+    deuda/mora nuevas condicionadas a que no hayan cambiado desde la lectura.
+    No se condiciona a la versión: un débito concurrente solo cambia el
+    balance, y el ADD conmuta con él.
+    """
+    new_debt = debt - debt_paid
+    expression = 'SET debt = :debt, late_fee = :late_fee, has_debt = :has_debt, last_updated = :last_updated'
+    values = {
+        ':debt': new_debt,
+        ':late_fee': late_fee - late_fee_paid,
+        ':has_debt': new_debt > 0,
+        ':last_updated': timestamp,
+        ':observed_debt': debt,
+        ':observed_late_fee': late_fee
+    }
+    if credit > 0 and not sharded_balance.is_sharded(tag):
+        expression += ' ADD balance :credit'
+        values[':credit'] = credit
+    return {
+        'Update': tag_versions.versioned({
+            'TableName': tags_table_name,
+            'Key': {'tag_id': tag['tag_id']},
+            'UpdateExpression': expression,
+            'ConditionExpression': 'attribute_exists(tag_id) AND ' + _observed('debt', debt)
+                                   + ' AND ' + _observed('late_fee', late_fee),
+            'ExpressionAttributeValues': values
+        })
+    }
+
+
+def _record(tag, reference, amount, late_fee_paid, debt_paid, credit, timestamp, source, attributes):
+    record = {
+        'bank_reference': reference,
+        'tag_id': tag['tag_id'],
+        'placa': tag.get('placa'),
+        'amount': to_decimal(amount),
+        'late_fee_paid': late_fee_paid,
+        'debt_paid': debt_paid,
+        'credited': credit,
+        'source': source,
+        'status': 'applied',
+        'applied_at': timestamp
+    }
+    record.update({key: value for key, value in attributes.items() if value is not None})
+    return record
+
+
+def _apply_ledger(dynamodb, tags_table_name, tag, reference, amount, timestamp, source, attributes):
+    """
+    Modo ledger: una entrada 'adjustment' con la referencia bancaria, en una
+    sola transacción con el comprobante. La deuda y la mora son snapshot +
+    cola, así que no hay atributo que condicionar: las recargas del tag se
+    serializan con ledger_topup_seq en Tags (condicionado al valor leído junto
+    con el estado), y si otra recarga se adelantó se relee y se reintenta.
+    """
+    tags_table = dynamodb.Table(tags_table_name)
+    entry_reference = f'topup:{reference}'
+    for _ in range(MAX_TOPUP_ATTEMPTS):
+        state = tag_ledger.read_state(dynamodb, tag)
+        late_fee_paid, debt_paid, credit = split_payment(amount, state['debt'], state['late_fee'])
+        record = _record(tag, reference, amount, late_fee_paid, debt_paid, credit, timestamp, source, attributes)
+        record['remaining_debt'] = max(ZERO, state['debt'] - debt_paid)
+        record['remaining_late_fee'] = max(ZERO, state['late_fee'] - late_fee_paid)
+        entry, puts = tag_ledger.entry_puts(
+            tag['tag_id'], 'adjustment', amount, entry_reference, tag_ledger.now_iso(),
+            balance_delta=credit, debt_delta=-debt_paid, late_fee_delta=-late_fee_paid
+        )
+        seq = int(tag.get('ledger_topup_seq') or 0)
+        items = [
+            {
+                'Update': tag_versions.versioned({
+                    'TableName': tags_table_name,
+                    'Key': {'tag_id': tag['tag_id']},
+                    'UpdateExpression': 'SET ledger_topup_seq = :seq, last_updated = :last_updated',
+                    'ConditionExpression': 'attribute_exists(tag_id) AND '
+                                           '(attribute_not_exists(ledger_watermark) OR ledger_watermark < :entry_id) AND '
+                                           + _observed('ledger_topup_seq', seq),
+                    'ExpressionAttributeValues': {
+                        ':seq': seq + 1,
+                        ':observed_ledger_topup_seq': seq,
+                        ':entry_id': entry['entry_id'],
+                        ':last_updated': timestamp
+                    }
+                })
+            },
+            *puts,
+            {
+                'Put': {
+                    'TableName': TAG_TOPUPS_TABLE,
+                    'Item': record,
+                    'ConditionExpression': 'attribute_not_exists(bank_reference)'
+                }
+            }
+        ]
+        try:
+            dynamodb.meta.client.transact_write_items(TransactItems=items)
+            return record
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+            if len(reasons) > 3 and reasons[3] == 'ConditionalCheckFailed':
+                raise DuplicateTopup(get_record(dynamodb, reference))
+            if len(reasons) > 2 and reasons[2] == 'ConditionalCheckFailed':
+                # Entrada sin comprobante (escrita antes de que ambos fueran en la misma transacción)
+                return _record_applied_entry(dynamodb, tag, reference, amount, timestamp, source, attributes, entry_reference)
+            if (reasons and reasons[0] == 'ConditionalCheckFailed') or 'TransactionConflict' in reasons:
+                tag = tags_table.get_item(Key={'tag_id': tag['tag_id']}, ConsistentRead=True).get('Item')
+                if not tag:
+                    raise ValueError('Tag not found')
+                continue
+            raise
+    raise ValueError(f"Could not apply top-up {reference} to tag {tag['tag_id']} after {MAX_TOPUP_ATTEMPTS} attempts")
+
+
+def _record_applied_entry(dynamodb, tag, reference, amount, timestamp, source, attributes, entry_reference):
+    """
+    Comprobante de una entrada ya registrada en el ledger: lo pagado sale de
+    la entrada y lo restante del estado anterior a ella (el estado actual ya
+    la incluye). Si la entrada ya se compactó, lo restante es el estado actual.
+    """
+    entry = tag_ledger.fetch_entry(dynamodb, tag['tag_id'], 'adjustment', entry_reference)
+    late_fee_paid = -to_decimal(entry.get('late_fee_delta'))
+    debt_paid = -to_decimal(entry.get('debt_delta'))
+    credit = to_decimal(entry.get('balance_delta'))
+    record = _record(tag, reference, amount, late_fee_paid, debt_paid, credit, timestamp, source, attributes)
+    before = tag_ledger.state_before(dynamodb, tag, entry)
+    if before is None:
+        state = tag_ledger.read_state(dynamodb, tag)
+        record['remaining_debt'] = max(ZERO, state['debt'])
+        record['remaining_late_fee'] = max(ZERO, state['late_fee'])
+    else:
+        record['remaining_debt'] = max(ZERO, before['debt'] - debt_paid)
+        record['remaining_late_fee'] = max(ZERO, before['late_fee'] - late_fee_paid)
+    try:
+        dynamodb.Table(TAG_TOPUPS_TABLE).put_item(Item=record, ConditionExpression='attribute_not_exists(bank_reference)')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        raise DuplicateTopup(get_record(dynamodb, reference))
+    return record
+
+
+def apply(dynamodb, tags_table_name, tag, amount, reference, source='api', now=None, **attributes):
+    """
+    Aplica una recarga al tag en una sola escritura atómica
+    (TransactWriteItems): update condicional de Tags (mora y deuda pagadas,
+    ADD del resto al balance o al shard del tag) + put del comprobante con
+    attribute_not_exists(bank_reference). Si la deuda o la mora cambiaron desde la
+    lectura, se relee el tag y se reintenta.
+    Retorna el comprobante; lanza DuplicateTopup si la referencia ya se aplicó.
+    """
+    amount = to_decimal(amount)
+    if amount <= 0:
+        raise ValueError('Amount must be greater than zero')
+    timestamp = (now or datetime.utcnow()).isoformat() + 'Z'
+    if tag_ledger.TAG_LEDGER_ENABLED:
+        return _apply_ledger(dynamodb, tags_table_name, tag, reference, amount, timestamp, source, attributes)
+
+    tags_table = dynamodb.Table(tags_table_name)
+    for _ in range(MAX_TOPUP_ATTEMPTS):
+        debt = to_decimal(tag.get('debt', 0))
+        late_fee = to_decimal(tag.get('late_fee', 0))
+        late_fee_paid, debt_paid, credit = split_payment(amount, debt, late_fee)
+        record = _record(tag, reference, amount, late_fee_paid, debt_paid, credit, timestamp, source, attributes)
+        record['remaining_debt'] = debt - debt_paid
+        record['remaining_late_fee'] = late_fee - late_fee_paid
+        items = [
+            _tag_update(tags_table_name, tag, debt, late_fee, late_fee_paid, debt_paid, credit, timestamp),
+            {
+                'Put': {
+                    'TableName': TAG_TOPUPS_TABLE,
+                    'Item': record,
+                    'ConditionExpression': 'attribute_not_exists(bank_reference)'
+                }
+            }
+        ]
+        if credit > 0 and sharded_balance.is_sharded(tag):
+            items.append(sharded_balance.credit_update(tag, credit, reference, timestamp))
+        try:
+            dynamodb.meta.client.transact_write_items(TransactItems=items)
+            if sharded_balance.is_sharded(tag):
+                sharded_balance.invalidate(tag['tag_id'])
+            return record
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = [r.get('Code') for r in e.response.get('CancellationReasons', [])]
+            if len(reasons) > 1 and reasons[1] == 'ConditionalCheckFailed':
+                raise DuplicateTopup(get_record(dynamodb, reference))
+            if (reasons and reasons[0] == 'ConditionalCheckFailed') or 'TransactionConflict' in reasons:
+                tag = tags_table.get_item(Key={'tag_id': tag['tag_id']}, ConsistentRead=True).get('Item')
+                if not tag:
+                    raise ValueError('Tag not found')
+                continue
+            raise
+    raise ValueError(f"Could not apply top-up {reference} to tag {tag['tag_id']} after {MAX_TOPUP_ATTEMPTS} attempts")
+
+
+def pending_transactions(dynamodb, transactions_table_name, placa, tag_id):
+    """Transacciones del tag con requires_payment=true, de la más antigua a la más nueva."""
+    kwargs = {
+        'KeyConditionExpression': Key('placa').eq(placa),
+        'FilterExpression': 'requires_payment = :true AND tag_id = :tag_id',
+        'ExpressionAttributeValues': {':true': True, ':tag_id': tag_id}
+    }
+    table = dynamodb.Table(transactions_table_name)
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def settle_pending(dynamodb, transactions_table_name, record):
+    """
+    Si la recarga dejó el tag sin deuda ni mora, marca como pagadas sus
+    transacciones pendientes (condicional a requires_payment=true, así no
+    compite con complete_pending_transaction). Con pago parcial no se marca
+    ninguna: la deuda del tag es acumulada y no se reparte por transacción.
+    Retorna los event_id marcados.
+    """
+    if record.get('remaining_debt', ZERO) > 0 or record.get('remaining_late_fee', ZERO) > 0:
+        return []
+    if not record.get('placa') or not (record.get('debt_paid', ZERO) > 0 or record.get('late_fee_paid', ZERO) > 0):
+        return []
+    table = dynamodb.Table(transactions_table_name)
+    settled = []
+    for transaction in pending_transactions(dynamodb, transactions_table_name, record['placa'], record['tag_id']):
+        try:
+            table.update_item(
+                Key={'placa': transaction['placa'], 'ts': transaction['ts']},
+                UpdateExpression='SET #status = :status, requires_payment = :false, completed_at = :completed_at, '
+                                 'paid_via = :paid_via, topup_reference = :reference',
+                ConditionExpression='requires_payment = :true',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':status': 'completed',
+                    ':false': False,
+                    ':true': True,
+                    ':completed_at': record['applied_at'],
+                    ':paid_via': 'topup',
+                    ':reference': record['bank_reference']
+                }
+            )
+            settled.append(transaction['ts'])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    if settled or 'settled_transactions' not in record:
+        dynamodb.Table(TAG_TOPUPS_TABLE).update_item(
+            Key={'bank_reference': record['bank_reference']},
+            UpdateExpression='SET settled_transactions = :settled',
+            ExpressionAttributeValues={':settled': settled}
+        )
+    return settled
+
+
+def topup(dynamodb, tags_table_name, transactions_table_name, tag, amount, reference, source='api', **attributes):
+    """
+    Recarga completa: apply() + settle_pending(). Retorna (comprobante, duplicado);
+    para una referencia ya aplicada retorna el comprobante original.
+    """
+    try:
+        record = apply(dynamodb, tags_table_name, tag, amount, reference, source=source, **attributes)
+    except DuplicateTopup as e:
+        record = e.record
+        if record is not None and 'settled_transactions' not in record:
+            # Reintento de una recarga interrumpida antes de marcar las pendientes
+            record['settled_transactions'] = settle_pending(dynamodb, transactions_table_name, record)
+        return record, True
+    record['settled_transactions'] = settle_pending(dynamodb, transactions_table_name, record)
+    return record, False
+
+
+def resolve_tag(dynamodb, tags_table_name, users_table_name, placa=None, tag_id=None):
+    """
+    Tag activo a recargar, por tag_id o por placa (UsersVehicles.tag_id y,
+    si no hay referencia, scan de Tags por placa como manage_tags).
+    Retorna None si no existe o no está activo.
+    """
+    tags_table = dynamodb.Table(tags_table_name)
+    if not tag_id and placa:
+        user = dynamodb.Table(users_table_name).get_item(
+            Key={'placa': placa}, ProjectionExpression='tag_id'
+        ).get('Item') or {}
+        tag_id = user.get('tag_id')
+    tag = tags_table.get_item(Key={'tag_id': tag_id}).get('Item') if tag_id else None
+    if tag is None and placa:
+        response = tags_table.scan(
+            FilterExpression='placa = :placa AND #status = :active',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={':placa': placa, ':active': 'active'}
+        )
+        tag = next(iter(response.get('Items', [])), None)
+    if tag is None or tag.get('status') != 'active' or (placa and tag.get('placa') != placa):
+        return None
+    return tag
@@ -0,0 +1,53 @@
+import re
+
+# Control de concurrencia optimista de los items de Tags.
+# Cada escritura del item incrementa el atributo version (ADD, el item sin
+# version cuenta como 0). Los escritores que leen el tag y escriben valores
+# calculados (read-modify-write) condicionan el update a la versión leída y
+# reintentan con el tag releído si otro escritor se adelantó.
+VERSION_NAME = '#version'
+MAX_VERSION_ATTEMPTS = 3
+
+_ADD_CLAUSE = re.compile(r'\bADD\s+')
+
+
+class VersionConflict(Exception):
+    """Otro escritor modificó el tag desde la lectura (versión distinta)."""
+
+    def __init__(self, tag_id, expected):
+        super().__init__(f'Tag {tag_id} changed since version {expected}')
+        self.tag_id = tag_id
+        self.expected = expected
+
+
+def current(tag):
+    """Versión del item de Tags (0 si nunca se versionó)."""
+    return int((tag or {}).get('version') or 0)
+
+
+def versioned(update, expected=None):
+    """
+    Agrega el incremento de versión a un update de Tags (kwargs de
+    update_item o el 'Update' de TransactWriteItems) y, si expected no es
+    None, la condición de que la versión siga siendo la leída.
+    Retorna el mismo dict.
+    """
+    expression = update['UpdateExpression']
+    if _ADD_CLAUSE.search(expression):
+        expression = _ADD_CLAUSE.sub(f'ADD {VERSION_NAME} :version_one, ', expression, count=1)
+    else:
+        expression += f' ADD {VERSION_NAME} :version_one'
+    update['UpdateExpression'] = expression
+    update.setdefault('ExpressionAttributeNames', {})[VERSION_NAME] = 'version'
+    update.setdefault('ExpressionAttributeValues', {})[':version_one'] = 1
+
+    if expected is not None:
+        if expected:
+            condition = f'{VERSION_NAME} = :expected_version'
+            update['ExpressionAttributeValues'][':expected_version'] = expected
+        else:
+            condition = f'attribute_not_exists({VERSION_NAME})'
+        previous = update.get('ConditionExpression')
+        update['ConditionExpression'] = f'({previous}) AND {condition}' if previous else condition
+    return update
+
@@ -0,0 +1,63 @@
+import os
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import event_ids
+
+# Contadores pre-agregados por peaje y hora (UTC), mantenidos por
+# aggregate_toll_stats desde el stream de Transactions.
+# Llave: aggregate_id = <peaje_id>#<YYYY-MM-DDTHH>
+TOLL_AGGREGATES_TABLE = os.environ.get('TOLL_AGGREGATES_TABLE')
+HOUR_FORMAT = '%Y-%m-%dT%H'
+USER_TYPES = ('tag', 'registrado', 'no_registrado')
+# Contadores acumulados (por total y por user_type)
+COUNTERS = ('crossings', 'amount', 'subtotal', 'tax')
+MAX_HOURS = 31 * 24
+BATCH_GET_SIZE = 100
+ZERO = Decimal('0')
+
+
+def hour_of(timestamp):
+    """Hora UTC (YYYY-MM-DDTHH) de un timestamp ISO 8601."""
+    millis = event_ids.to_millis(timestamp)
+    return datetime.fromtimestamp(millis / 1000, tz=timezone.utc).strftime(HOUR_FORMAT)
+
+
+def aggregate_id(peaje_id, hour):
+    return f"{peaje_id}#{hour}"
+
+
+def hours_between(start, end):
+    """Horas (YYYY-MM-DDTHH) desde start hasta end inclusive."""
+    cursor = datetime.strptime(hour_of(start), HOUR_FORMAT)
+    last = datetime.strptime(hour_of(end), HOUR_FORMAT)
+    hours = []
+    while cursor <= last:
+        hours.append(cursor.strftime(HOUR_FORMAT))
+        cursor += timedelta(hours=1)
+    return hours
+
+
+def empty_counters():
+    counters = {name: ZERO for name in COUNTERS}
+    counters['late_fee'] = ZERO
+    for user_type in USER_TYPES:
+        counters[f'crossings_{user_type}'] = ZERO
+        counters[f'amount_{user_type}'] = ZERO
+    return counters
+
+
+def read(dynamodb, peaje_id, hours):
+    """
+    Lee los agregados de un peaje para una lista de horas con batch_get_item
+    (una clave por hora). Retorna {hour: item}; las horas sin cruces no aparecen.
+    """
+    keys = [{'aggregate_id': aggregate_id(peaje_id, hour)} for hour in hours]
+    items = {}
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        request = {TOLL_AGGREGATES_TABLE: {'Keys': keys[start:start + BATCH_GET_SIZE]}}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(TOLL_AGGREGATES_TABLE, []):
+                items[item['hour']] = item
+            request = response.get('UnprocessedKeys') or None
+    return items
@@ -0,0 +1,75 @@
+import os
+import time
+from botocore.exceptions import ClientError
+import cache_versions
+
+# Catálogo de peajes completo en memoria del contenedor (ingest_webhook y
+# validate_transaction). Son pocas decenas de items: se lee con un scan en la
+# fase de init y se recarga al vencer TOLL_CATALOG_TTL_SECONDS o cuando
+# seed_csv / load_csv_data incrementan la versión 'tolls' de CacheVersions.
+TOLLS_CATALOG_TABLE = os.environ.get('TOLLS_CATALOG_TABLE')
+TOLL_CATALOG_TTL_SECONDS = int(os.environ.get('TOLL_CATALOG_TTL_SECONDS', '300'))
+TOLL_CATALOG_VERSION_CHECK_SECONDS = int(os.environ.get('TOLL_CATALOG_VERSION_CHECK_SECONDS', '30'))
+
+
+class TollCatalog:
+    """
+    get(peaje_id) responde desde memoria. Un peaje que no está en el catálogo
+    cargado se consulta con get_item (peaje creado después de la carga); el
+    llamador decide si cachea el resultado negativo.
+    """
+
+    def __init__(self, dynamodb, table_name=None, ttl_seconds=None):
+        self.dynamodb = dynamodb
+        self.table_name = table_name or TOLLS_CATALOG_TABLE
+        self.ttl_seconds = TOLL_CATALOG_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        self.items = {}
+        self.loaded_at = None
+        self.version = cache_versions.VersionWatcher(
+            dynamodb, cache_versions.TOLLS_KEY, TOLL_CATALOG_VERSION_CHECK_SECONDS
+        )
+
+    def __len__(self):
+        return len(self.items)
+
+    def load(self, now=None):
+        """Lee el catálogo completo (scan paginado)."""
+        if self.version.version is None:
+            # Versión base leída antes que el catálogo: un cambio posterior lo invalida
+            self.version.changed()
+        table = self.dynamodb.Table(self.table_name)
+        items = {}
+        kwargs = {}
+        while True:
+            response = table.scan(**kwargs)
+            for item in response.get('Items', []):
+                items[item['peaje_id']] = item
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        self.items = items
+        self.loaded_at = now or time.monotonic()
+        return len(items)
+
+    def is_stale(self, now=None):
+        if self.loaded_at is None:
+            return True
+        return (now or time.monotonic()) - self.loaded_at > self.ttl_seconds
+
+    def get(self, peaje_id, now=None, fetch_missing=True):
+        """
+        fetch_missing=False responde solo desde memoria (modo accept de
+        ingest_webhook): un peaje recién creado se ve al recargar el catálogo.
+        """
+        if self.is_stale(now) or self.version.changed(now):
+            try:
+                self.load(now)
+            except ClientError as e:
+                # Se sigue con el catálogo anterior; el siguiente get reintenta
+                print(f'Warning: Could not load toll catalog: {e}')
+        item = self.items.get(peaje_id)
+        if item is None and fetch_missing:
+            item = self.dynamodb.Table(self.table_name).get_item(Key={'peaje_id': peaje_id}).get('Item')
+            if item is not None:
+                self.items[peaje_id] = item
+        return item
@@ -0,0 +1,39 @@
+# Reglas de cobro compartidas por calculate_charge (Step Functions) y
+# process_toll_batch (procesamiento por lotes desde SQS).
+IVA_RATE = 0.12  # IVA 12% según normativa guatemalteca
+TAG_DISCOUNT_RATE = 0.10
+
+
+def compute_charge(user_type, peaje_info):
+    """
+    Calcula el monto a cobrar según el tipo de usuario y las tarifas del peaje.
+    
+    Aplica:
+    - Tarifas diferenciadas por tipo de usuario (registrado, no_registrado, tag)
+    - Descuento del 10% para usuarios con Tag (ya incluido en tarifa_tag)
+    - IVA del 12% sobre el subtotal
+    """
+    if not user_type or not peaje_info:
+        raise ValueError('Missing required data for charge calculation')
+    
+    # Obtener tarifa según tipo de usuario
+    tarifa_key = f'tarifa_{user_type}'
+    tarifa_base = float(peaje_info.get('tarifa_base', 0))
+    amount = float(peaje_info.get(tarifa_key, tarifa_base))
+    
+    # El descuento ya está aplicado en tarifa_tag; se calcula el monto para trazabilidad
+    discount_applied = round(tarifa_base * TAG_DISCOUNT_RATE, 2) if user_type == 'tag' else 0.0
+    
+    subtotal = amount
+    tax = subtotal * IVA_RATE
+    total = subtotal + tax
+    
+    return {
+        'subtotal': round(subtotal, 2),
+        'tax': round(tax, 2),
+        'total': round(total, 2),
+        'currency': 'GTQ',
+        'user_type': user_type,
+        'tarifa_aplicada': round(amount, 2),
+        'discount_applied': discount_applied
+    }
@@ -0,0 +1,70 @@
+import json
+import os
+import time
+import uuid
+
+# Preparación de contenedores de las funciones del camino caliente
+# (ingest_webhook, validate_transaction, calculate_charge):
+# - prime(): en la fase de init (al importar app.py) carga catálogos y abre
+#   las conexiones, fuera de la invocación facturada del primer cruce.
+# - is_warmup()/respond(): el evento {"warmup": true} de warm_functions se
+#   responde sin tocar la lógica del handler.
+INIT_PRIMING_ENABLED = os.environ.get('INIT_PRIMING_ENABLED', 'true').lower() == 'true'
+WARMUP_KEY = 'warmup'
+# Tope del delay_ms que pide warm_functions (muy por debajo del timeout)
+MAX_WARMUP_DELAY_MS = 5000
+
+# Identidad del contenedor: warm_functions cuenta los contenedores distintos
+CONTAINER_ID = uuid.uuid4().hex[:12]
+_state = {'initialized_at': time.time(), 'primed': {}, 'warmups': 0}
+
+
+def prime(function_name, steps):
+    """
+    Ejecuta los pasos de preparación {nombre: callable} en orden. Cada paso es
+    best-effort: un fallo se registra y el dato se carga de forma perezosa en
+    la primera invocación, como antes.
+    """
+    if not INIT_PRIMING_ENABLED:
+        return {}
+    results = {}
+    for name, step in steps.items():
+        start = time.perf_counter()
+        try:
+            step()
+            status = 'ok'
+        except Exception as e:
+            status = f'failed: {e}'
+        results[name] = {'elapsed_ms': round((time.perf_counter() - start) * 1000, 1), 'status': status}
+    _state['primed'] = results
+    print(json.dumps({
+        'function': function_name,
+        'container_id': CONTAINER_ID,
+        'steps': results,
+        'status': 'container_primed'
+    }))
+    return results
+
+
+def is_warmup(event):
+    return isinstance(event, dict) and event.get(WARMUP_KEY) is True
+
+
+def respond(event, context=None):
+    """
+    Respuesta a una invocación de calentamiento. delay_ms mantiene ocupado el
+    contenedor para que las invocaciones concurrentes de warm_functions caigan
+    en contenedores distintos.
+    """
+    delay_ms = min(int(event.get('delay_ms') or 0), MAX_WARMUP_DELAY_MS)
+    if delay_ms > 0:
+        time.sleep(delay_ms / 1000)
+    _state['warmups'] += 1
+    return {
+        'warm': True,
+        'function': getattr(context, 'function_name', None),
+        'container_id': CONTAINER_ID,
+        'first_warmup': _state['warmups'] == 1,
+        'container_age_seconds': round(time.time() - _state['initialized_at'], 1),
+        'primed': sorted(_state['primed'])
+    }
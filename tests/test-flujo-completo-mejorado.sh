@@ -271,7 +271,6 @@ check_and_complete_pending_transactions() {
     # Consultar transacciones pendientes
     local result=$(aws dynamodb query \
         --table-name "$table_name" \
-        --index-name "placa-timestamp-index" \
         --key-condition-expression "placa = :placa" \
         --filter-expression "#status = :status" \
         --expression-attribute-names '{"#status": "status"}' \
@@ -407,11 +406,10 @@ check_dynamodb_transactions() {
     
     # Intentar con retry logic para manejar eventual consistency
     for i in $(seq 1 $max_retries); do
-        # Consultar usando GSI placa-timestamp-index
+        # Consultar la tabla base (ts ordenable por tiempo, más recientes primero)
         # Esto verifica que la transacción fue CREADA por el flujo, no que ya existía
         result=$(aws dynamodb query \
             --table-name "$table_name" \
-            --index-name "placa-timestamp-index" \
             --key-condition-expression "placa = :placa" \
             --expression-attribute-values "{\":placa\":{\"S\":\"$placa\"}}" \
             --region "$REGION" \
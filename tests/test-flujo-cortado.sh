@@ -124,7 +124,6 @@ check_transaction_status() {
     while [ $attempt -lt $max_attempts ]; do
         local result=$(aws dynamodb query \
             --table-name "Transactions-${STAGE}" \
-            --index-name "placa-timestamp-index" \
             --key-condition-expression "placa = :placa" \
             --expression-attribute-values "{\":placa\":{\"S\":\"$placa\"}}" \
             --region "$REGION" \